@@ -1,24 +1,87 @@
 # app.py
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+from flask import Flask, render_template, request, redirect, url_for, jsonify, Response, stream_with_context, g
 import os
+import time
 import urllib.parse
 import re
 
 from db_writer import (
     get_connection,
-    ensure_department_exists,
-    insert_project,
-    update_task_status,
-    insert_project_update
+    insert_project_updates_bulk,
+    update_tasks_status_bulk,
+    pool_stats
 )
-from mailer import send_email
+import dept_counters
+import project_repository as repo
+from read_cache import get_cache, DEPARTMENTS_CACHE_TTL
+import outbox
+import search_index
+import export
+import change_feed
+import metrics
+from mailer import build_message, get_pool as get_mail_pool
+from preclassifier import task_message_id
 from dotenv import load_dotenv
 load_dotenv()
 
 app = Flask(__name__, template_folder="template")
+cache = get_cache()
 
 
-def fetch_departments():
+# ------------------------------------------------------------
+# Request timing, sampled profiling and /metrics
+# ------------------------------------------------------------
+@app.before_request
+def _start_timer():
+    g.request_started = time.perf_counter()
+    g.profile = metrics.start_profile()
+
+
+def _finish_request(status):
+    """Record the request and stop its profile; runs once per request."""
+    metrics.stop_profile(g.pop("profile", None), f"http-{request.endpoint or 'unmatched'}")
+    started = g.pop("request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        seconds = time.perf_counter() - started
+        labels = {"route": route, "method": request.method, "status": status}
+        metrics.observe("http_request_seconds", seconds, **labels)
+        metrics.log_timing("http_request_seconds", seconds, labels)
+
+
+@app.after_request
+def _record_request(response):
+    # for streamed bodies (exports, SSE) this is the time until the view
+    # returned the response object, not until the last chunk was sent
+    _finish_request(response.status_code)
+    return response
+
+
+@app.teardown_request
+def _record_failed_request(exc=None):
+    # an exception Flask does not turn into a response (PROPAGATE_EXCEPTIONS,
+    # debug mode) skips after_request; without this the profiler would
+    # stay enabled on this worker thread. Handled requests were already
+    # recorded, so this is a no-op for them
+    _finish_request(500)
+
+
+@metrics.register_collector
+def _pool_gauges():
+    db = pool_stats()
+    return [
+        ("db_pool_connections", {"state": "in_use"}, db["in_use"]),
+        ("db_pool_connections", {"state": "idle"}, db["idle"]),
+        ("read_cache_hit_ratio", {}, cache.stats()["hit_ratio"]),
+    ]
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+def _load_departments():
     conn = get_connection()
     cur = conn.cursor()
     cur.execute("SELECT name FROM departments WHERE name IS NOT NULL AND name <> '' ORDER BY name")
@@ -27,6 +90,19 @@ def fetch_departments():
     return departments
 
 
+def fetch_departments():
+    return cache.get_or_load("departments", "", (), _load_departments, ttl=DEPARTMENTS_CACHE_TTL)
+
+
+def find_department(name):
+    """Canonical spelling of a department name, or None (served from the cached list)."""
+    wanted = (name or "").strip().lower()
+    for dept in fetch_departments():
+        if dept.lower() == wanted:
+            return dept
+    return None
+
+
 # ------------------------------------------------------------
 # Detect if admin reply means "resolved"
 # ------------------------------------------------------------
@@ -51,145 +127,134 @@ def home():
 # ------------------------------------------------------------
 # Department view with filters
 # ------------------------------------------------------------
+# Pages are addressed by the (created_at, id) of the last row shown
+# (see project_repository), so a page costs the same whether it is the
+# first or the thousandth.
 @app.route("/<dept_name>")
 def department_view(dept_name):
-    dept_lower = dept_name.strip().lower()
-
     status_filter = (request.args.get("status") or "").strip().lower()
     priority_filter = (request.args.get("priority") or "").strip().lower()
     email_filter = (request.args.get("email") or "").strip().lower()
+    limit = repo.page_size(request.args.get("limit"))
+    before = repo.decode_cursor(request.args.get("before"))
 
-    conn = get_connection()
-    cur = conn.cursor()
-
-    cur.execute("SELECT name FROM departments WHERE LOWER(name) = ?", (dept_lower,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
+    actual_name = find_department(dept_name)
+    if not actual_name:
         return f"Invalid department name: {dept_name}", 400
-    actual_name = row[0]
-
-    query = """
-        SELECT id, project_type, owner_email, assigned_dept,
-               time_required, status, priority, created_at, summary
-        FROM projects
-        WHERE LOWER(assigned_dept) = ?
-    """
-    params = [dept_lower]
-
-    if status_filter:
-        query += " AND LOWER(status) = ?"
-        params.append(status_filter)
-
-    if priority_filter:
-        query += " AND LOWER(priority) = ?"
-        params.append(priority_filter)
-
-    if email_filter:
-        query += " AND LOWER(owner_email) LIKE ?"
-        params.append(f"%{email_filter}%")
-
-    query += " ORDER BY created_at DESC"
-
-    cur.execute(query, params)
-    projects = cur.fetchall()
-
-    project_ids = [str(p.id) for p in projects]
-    updates_map = {}
-
-    if project_ids:
-        placeholders = ",".join("?" for _ in project_ids)
-        q = f"""
-            SELECT project_id, update_message, from_email, update_type, created_at
-            FROM project_updates
-            WHERE project_id IN ({placeholders})
-            ORDER BY created_at ASC
-        """
-        cur.execute(q, project_ids)
-        rows = cur.fetchall()
-        for r in rows:
-            updates_map.setdefault(r.project_id, []).append({
-                "message": r.update_message,
-                "from_email": r.from_email,
-                "update_type": r.update_type,
-                "created_at": r.created_at
-            })
-
-    projects_list = []
-    for p in projects:
-        projects_list.append({
-            "id": p.id,
-            "project_type": p.project_type,
-            "owner_email": p.owner_email,
-            "assigned_dept": p.assigned_dept,
-            "time_required": p.time_required,
-            "status": p.status,
-            "priority": p.priority,
-            "created_at": p.created_at,
-            "summary": p.summary,
-            "updates": updates_map.get(p.id, [])
-        })
 
-    conn.close()
+    def load_page():
+        # watermark first: the live feed replays anything committed after it
+        mark = change_feed.known_mark(actual_name)
+        return mark, repo.department_page(
+            actual_name, status_filter, priority_filter, email_filter, limit=limit, before=before
+        )
+
+    mark, page = cache.get_or_load(
+        "page", actual_name,
+        (status_filter, priority_filter, email_filter, limit, request.args.get("before") if before else None),
+        load_page
+    )
 
     return render_template(
         "department.html",
         dept=actual_name,
-        projects=projects_list,
+        projects=page.projects,
         status_filter=status_filter,
         priority_filter=priority_filter,
-        email_filter=email_filter
+        email_filter=email_filter,
+        limit=limit,
+        is_first_page=before is None,
+        next_cursor=page.next_cursor,
+        feed_mark=change_feed.encode_mark(mark)
     )
 
 
 # ------------------------------------------------------------
-# Dashboard
+# Live changes (server-sent events, or one long-poll with ?poll=1)
 # ------------------------------------------------------------
-@app.route("/<dept_name>/dashboard")
-def department_dashboard(dept_name):
-    dept_lower = dept_name.strip().lower()
-    conn = get_connection()
-    cur = conn.cursor()
+CHANGE_FEED_HEARTBEAT = float(os.getenv("CHANGE_FEED_HEARTBEAT", 15))
+CHANGE_FEED_LONG_POLL = float(os.getenv("CHANGE_FEED_LONG_POLL", 25))
 
-    cur.execute("SELECT name FROM departments WHERE LOWER(name) = ?", (dept_lower,))
-    row = cur.fetchone()
-    if not row:
-        conn.close()
+
+@app.route("/<dept_name>/changes")
+def department_changes(dept_name):
+    actual_name = find_department(dept_name)
+    if not actual_name:
         return f"Invalid department name: {dept_name}", 400
 
-    cur.execute("""
-        SELECT status, priority
-        FROM projects
-        WHERE LOWER(assigned_dept) = ?
-    """, (dept_lower,))
-    rows = cur.fetchall()
-    conn.close()
+    # EventSource resends the last event id by itself when it reconnects
+    since = change_feed.decode_mark(request.headers.get("Last-Event-ID") or request.args.get("since"))
+    sub = change_feed.subscribe(actual_name, since)
+
+    if request.args.get("poll") == "1":
+        try:
+            event = sub.get(CHANGE_FEED_LONG_POLL)
+        finally:
+            sub.close()
+        return jsonify(event or change_feed.changes_event(since, [], []))
+
+    def stream():
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                event = sub.get(CHANGE_FEED_HEARTBEAT)
+                if event is None:
+                    # keeps proxies from closing the stream, and notices gone clients
+                    yield ": keepalive\n\n"
+                    continue
+                yield change_feed.sse(event)
+                if event["type"] == "reset":
+                    return
+        finally:
+            sub.close()
+
+    return Response(
+        stream_with_context(stream()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
-    total = len(rows)
-    pending = sum(1 for r in rows if (r.status or "").lower() == "pending")
-    resolved = sum(1 for r in rows if (r.status or "").lower() == "resolved")
 
-    priority_count = {
-        "pending": {"high": 0, "medium": 0, "low": 0},
-        "resolved": {"high": 0, "medium": 0, "low": 0}
-    }
+# ------------------------------------------------------------
+# Older updates for one project (JSON, used by department.html)
+# ------------------------------------------------------------
+@app.route("/project/<int:project_id>/updates")
+def project_updates(project_id):
+    limit = repo.page_size(request.args.get("limit"), default=repo.UPDATES_PER_PROJECT * 4)
+    updates, next_cursor = repo.project_updates(project_id, limit, request.args.get("before"))
+    return jsonify({
+        "ok": True,
+        "updates": [dict(u._asdict(), created_at=str(u.created_at)) for u in updates],
+        "next_cursor": next_cursor
+    })
 
-    for r in rows:
-        status = (r.status or "").lower()
-        priority = (r.priority or "").lower()
-        if priority in ("high", "medium", "low"):
-            if status == "pending":
-                priority_count["pending"][priority] += 1
-            elif status == "resolved":
-                priority_count["resolved"][priority] += 1
+
+# ------------------------------------------------------------
+# Dashboard
+# ------------------------------------------------------------
+@app.route("/<dept_name>/dashboard")
+def department_dashboard(dept_name):
+    actual_name = find_department(dept_name)
+    if not actual_name:
+        return f"Invalid department name: {dept_name}", 400
+
+    def load_counts():
+        # O(1): a few pre-aggregated rows instead of every project in the dept
+        conn = get_connection()
+        try:
+            return dept_counters.fetch_dashboard_counts(conn.cursor(), actual_name)
+        finally:
+            conn.close()
+
+    counts = cache.get_or_load("dashboard", actual_name, (), load_counts)
 
     return render_template(
         "department_stats.html",
         dept=dept_name,
-        total=total,
-        pending=pending,
-        resolved=resolved,
-        priority_count=priority_count
+        total=counts["total"],
+        pending=counts["pending"],
+        resolved=counts["resolved"],
+        priority_count=counts["priority_count"]
     )
 
 
@@ -212,70 +277,133 @@ def sender_results():
     if not raw_email:
         return redirect(url_for("sender_lookup"))
     email = urllib.parse.unquote_plus(raw_email).strip().lower()
-    like_pattern = f"%{email}%"
+    before = repo.decode_cursor(request.args.get("before"))
 
-    conn = get_connection()
-    cur = conn.cursor()
-    cur.execute("""
-        SELECT id, project_type, owner_email, assigned_dept,
-               time_required, status, priority, created_at, summary
-        FROM projects
-        WHERE LOWER(owner_email) LIKE ?
-        ORDER BY created_at DESC
-    """, (like_pattern,))
-    projects = cur.fetchall()
-
-    projects_list = []
-    project_ids = []
-    for p in projects:
-        projects_list.append({
-            "id": p.id,
-            "project_type": p.project_type,
-            "owner_email": p.owner_email,
-            "assigned_dept": p.assigned_dept,
-            "time_required": p.time_required,
-            "status": p.status,
-            "priority": p.priority,
-            "created_at": p.created_at,
-            "summary": p.summary
-        })
-        project_ids.append(str(p.id))
-
-    updates_map = {}
-    if project_ids:
-        placeholders = ",".join("?" for _ in project_ids)
-        q = f"""
-            SELECT project_id, update_message, from_email, update_type, created_at
-            FROM project_updates
-            WHERE project_id IN ({placeholders})
-            ORDER BY created_at ASC
-        """
-        cur.execute(q, project_ids)
-        rows = cur.fetchall()
-        for r in rows:
-            updates_map.setdefault(r.project_id, []).append({
-                "message": r.update_message,
-                "from_email": r.from_email,
-                "update_type": r.update_type,
-                "created_at": r.created_at
-            })
-
-    total = len(projects_list)
-    pending = sum(1 for p in projects_list if (p["status"] or "").lower() == "pending")
-    resolved = sum(1 for p in projects_list if (p["status"] or "").lower() == "resolved")
-    conn.close()
+    page = repo.sender_page(email, limit=repo.page_size(request.args.get("limit"), repo.SENDER_PAGE_SIZE),
+                            before=before)
 
     return render_template(
         "sender_dashboard.html",
         email_display=email,
-        projects=projects_list,
-        total=total,
-        pending=pending,
-        resolved=resolved,
-        updates_map=updates_map
+        raw_email=raw_email,
+        projects=page.projects,
+        total=page.counts.total,
+        pending=page.counts.pending,
+        resolved=page.counts.resolved,
+        next_cursor=page.next_cursor
+    )
+
+
+# ------------------------------------------------------------
+# Streaming exports (CSV / JSONL, optional gzip)
+# ------------------------------------------------------------
+def _export_response(rows, filename):
+    fmt = (request.args.get("format") or "csv").strip().lower()
+    if fmt not in export.FORMATS:
+        return f"Unknown export format: {fmt}", 400
+    compress = request.args.get("gzip") == "1"
+
+    filename = f"{filename}.{fmt}"
+    mimetype = export.FORMATS[fmt]
+    if compress:
+        filename += ".gz"
+        mimetype = "application/gzip"
+
+    # no Content-Length: the body goes out chunked as rows are read
+    return Response(
+        stream_with_context(export.export(rows, fmt, compress)),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+@app.route("/<dept_name>/export")
+def department_export(dept_name):
+    actual_name = find_department(dept_name)
+    if not actual_name:
+        return f"Invalid department name: {dept_name}", 400
+
+    rows = export.department_rows(
+        actual_name,
+        (request.args.get("status") or "").strip().lower(),
+        (request.args.get("priority") or "").strip().lower(),
+        (request.args.get("email") or "").strip().lower()
+    )
+    slug = re.sub(r"[^a-z0-9]+", "_", actual_name.lower()).strip("_") or "department"
+    return _export_response(rows, f"{slug}_tickets")
+
+
+@app.route("/sender/export")
+def sender_export():
+    email = urllib.parse.unquote_plus(request.args.get("email", "")).strip().lower()
+    if not email:
+        return "Missing email", 400
+    slug = re.sub(r"[^a-z0-9]+", "_", email).strip("_") or "sender"
+    return _export_response(export.sender_rows(email), f"{slug}_tickets")
+
+
+# ------------------------------------------------------------
+# Full-text search (summaries + update messages)
+# ------------------------------------------------------------
+@app.route("/search")
+def search():
+    q = (request.args.get("q") or "").strip()
+    dept = (request.args.get("dept") or "").strip().lower()
+    status = (request.args.get("status") or "").strip().lower()
+    try:
+        page = max(1, int(request.args.get("page", 1)))
+    except ValueError:
+        page = 1
+    page_size = repo.page_size(request.args.get("limit"), search_index.SEARCH_PAGE_SIZE)
+
+    result = search_index.search(q, dept, status, page=page, page_size=page_size)
+
+    if request.args.get("format") == "json":
+        return jsonify({
+            "ok": True,
+            "total": result["total"],
+            "page": result["page"],
+            "page_size": result["page_size"],
+            "capped": result["capped"],
+            "backend": result["backend"],
+            "facets": result["facets"],
+            "results": [{
+                "id": r["project"].id,
+                "project_type": r["project"].project_type,
+                "owner_email": r["project"].owner_email,
+                "assigned_dept": r["project"].assigned_dept,
+                "status": r["project"].status,
+                "priority": r["project"].priority,
+                "created_at": str(r["project"].created_at),
+                "summary": r["project"].summary,
+                "score": r["score"],
+                "matches": r["matches"]
+            } for r in result["results"]]
+        })
+
+    return render_template(
+        "search.html",
+        q=q,
+        dept_filter=dept,
+        status_filter=status,
+        result=result,
+        has_next=page * page_size < result["total"]
     )
 
 
+# ------------------------------------------------------------
+# Read cache hit ratios / staleness
+# ------------------------------------------------------------
+@app.route("/stats/cache")
+def cache_stats():
+    return jsonify(cache.stats())
+
+
+@app.route("/stats/change_feed")
+def change_feed_stats():
+    return jsonify(change_feed.stats())
+
+
 # ------------------------------------------------------------
 # Send reply + auto-resolve
 # ------------------------------------------------------------
@@ -305,24 +433,147 @@ def send_reply():
     # send email safely (no line breaks allowed)
     subject = subject.replace("\n", "").replace("\r", "")
 
+    # queued, not sent: an outbox worker delivers it, then records the
+    # reply and applies the auto-resolve (NO extra system message)
     try:
-        send_email(to_address=owner_email, subject=subject, body=reply_message)
+        delivery_id = outbox.enqueue(
+            to_address=owner_email,
+            subject=subject,
+            body=reply_message,
+            message_id=task_message_id(project_id),
+            project_id=int(project_id),
+            resolve=is_resolved_message(reply_message) and current_status != "resolved"
+        )
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 500
 
-    insert_project_update(
-        project_id=int(project_id),
-        update_message=reply_message,
-        from_email=os.getenv("EMAIL_ADDRESS"),
-        update_type="reply"
-    )
+    return jsonify({"ok": True, "delivery_id": delivery_id, "status": "queued"})
+
+
+# ------------------------------------------------------------
+# Bulk reply / resolve
+# ------------------------------------------------------------
+# One project lookup, mails pipelined over the pooled SMTP sessions, then
+# one bulk insert of the updates and one set-based status change for the
+# projects whose mail went out.
+BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", 500))
 
-    # Auto status update (NO extra system message)
-    if is_resolved_message(reply_message) and current_status != "resolved":
-        update_task_status(int(project_id), "resolved")
 
-    return jsonify({"ok": True})
+def _bulk_items(payload):
+    """
+    Accepts {"items": [{"project_id", "message", "resolve"?}, ...]} or
+    {"project_ids": [...], "message": "...", "resolve"?: bool}.
+    resolve defaults to is_resolved_message(message).
+    """
+    if "items" in payload:
+        raw = payload.get("items") or []
+    else:
+        raw = [{"project_id": pid, "message": payload.get("message"), "resolve": payload.get("resolve")}
+               for pid in payload.get("project_ids") or []]
+    items = []
+    for it in raw:
+        message = (it.get("message") or "").strip()
+        try:
+            pid = int(it.get("project_id"))
+        except (TypeError, ValueError):
+            pid = None
+        resolve = it.get("resolve")
+        if resolve is None:
+            resolve = is_resolved_message(message)
+        items.append({"project_id": pid, "message": message, "resolve": bool(resolve)})
+    return items
+
+
+@app.route("/bulk_reply", methods=["POST"])
+def bulk_reply():
+    payload = request.get_json(silent=True) or {}
+    items = _bulk_items(payload)
+    if not items:
+        return jsonify({"ok": False, "error": "No items"}), 400
+    if len(items) > BULK_MAX_ITEMS:
+        return jsonify({"ok": False, "error": f"At most {BULK_MAX_ITEMS} items per request"}), 400
+
+    projects = repo.projects_by_ids([it["project_id"] for it in items if it["project_id"] is not None])
+
+    results, to_send = [], []
+    for it in items:
+        result = {"project_id": it["project_id"], "ok": False, "resolved": False}
+        results.append(result)
+        project = projects.get(it["project_id"])
+        if not it["message"]:
+            result["error"] = "Missing message"
+        elif project is None:
+            result["error"] = "Project not found"
+        else:
+            subject = f"Update on your request: {project.project_type} (Task {project.id})"
+            try:
+                msg = build_message(project.owner_email, subject, it["message"],
+                                    message_id=task_message_id(project.id))
+            except ValueError as e:
+                result["error"] = str(e)
+                continue
+            to_send.append((result, it, project, msg))
+
+    errors = get_mail_pool().send_many([msg for _, _, _, msg in to_send])
+
+    updates, resolve_ids, sent = [], [], []
+    for (result, it, project, msg), error in zip(to_send, errors):
+        if error is not None:
+            result["error"] = str(error)
+            continue
+        sent.append(result)
+        updates.append({
+            "project_id": project.id,
+            "update_message": it["message"],
+            "from_email": os.getenv("EMAIL_ADDRESS"),
+            "update_type": "reply",
+            "source_message_id": msg["Message-ID"],
+        })
+        if it["resolve"] and (project.status or "").lower() != "resolved":
+            resolve_ids.append(project.id)
+
+    update_ids = insert_project_updates_bulk(updates) if updates else []
+    resolved = set(update_tasks_status_bulk(resolve_ids, "resolved") or []) if resolve_ids else set()
+
+    for result in sent:
+        result["ok"] = True
+        result["sent"] = True
+        result["recorded"] = update_ids is not None
+        result["resolved"] = result["project_id"] in resolved
+
+    return jsonify({
+        "ok": all(r["ok"] for r in results),
+        "results": results,
+        "summary": {
+            "items": len(results),
+            "sent": len(sent),
+            "failed": len(results) - len(sent),
+            "resolved": len(resolved)
+        }
+    })
+
+
+@app.route("/delivery/<int:delivery_id>")
+def delivery_status(delivery_id):
+    status = outbox.delivery_status(delivery_id)
+    if status is None:
+        return jsonify({"ok": False, "error": "Delivery not found"}), 404
+    return jsonify(dict(status, ok=True))
+
+
+def start_background_workers():
+    """
+    Start the in-process outbox senders (OUTBOX_IN_APP=1). Call once per
+    serving process, e.g. from the WSGI entry point or a post-fork hook;
+    importing app alone starts nothing.
+    """
+    if os.getenv("OUTBOX_IN_APP", "1") == "1":
+        outbox.start_workers()
 
 
 if __name__ == "__main__":
+    # the debug reloader imports this file in a watcher and a serving child;
+    # only the child sends mail
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        start_background_workers()
     app.run(debug=True)
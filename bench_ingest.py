@@ -0,0 +1,747 @@
+# bench_ingest.py
+"""
+End-to-end replay benchmark for the ingest path (drain_mailbox: IMAP
+fetch -> parse -> thread index / rules / LLM -> DB write) with every
+external service replaced by a local stand-in:
+
+  - a synthetic corpus: new requests, status replies, large attachments,
+    HTML-only mail, non-English mail and duplicate deliveries
+  - a fake IMAP server on 127.0.0.1 (SEARCH, BODYSTRUCTURE, partial and
+    full UID FETCH), so structure and full fetch modes both run for real
+  - a stub LLM with configurable latency, jitter and error rate
+  - an in-memory store in place of SQL Server (db_writer + thread index)
+
+Reports emails/sec, p50/p99 per stage, peak RSS and the stored
+projects/updates as JSON, next to the outcome expected from the corpus
+kinds. With --baseline it becomes a regression gate: exit status 1 when
+throughput, a stage p99 or peak RSS is worse than the baseline by more
+than --tolerance, or when the projects/updates counts differ from the
+baseline or the expected outcome (a faster run that threads replies
+wrongly is not an improvement).
+
+    python bench_ingest.py --emails 2000 --llm-latency 0.2 --save-baseline bench_baseline.json
+    python bench_ingest.py --emails 2000 --llm-latency 0.2 --baseline bench_baseline.json
+    python bench_ingest.py --write-corpus corpus/        keep the generated .eml files
+    python bench_ingest.py --replay corpus/              replay .eml files instead
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import socket
+import imaplib
+import argparse
+import threading
+import contextlib
+import socketserver
+from email import policy
+from email.message import EmailMessage
+from email.parser import BytesParser
+from email.utils import make_msgid, formatdate
+
+DEFAULT_MIX = "new=45,reply=25,attachment=10,html=8,i18n=8,duplicate=4"
+
+USERS = [f"user{i:03d}@corp.example" for i in range(200)]
+REQUESTS = [
+    ("Laptop not booting", "Hardware", "My laptop shows a black screen after the BIOS logo since this morning."),
+    ("VPN access for new joiner", "IT", "Please enable VPN access for our new analyst starting Monday."),
+    ("Salary slip missing", "HR", "I cannot find my salary slip for last month on the portal."),
+    ("Invoice approval pending", "Finance", "Vendor invoice INV-{n} is waiting for approval for two weeks."),
+    ("Printer on floor 3 jammed", "Hardware", "The shared printer keeps jamming on every second page."),
+    ("Outlook keeps crashing", "IT", "Outlook closes itself whenever I open the shared calendar."),
+    ("Leave balance incorrect", "HR", "My leave balance shows 4 days less than it should."),
+    ("Reimbursement not received", "Finance", "Travel reimbursement for claim {n} has not been credited."),
+]
+FOLLOW_UPS = [
+    "Any update on this? It is blocking my work.",
+    "Just checking in - still waiting for a response.",
+    "Thanks, this is resolved now.",
+    "Issue fixed after the restart, you can close it.",
+    "Still not fixed, the problem came back today.",
+]
+I18N = [
+    ("लैपटॉप चालू नहीं हो रहा", "नमस्ते, मेरा लैपटॉप आज सुबह से चालू नहीं हो रहा है। कृपया मदद करें।"),
+    ("Gehaltsabrechnung fehlt", "Hallo, meine Gehaltsabrechnung für letzten Monat fehlt im Portal."),
+    ("VPNに接続できません", "おはようございます。昨日からVPNに接続できません。確認をお願いします。"),
+    ("Reembolso no recibido", "Hola, el reembolso de mi viaje todavía no ha sido acreditado."),
+]
+FILLER = ("Regards,\nThe operations team\n\nThis message and any attachments are confidential "
+          "and intended solely for the addressee. ") * 3
+
+
+# ------------------------------------------------------------
+# Corpus
+# ------------------------------------------------------------
+def parse_mix(spec):
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.partition("=")
+        weights[name.strip()] = float(weight or 0)
+    total = sum(weights.values()) or 1.0
+    return {k: v / total for k, v in weights.items()}
+
+
+def _base(rnd, sender, subject):
+    msg = EmailMessage()
+    msg["From"] = sender
+    msg["To"] = "support@corp.example"
+    msg["Subject"] = subject
+    msg["Date"] = formatdate(localtime=False)
+    msg["Message-ID"] = make_msgid(idstring=str(rnd.randrange(10 ** 9)), domain="bench.example")
+    return msg
+
+
+def _request(rnd, n):
+    subject, _, body = rnd.choice(REQUESTS)
+    return f"{subject} #{n}", body.format(n=n)
+
+
+def make_corpus(count, mix=DEFAULT_MIX, seed=7, attachment_kb=2048):
+    """
+    (RFC822 byte strings in delivery order, kind of each); replies follow
+    their originals.
+    """
+    rnd = random.Random(seed)
+    weights = parse_mix(mix)
+    kinds, cum = list(weights), []
+    acc = 0.0
+    for k in kinds:
+        acc += weights[k]
+        cum.append(acc)
+
+    corpus, delivered, originals = [], [], []   # originals: (message, raw) that can be replied to
+    for n in range(count):
+        r = rnd.random()
+        kind = next((k for k, c in zip(kinds, cum) if r <= c), kinds[-1])
+        if kind in ("reply", "duplicate") and not originals:
+            kind = "new"
+        sender = rnd.choice(USERS)
+
+        if kind == "reply":
+            orig, _ = rnd.choice(originals)
+            msg = _base(rnd, orig["From"], "Re: " + orig["Subject"])
+            msg["In-Reply-To"] = orig["Message-ID"]
+            msg["References"] = orig["Message-ID"]
+            quoted = "\n".join("> " + line for line in (orig.get_body(("plain", "html")).get_content()
+                                                        .splitlines()[:20]))
+            msg.set_content(f"{rnd.choice(FOLLOW_UPS)}\n\nOn Mon, {orig['From']} wrote:\n{quoted}\n")
+        elif kind == "duplicate":
+            # the same mail delivered again (CC'd to a second alias)
+            corpus.append(rnd.choice(originals)[1])
+            delivered.append(kind)
+            continue
+        elif kind == "html":
+            subject, body = _request(rnd, n)
+            msg = _base(rnd, sender, subject)
+            rows = "".join(f"<tr><td style='padding:4px'>Item {i}</td><td>{body}</td></tr>" for i in range(5))
+            msg.set_content(f"<html><head><style>td {{ color: #333; }}</style></head><body>"
+                            f"<p>Hi team,</p><p>{body}</p><table>{rows}</table>"
+                            f"<p>{FILLER}</p></body></html>", subtype="html")
+        elif kind == "i18n":
+            subject, body = rnd.choice(I18N)
+            msg = _base(rnd, sender, f"{subject} #{n}")
+            msg.set_content(f"{body}\n\n{FILLER}", cte=rnd.choice(["base64", "quoted-printable"]))
+        else:
+            subject, body = _request(rnd, n)
+            msg = _base(rnd, sender, subject)
+            msg.set_content(f"Hi team,\n\n{body}\n\n{FILLER}")
+            if kind == "attachment":
+                blob = rnd.randbytes(attachment_kb * 1024) if hasattr(rnd, "randbytes") else \
+                    os.urandom(attachment_kb * 1024)
+                msg.add_attachment(blob, maintype="application", subtype="pdf", filename=f"scan-{n}.pdf")
+
+        raw = msg.as_bytes(policy=policy.SMTP)
+        corpus.append(raw)
+        delivered.append(kind)
+        if kind != "reply":
+            originals.append((msg, raw))
+    return corpus, delivered
+
+
+def expected_outcome(kinds):
+    """
+    What a correct ingest stores for a generated corpus: one project per
+    request, one update per reply (threaded to its original), nothing for
+    a duplicate delivery.
+    """
+    by_kind = {}
+    for kind in kinds:
+        by_kind[kind] = by_kind.get(kind, 0) + 1
+    replies = by_kind.get("reply", 0)
+    duplicates = by_kind.get("duplicate", 0)
+    return {
+        "projects": len(kinds) - replies - duplicates,
+        "updates": replies,
+        "duplicates_skipped": duplicates,
+        "by_kind": by_kind,
+    }
+
+
+def write_corpus(corpus, directory):
+    os.makedirs(directory, exist_ok=True)
+    for i, raw in enumerate(corpus, 1):
+        with open(os.path.join(directory, f"{i:06d}.eml"), "wb") as f:
+            f.write(raw)
+
+
+def load_corpus(directory):
+    names = sorted(n for n in os.listdir(directory) if n.lower().endswith(".eml"))
+    corpus = []
+    for name in names:
+        with open(os.path.join(directory, name), "rb") as f:
+            corpus.append(f.read())
+    return corpus
+
+
+# ------------------------------------------------------------
+# Fake IMAP server (just enough IMAP4rev1 for imaplib and mime_reader)
+# ------------------------------------------------------------
+def _quote(value):
+    if value is None:
+        return b"NIL"
+    text = str(value).replace("\\", "\\\\").replace('"', '\\"')
+    return b'"' + text.encode("utf-8", "replace") + b'"'
+
+
+def _split(raw):
+    """(header block incl. blank line, body) of a message or part."""
+    for sep in (b"\r\n\r\n", b"\n\n"):
+        pos = raw.find(sep)
+        if pos != -1:
+            return raw[:pos + len(sep)], raw[pos + len(sep):]
+    return raw, b""
+
+
+def _params(part):
+    params = (part.get_params() or [])[1:]
+    if not params:
+        return b"NIL"
+    return b"(" + b" ".join(_quote(k) + b" " + _quote(v) for k, v in params) + b")"
+
+
+def _bodystructure(part):
+    if part.is_multipart():
+        children = b"".join(_bodystructure(p) for p in part.get_payload())
+        return b"(" + children + b" " + _quote(part.get_content_subtype()) + b" " + _params(part) + b" NIL NIL)"
+    body = _split(part.as_bytes())[1]
+    fields = [_quote(part.get_content_maintype()), _quote(part.get_content_subtype()), _params(part),
+              b"NIL", b"NIL", _quote((part.get("Content-Transfer-Encoding") or "7bit").lower()),
+              str(len(body)).encode()]
+    if part.get_content_maintype() == "text":
+        fields.append(str(body.count(b"\n")).encode())
+    disposition = part.get_content_disposition()
+    if disposition:
+        filename = part.get_param("filename", header="content-disposition")
+        disp = b"(" + _quote(disposition) + b" " + \
+            (b"(" + _quote("filename") + b" " + _quote(filename) + b")" if filename else b"NIL") + b")"
+    else:
+        disp = b"NIL"
+    fields += [b"NIL", disp, b"NIL"]
+    return b"(" + b" ".join(fields) + b")"
+
+
+class FakeMessage:
+    def __init__(self, raw):
+        self.raw = raw
+        self.msg = BytesParser(policy=policy.compat32).parsebytes(raw)
+        self.header = _split(raw)[0]
+        self.structure = _bodystructure(self.msg)
+
+    def section(self, spec):
+        if not spec:
+            return self.raw
+        part = self.msg
+        for index in spec.split("."):
+            if part.is_multipart():
+                part = part.get_payload()[int(index) - 1]
+        return _split(part.as_bytes())[1] if part is not self.msg else _split(self.raw)[1]
+
+
+_BODY_ITEM_RE = re.compile(r"BODY(?:\.PEEK)?\[([\d.]*|HEADER)\](?:<(\d+)\.(\d+)>)?", re.IGNORECASE)
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data if data.endswith(b"\r\n") else data + b"\r\n")
+
+    def handle(self):
+        messages = self.server.messages
+        # many small responses per command; don't let Nagle + delayed ACK stall them
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.send(b"* OK [CAPABILITY IMAP4rev1] bench IMAP ready")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            tag, _, rest = line.rstrip(b"\r\n").partition(b" ")
+            command, _, args = rest.partition(b" ")
+            command = command.upper()
+            if command == b"CAPABILITY":
+                self.send(b"* CAPABILITY IMAP4rev1")
+            elif command == b"SELECT":
+                self.send(b"* %d EXISTS" % len(messages))
+                self.send(b"* 0 RECENT")
+                self.send(b"* OK [UIDVALIDITY 1] UIDs valid")
+                self.send(b"* OK [UIDNEXT %d] next UID" % (len(messages) + 1))
+                self.send(tag + b" OK [READ-WRITE] SELECT completed")
+                continue
+            elif command == b"LOGOUT":
+                self.send(b"* BYE bench IMAP closing")
+                self.send(tag + b" OK LOGOUT completed")
+                return
+            elif command == b"UID":
+                sub, _, args = args.partition(b" ")
+                if sub.upper() == b"SEARCH":
+                    match = re.search(rb"UID (\d+):\*", args)
+                    start = int(match.group(1)) if match else 1
+                    uids = range(max(start, 1), len(messages) + 1) or [len(messages)]
+                    self.send(b"* SEARCH " + b" ".join(str(u).encode() for u in uids))
+                elif sub.upper() == b"FETCH":
+                    uid_set, _, items = args.partition(b" ")
+                    self._fetch(uid_set.decode(), items.decode())
+            self.send(tag + b" OK " + command + b" completed")
+
+    def _fetch(self, uid_set, items):
+        messages = self.server.messages
+        uids = []
+        for piece in uid_set.split(","):
+            lo, _, hi = piece.partition(":")
+            hi = len(messages) if hi == "*" else int(hi or lo)
+            uids.extend(range(int(lo), hi + 1))
+        for uid in uids:
+            if not 1 <= uid <= len(messages):
+                continue
+            msg = messages[uid - 1]
+            out = [b"* %d FETCH (UID %d" % (uid, uid)]
+            if "BODYSTRUCTURE" in items.upper():
+                out.append(b" BODYSTRUCTURE " + msg.structure)
+            literals = []
+            if re.search(r"\bRFC822\b", items, re.IGNORECASE):
+                literals.append((b"RFC822", msg.raw))
+            for match in _BODY_ITEM_RE.finditer(items):
+                section, origin, length = match.groups()
+                data = msg.header if section.upper() == "HEADER" else msg.section(section)
+                name = f"BODY[{section.upper()}]".encode()
+                if origin is not None:
+                    data = data[int(origin):int(origin) + int(length)]
+                    name += f"<{origin}>".encode()
+                literals.append((name, data))
+            payload = b"".join(out)
+            for name, data in literals:
+                payload += b" " + name + b" {%d}\r\n" % len(data) + data
+            self.wfile.write(payload + b")\r\n")
+            self.server.bytes_sent += len(payload)
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, corpus, host="127.0.0.1", port=0):
+        super().__init__((host, port), _IMAPHandler)
+        self.messages = [FakeMessage(raw) for raw in corpus]
+        self.bytes_sent = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, name="bench-imap", daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+# ------------------------------------------------------------
+# Stub LLM
+# ------------------------------------------------------------
+class StubResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+class StubLLM:
+    """ChatGroq.invoke stand-in: sleeps latency +- jitter, fails error_rate of calls."""
+
+    TASK = {"project_type": "Support request", "assigned_dept": "IT", "time_required": "2 days",
+            "priority": "MEDIUM", "status": "pending", "summary": "User reports a problem.\nNeeds follow-up."}
+
+    def __init__(self, stages, latency=0.2, jitter=0.5, error_rate=0.0, seed=11):
+        self.stages = stages
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self._rnd = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def _answer(self, subject):
+        match = re.search(r"(?:task|ticket)\s*[:#]?\s*(\d+)", subject or "", re.IGNORECASE)
+        if match:
+            return {"is_status_update": True, "task_id": int(match.group(1)), "new_status": None, "task": None}
+        return {"is_status_update": False, "task_id": None, "new_status": None, "task": dict(self.TASK)}
+
+    def invoke(self, prompt):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (1 + self._rnd.uniform(-self.jitter, self.jitter))
+            fail = self._rnd.random() < self.error_rate
+        start = time.perf_counter()
+        time.sleep(max(0.0, delay))
+        self.stages.add("llm", time.perf_counter() - start)
+        if fail:
+            with self._lock:
+                self.errors += 1
+            raise RuntimeError("stub LLM: simulated 503")
+
+        if "For EACH email below" in prompt:
+            subjects = re.findall(r"### Email (\d+)\nSubject: (.*)", prompt)
+            items = []
+            for index, subject in subjects:
+                answer = self._answer(subject)
+                if "decide whether it is a STATUS UPDATE" not in prompt:
+                    answer = dict(self.TASK)
+                items.append(dict(answer, index=int(index)))
+            return StubResponse(json.dumps(items))
+        subject = (re.search(r"Subject: (.*)", prompt) or [None, ""])[1]
+        answer = self._answer(subject)
+        if "Classify this email and extract" in prompt:
+            return StubResponse(json.dumps(answer))
+        if "STATUS UPDATE" in prompt:
+            return StubResponse(json.dumps({k: answer[k] for k in ("is_status_update", "task_id", "new_status")}))
+        return StubResponse(json.dumps(self.TASK))
+
+
+# ------------------------------------------------------------
+# In-memory DB stand-in
+# ------------------------------------------------------------
+class MemoryStore:
+    """The db_writer calls email_reader makes, plus the thread index, in memory."""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self._lock = threading.Lock()
+        self.projects = {}        # id -> dict
+        self.updates = {}         # id -> dict
+        self.by_message_id = {}   # source Message-ID -> ("project"/"update", id)
+        self.thread_keys = {}     # hex key -> (kind, project_id)
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _record_keys(self, project_id, keys):
+        for key, kind in keys:
+            if kind == "m" and key in self.thread_keys:
+                continue
+            self.thread_keys[key] = (kind, project_id)
+
+    def insert_project(self, data):
+        import thread_index
+        self._wait()
+        with self._lock:
+            mid = data.get("source_message_id")
+            if mid and mid in self.by_message_id:
+                return self.by_message_id[mid][1]
+            pid = len(self.projects) + 1
+            self.projects[pid] = dict(data, id=pid)
+            if mid:
+                self.by_message_id[mid] = ("project", pid)
+            self._record_keys(pid, thread_index.keys_for(mid, data.get("thread_subject"), data.get("owner_email")))
+            return pid
+
+    def insert_project_update(self, project_id, update_message, from_email, update_type="reply",
+                              source_message_id=None, thread_subject=None):
+        import thread_index
+        self._wait()
+        with self._lock:
+            if source_message_id and source_message_id in self.by_message_id:
+                return self.by_message_id[source_message_id][1]
+            uid = len(self.updates) + 1
+            self.updates[uid] = {"project_id": project_id, "update_message": update_message,
+                                 "from_email": from_email, "update_type": update_type}
+            if source_message_id:
+                self.by_message_id[source_message_id] = ("update", uid)
+            self._record_keys(project_id, thread_index.keys_for(source_message_id, thread_subject, from_email))
+            return uid
+
+    def update_task_status(self, task_id, new_status):
+        self._wait()
+        with self._lock:
+            if task_id in self.projects:
+                self.projects[task_id]["status"] = new_status
+        return True
+
+    def write_ingest_batch(self, updates, resolve_ids, projects):
+        for u in updates:
+            self.insert_project_update(u["project_id"], u.get("update_message", ""), u.get("from_email", ""),
+                                       u.get("update_type", "reply"), u.get("source_message_id"),
+                                       u.get("thread_subject"))
+        for task_id in resolve_ids:
+            self.update_task_status(task_id, "resolved")
+        return [self.insert_project(d) for d in projects]
+
+    def lookup_many(self, parsed_list):
+        """thread_index.lookup_many against the in-memory keys."""
+        import thread_index
+        self._wait()
+        best = [None] * len(parsed_list)
+        with self._lock:
+            for n, parsed in enumerate(parsed_list):
+                for rank, key, kind in thread_index._lookup_keys(parsed):
+                    hit = self.thread_keys.get(key)
+                    if hit is None:
+                        continue
+                    project = self.projects.get(hit[1]) or {}
+                    if kind == "s" and (project.get("status") or "").lower() == "resolved":
+                        continue
+                    if best[n] is None or rank < best[n][0]:
+                        best[n] = (rank, hit[1])
+        return best
+
+
+# ------------------------------------------------------------
+# Measurement
+# ------------------------------------------------------------
+class Stages:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.samples.setdefault(name, []).append(seconds)
+
+    def wrap(self, name, fn):
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.add(name, time.perf_counter() - start)
+        return timed
+
+    def summary(self):
+        out = {}
+        with self._lock:
+            samples = {k: sorted(v) for k, v in self.samples.items()}
+        for name, values in sorted(samples.items()):
+            out[name] = {
+                "count": len(values),
+                "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+                "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+            }
+        return out
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(q * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def peak_rss_mb():
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # KiB on Linux, bytes on macOS
+        return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+    except ImportError:
+        pass
+    try:
+        import psutil
+        info = psutil.Process().memory_info()
+        return round(getattr(info, "peak_wset", info.rss) / (1024 * 1024), 1)
+    except ImportError:
+        return None
+
+
+@contextlib.contextmanager
+def patched(replacements):
+    """Temporarily set module attributes: [(module, name, value), ...]."""
+    saved = [(module, name, getattr(module, name)) for module, name, _ in replacements]
+    for module, name, value in replacements:
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+
+
+# ------------------------------------------------------------
+# Run
+# ------------------------------------------------------------
+def run(corpus, args):
+    # imported here so the environment set in main() is seen at import time
+    import email_reader
+    import ingest_pipeline
+    import llm_groq_extractor
+    import thread_index
+
+    stages = Stages()
+    store = MemoryStore(args.db_latency)
+    stub = StubLLM(stages, args.llm_latency, args.llm_jitter, args.llm_error_rate)
+    replacements = [
+        (llm_groq_extractor, "llm", stub),
+        (email_reader, "insert_project", store.insert_project),
+        (email_reader, "insert_project_update", store.insert_project_update),
+        (email_reader, "update_task_status", store.update_task_status),
+        (email_reader, "write_ingest_batch", store.write_ingest_batch),
+        (thread_index, "lookup_many", stages.wrap("thread_lookup", store.lookup_many)),
+        (ingest_pipeline, "fetch_chunk", stages.wrap("imap_fetch", ingest_pipeline.fetch_chunk)),
+        (email_reader, "parse_email", stages.wrap("parse", email_reader.parse_email)),
+        (email_reader, "classify_email", stages.wrap("classify", email_reader.classify_email)),
+        (email_reader, "process_email_batch", stages.wrap("classify_batch", email_reader.process_email_batch)),
+        (email_reader, "write_email", stages.wrap("write", email_reader.write_email)),
+        (email_reader, "write_email_batch", stages.wrap("write_batch", email_reader.write_email_batch)),
+    ]
+
+    rss_before = peak_rss_mb()
+    checkpoints = []
+    with FakeIMAPServer(corpus) as server, patched(replacements):
+        mail = imaplib.IMAP4(*server.server_address)
+        mail.login("bench", "bench")
+        mail.select("INBOX")
+        log = sys.stdout if args.verbose else open(os.devnull, "w")
+        try:
+            with contextlib.redirect_stdout(log):
+                started = time.perf_counter()
+                summary = email_reader.drain_mailbox(mail, 0, checkpoints.append)
+                elapsed = time.perf_counter() - started
+        finally:
+            if log is not sys.stdout:
+                log.close()
+            mail.logout()
+        imap_bytes = server.bytes_sent
+
+    return {
+        "emails": len(corpus),
+        "seconds": round(elapsed, 3),
+        "emails_per_sec": round(len(corpus) / elapsed, 2) if elapsed else None,
+        "written": summary["written"],
+        "failed": summary["failed"],
+        "checkpoint": checkpoints[-1] if checkpoints else None,
+        "projects": len(store.projects),
+        "updates": len(store.updates),
+        "llm_calls": stub.calls,
+        "llm_errors": stub.errors,
+        "imap_mb": round(imap_bytes / (1024 * 1024), 2),
+        "stages": stages.summary(),
+        "rss_before_run_mb": rss_before,
+        "peak_rss_mb": peak_rss_mb(),
+        "config": {
+            "fetch_mode": args.fetch_mode, "workers": args.workers, "llm_batch_size": args.llm_batch_size,
+            "llm_latency": args.llm_latency, "llm_error_rate": args.llm_error_rate,
+            "db_latency": args.db_latency, "mix": args.mix,
+        },
+    }
+
+
+def compare(result, baseline, tolerance):
+    """
+    [(metric, baseline, current, ok)] - higher throughput / lower p99 and
+    RSS are better; projects/updates must match exactly.
+    """
+    rows = []
+
+    def check(name, base, current, higher_is_better):
+        if base is None or current is None:
+            return
+        if higher_is_better:
+            ok = current >= base * (1 - tolerance)
+        else:
+            # ignore sub-millisecond noise on fast stages
+            ok = current <= base * (1 + tolerance) or current - base < 1.0
+        rows.append((name, base, current, ok))
+
+    check("emails_per_sec", baseline.get("emails_per_sec"), result.get("emails_per_sec"), True)
+    for stage, stats in (baseline.get("stages") or {}).items():
+        current = (result.get("stages") or {}).get(stage)
+        if current:
+            check(f"{stage}.p99_ms", stats.get("p99_ms"), current.get("p99_ms"), False)
+    check("peak_rss_mb", baseline.get("peak_rss_mb"), result.get("peak_rss_mb"), False)
+
+    # which emails a failing stub LLM call hits depends on timing
+    if not (result.get("llm_errors") or baseline.get("llm_errors")):
+        expected = result.get("expected") or {}
+        for name in ("projects", "updates"):
+            if baseline.get(name) is not None:
+                rows.append((name, baseline[name], result.get(name), result.get(name) == baseline[name]))
+            if expected.get(name) is not None:
+                rows.append((f"{name}.expected", expected[name], result.get(name),
+                             result.get(name) == expected[name]))
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=1000)
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="kind=weight,... (new reply attachment html i18n duplicate)")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--attachment-kb", type=int, default=2048)
+    parser.add_argument("--replay", metavar="DIR", help="replay the .eml files in DIR instead of generating")
+    parser.add_argument("--write-corpus", metavar="DIR", help="also write the generated corpus to DIR")
+    parser.add_argument("--fetch-mode", choices=("structure", "full"), default="structure")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="seconds per stub LLM call")
+    parser.add_argument("--llm-jitter", type=float, default=0.5, help="+- share of the latency")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-batch-size", type=int, default=8, help="1 disables batched prompts")
+    parser.add_argument("--extraction-mode", choices=("combined", "sequential"), default="combined")
+    parser.add_argument("--db-latency", type=float, default=0.002, help="seconds per stand-in DB call")
+    parser.add_argument("--baseline", help="compare against this result file; exit 1 on regression")
+    parser.add_argument("--save-baseline", help="write this run's result to the file")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed relative regression")
+    parser.add_argument("--verbose", action="store_true", help="keep the pipeline's own output")
+    args = parser.parse_args()
+
+    # read by the repo modules at import time
+    os.environ.setdefault("GROQ_API_KEY", "bench-stub")
+    os.environ["IMAP_FETCH_MODE"] = args.fetch_mode
+    os.environ["INGEST_WORKERS"] = str(args.workers)
+    os.environ["LLM_BATCH_SIZE"] = str(args.llm_batch_size)
+    os.environ["LLM_EXTRACTION_MODE"] = args.extraction_mode
+    os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+    os.environ.setdefault("INGEST_LEDGER", "0")
+
+    if args.replay:
+        corpus, kinds = load_corpus(args.replay), None
+    else:
+        corpus, kinds = make_corpus(args.emails, args.mix, args.seed, args.attachment_kb)
+        if args.write_corpus:
+            write_corpus(corpus, args.write_corpus)
+
+    result = run(corpus, args)
+    # unknown for replayed mail
+    result["expected"] = expected_outcome(kinds) if kinds is not None else None
+    print(json.dumps(result, indent=2))
+    expected = result["expected"]
+    if expected is not None:
+        print(f"📋 Stored {result['projects']} projects, {result['updates']} updates; expected "
+              f"{expected['projects']} / {expected['updates']} ({expected['duplicates_skipped']} duplicates skipped)")
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"📝 Baseline written to {args.save_baseline}")
+
+    if args.baseline:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        rows = compare(result, baseline, args.tolerance)
+        failed = [r for r in rows if not r[3]]
+        for name, base, current, ok in rows:
+            print(f"{'✅' if ok else '❌'} {name:<28} baseline {base:>10}  now {current:>10}")
+        if failed:
+            print(f"❌ {len(failed)} metric(s) regressed by more than {args.tolerance:.0%} "
+                  f"or stored different projects/updates")
+            sys.exit(1)
+        print("✅ No regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
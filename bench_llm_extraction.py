@@ -0,0 +1,122 @@
+# bench_llm_extraction.py
+"""
+Compare the sequential (two llm.invoke calls) and combined (one call)
+extraction paths against a stubbed LLM with configurable latency.
+
+    python bench_llm_extraction.py --emails 200 --latency 0.25 --status-ratio 0.3
+"""
+import os
+import json
+import time
+import random
+import argparse
+
+# ChatGroq is constructed at import time; the stub replaces it before use
+os.environ.setdefault("GROQ_API_KEY", "bench-stub")
+# measure the LLM paths themselves, not the response cache or rule engine
+os.environ.setdefault("LLM_CACHE_ENABLED", "0")
+os.environ.setdefault("PRECLASSIFY_MIN_CONFIDENCE", "1.01")
+
+import llm_groq_extractor
+
+
+class StubResponse:
+    def __init__(self, content):
+        self.content = content
+
+
+class StubLLM:
+    """Mimics ChatGroq.invoke: sleeps `latency` (+ per-1k-char cost) then answers."""
+
+    def __init__(self, latency=0.25, per_kchar=0.0):
+        self.latency = latency
+        self.per_kchar = per_kchar
+        self.calls = 0
+        self.prompt_chars = 0
+
+    def invoke(self, prompt):
+        self.calls += 1
+        self.prompt_chars += len(prompt)
+        time.sleep(self.latency + self.per_kchar * len(prompt) / 1000.0)
+        is_status = "(Task " in prompt
+        task = {
+            "project_type": "Laptop request",
+            "assigned_dept": "Hardware",
+            "time_required": "2 days",
+            "priority": "HIGH",
+            "status": "pending",
+            "summary": "User needs a replacement laptop.\nCurrent one does not boot.",
+        }
+        if "Classify this email and extract" in prompt:
+            data = {
+                "is_status_update": is_status,
+                "task_id": 42 if is_status else None,
+                "new_status": "resolved" if is_status else None,
+                "task": None if is_status else task,
+            }
+        elif "Detect if this email is a STATUS UPDATE" in prompt:
+            data = {
+                "is_status_update": is_status,
+                "task_id": 42 if is_status else None,
+                "new_status": "resolved" if is_status else None,
+            }
+        else:
+            data = task
+        return StubResponse(json.dumps(data))
+
+
+def make_emails(n, status_ratio, seed=7):
+    rnd = random.Random(seed)
+    filler = "Please see the details below. " * 20
+    emails = []
+    for i in range(n):
+        if rnd.random() < status_ratio:
+            emails.append((f"Re: Update on your request: Laptop request (Task {i})",
+                           "Thanks, the issue is resolved now.\n\n> " + filler))
+        else:
+            emails.append((f"Need a new laptop #{i}",
+                           "Hi team, my laptop stopped booting this morning. " + filler))
+    return emails
+
+
+def run(mode, emails, latency, per_kchar):
+    stub = StubLLM(latency, per_kchar)
+    llm_groq_extractor.llm = stub
+    fn = (llm_groq_extractor.extract_email_info if mode == "combined"
+          else llm_groq_extractor.extract_email_info_sequential)
+    started = time.perf_counter()
+    for subject, body in emails:
+        fn(subject, body)
+    elapsed = time.perf_counter() - started
+    return {
+        "mode": mode,
+        "emails": len(emails),
+        "seconds": round(elapsed, 3),
+        "emails_per_sec": round(len(emails) / elapsed, 2) if elapsed else None,
+        "llm_calls": stub.calls,
+        "prompt_tokens_est": stub.prompt_chars // 4,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--emails", type=int, default=100)
+    parser.add_argument("--latency", type=float, default=0.25, help="seconds per LLM call")
+    parser.add_argument("--per-kchar", type=float, default=0.0, help="extra seconds per 1000 prompt chars")
+    parser.add_argument("--status-ratio", type=float, default=0.3)
+    args = parser.parse_args()
+
+    emails = make_emails(args.emails, args.status_ratio)
+    sequential = run("sequential", emails, args.latency, args.per_kchar)
+    combined = run("combined", emails, args.latency, args.per_kchar)
+
+    for r in (sequential, combined):
+        print(json.dumps(r))
+    if sequential["emails_per_sec"] and combined["emails_per_sec"]:
+        print(f"Speedup: {combined['emails_per_sec'] / sequential['emails_per_sec']:.2f}x, "
+              f"LLM calls saved: {sequential['llm_calls'] - combined['llm_calls']}, "
+              f"prompt tokens saved: {sequential['prompt_tokens_est'] - combined['prompt_tokens_est']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# bench_queries.py
+"""
+Compare the old LOWER(...) filters with the normalized-column filters from
+project_filters.py on a scratch copy of the projects table.
+
+    python bench_queries.py --rows 1000000 --repeat 20 [--keep]
+
+Seeds bench_projects (same columns, computed columns and indexes as
+migrations 0004 and 0010; owner_email holds a raw "Name <address>" From
+header like ingested mail does), then for each query shape reports p50/p95 latency, the
+plan operators touching the table and logical reads for both variants.
+The table is dropped afterwards unless --keep is given.
+"""
+import re
+import json
+import time
+import argparse
+import statistics
+
+from db_writer import get_connection
+from project_filters import project_filters, email_predicate
+
+TABLE = "bench_projects"
+SEED_CHUNK = 100000
+
+DDL = [
+    f"IF OBJECT_ID('{TABLE}', 'U') IS NOT NULL DROP TABLE {TABLE}",
+    f"""
+    CREATE TABLE {TABLE} (
+        id INT IDENTITY(1, 1) PRIMARY KEY,
+        project_type NVARCHAR(255), owner_email NVARCHAR(320), assigned_dept NVARCHAR(100),
+        time_required NVARCHAR(100), status NVARCHAR(50), priority NVARCHAR(50),
+        summary NVARCHAR(MAX), created_at DATETIME2 NOT NULL, owner_address NVARCHAR(320),
+        dept_norm AS CAST(LOWER(assigned_dept) AS NVARCHAR(100)) PERSISTED,
+        status_norm AS CAST(LOWER(status) AS NVARCHAR(50)) PERSISTED,
+        priority_norm AS CAST(LOWER(priority) AS NVARCHAR(50)) PERSISTED,
+        owner_email_norm AS CAST(LOWER(owner_address) AS NVARCHAR(320)) PERSISTED,
+        owner_email_rev AS CAST(REVERSE(LOWER(owner_address)) AS NVARCHAR(320)) PERSISTED
+    )
+    """,
+]
+
+INDEXES = [
+    f"CREATE INDEX ix_bench_created_id ON {TABLE}(created_at DESC, id DESC) INCLUDE (assigned_dept, status, priority, owner_email)",
+    f"CREATE INDEX ix_bench_dept_status_priority_created ON {TABLE}(dept_norm, status_norm, priority_norm, created_at DESC, id DESC)",
+    f"CREATE INDEX ix_bench_dept_created ON {TABLE}(dept_norm, created_at DESC, id DESC)",
+    f"CREATE INDEX ix_bench_owner_email_norm ON {TABLE}(owner_email_norm, created_at DESC, id DESC)",
+    f"CREATE INDEX ix_bench_owner_email_rev ON {TABLE}(owner_email_rev)",
+]
+
+SEED_SQL = f"""
+    WITH n AS (
+        SELECT TOP (?) ROW_NUMBER() OVER (ORDER BY (SELECT NULL)) + ? AS i
+        FROM sys.all_objects a CROSS JOIN sys.all_objects b CROSS JOIN sys.all_objects c
+    )
+    INSERT INTO {TABLE} (project_type, owner_email, owner_address, assigned_dept, time_required, status, priority,
+                         summary, created_at)
+    SELECT 'Bench request ' + CAST(i AS NVARCHAR(20)),
+           'User ' + CAST(i % 50000 AS NVARCHAR(20)) + ' <' + address + '>',
+           LOWER(address),
+           CHOOSE(i % 4 + 1, 'HR', 'Finance', 'IT', 'Hardware'),
+           '2 days',
+           CASE WHEN i % 3 = 0 THEN 'Resolved' ELSE 'pending' END,
+           CHOOSE(i % 3 + 1, 'HIGH', 'Medium', 'low'),
+           'Synthetic row for query benchmarks',
+           DATEADD(SECOND, -CAST(i AS INT), SYSUTCDATETIME())
+    FROM n
+    CROSS APPLY (SELECT 'User' + CAST(i % 50000 AS NVARCHAR(20)) + '@'
+                        + CHOOSE(i % 5 + 1, 'ICICI.com', 'example.com', 'corp.in', 'mail.net', 'bank.co.in')
+                 AS address) a
+"""
+
+SELECT = f"SELECT TOP (51) id, owner_email, assigned_dept, status, priority, created_at FROM {TABLE}"
+ORDER = "ORDER BY created_at DESC, id DESC"
+
+# (name, legacy WHERE + params, normalized WHERE + params)
+CASES = [
+    ("dept page",
+     ("LOWER(assigned_dept) = ?", ["it"]),
+     project_filters(dept="it")),
+    ("dept + status + priority",
+     ("LOWER(assigned_dept) = ? AND LOWER(status) = ? AND LOWER(priority) = ?", ["it", "pending", "high"]),
+     project_filters(dept="it", status="pending", priority="high")),
+    ("email exact",
+     ("LOWER(owner_email) LIKE ?", ["%user123@mail.net%"]),
+     email_predicate("user123@mail.net")),
+    ("email domain",
+     ("LOWER(owner_email) LIKE ?", ["%@corp.in%"]),
+     email_predicate("@corp.in")),
+    ("email prefix",
+     ("LOWER(owner_email) LIKE ?", ["%user4242%"]),
+     email_predicate("user4242")),
+]
+
+
+def seed(cur, conn, rows):
+    for sql in DDL:
+        cur.execute(sql)
+    conn.commit()
+    started = time.perf_counter()
+    for offset in range(0, rows, SEED_CHUNK):
+        cur.execute(SEED_SQL, (min(SEED_CHUNK, rows - offset), offset))
+        conn.commit()
+    for sql in INDEXES:
+        cur.execute(sql)
+    cur.execute(f"UPDATE STATISTICS {TABLE}")
+    conn.commit()
+    print(f"Seeded {rows} rows in {time.perf_counter() - started:.1f}s")
+
+
+def plan_summary(cur, sql, params):
+    """Run once with STATISTICS XML; return (operators on TABLE, logical reads)."""
+    cur.execute("SET STATISTICS XML ON")
+    try:
+        cur.execute(sql, params)
+        cur.fetchall()
+        plan = ""
+        while cur.nextset():
+            row = cur.fetchone()
+            if row and isinstance(row[0], str) and "ShowPlanXML" in row[0]:
+                plan = row[0]
+    finally:
+        cur.execute("SET STATISTICS XML OFF")
+
+    # each operator's own <Object> comes before its first child <RelOp>
+    ops = set()
+    for segment in plan.split("<RelOp ")[1:]:
+        op = re.search(r'PhysicalOp="([^"]+)"', segment)
+        if op and f'Table="[{TABLE}]"' in segment:
+            ops.add(op.group(1))
+    reads = sum(int(r) for r in re.findall(r'ActualLogicalReads="(\d+)"', plan))
+    return sorted(ops), reads
+
+
+def time_query(cur, sql, params, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cur.execute(sql, params)
+        cur.fetchall()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "p50_ms": round(statistics.median(samples), 2),
+        "p95_ms": round(samples[min(len(samples) - 1, int(len(samples) * 0.95))], 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=1000000)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--keep", action="store_true", help="keep bench_projects afterwards")
+    parser.add_argument("--no-seed", action="store_true", help="reuse an existing bench_projects")
+    args = parser.parse_args()
+
+    conn = get_connection()
+    cur = conn.cursor()
+    try:
+        if not args.no_seed:
+            seed(cur, conn, args.rows)
+
+        for name, (old_where, old_params), (new_where, new_params) in CASES:
+            for variant, where, params in (("legacy", old_where, old_params), ("normalized", new_where, new_params)):
+                sql = f"{SELECT} WHERE {where} {ORDER}"
+                ops, reads = plan_summary(cur, sql, params)
+                result = {"query": name, "variant": variant, "operators": ops, "logical_reads": reads}
+                result.update(time_query(cur, sql, params, args.repeat))
+                print(json.dumps(result))
+    finally:
+        if not args.keep:
+            cur.execute(f"IF OBJECT_ID('{TABLE}', 'U') IS NOT NULL DROP TABLE {TABLE}")
+            conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
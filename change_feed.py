@@ -0,0 +1,370 @@
+# change_feed.py
+"""
+Per-department change feed for the live department board.
+
+projects and project_updates carry a rowversion column (migration
+0006_change_feed). A watermark is the smallest rowversion not seen yet;
+each poll reads rows in [watermark, MIN_ACTIVE_ROWVERSION()), so a row
+from a transaction that is still open is never skipped: it stays above
+the upper bound until it commits.
+
+One DepartmentFeed thread polls per department while at least one
+client listens, and copies each delta (new or changed projects, new
+updates) to every subscriber's queue. Watermarks go to the browser as
+hex in the SSE event id, so a reconnecting client resumes where it left
+off.
+"""
+import os
+import json
+import time
+import queue
+import threading
+
+from db_writer import get_connection
+from project_filters import normalize
+
+CHANGE_FEED_INTERVAL = float(os.getenv("CHANGE_FEED_INTERVAL", 2))
+# a feed with no subscribers stops after this long
+CHANGE_FEED_IDLE = float(os.getenv("CHANGE_FEED_IDLE", 30))
+# events buffered per client; a client that falls further behind is reset
+CHANGE_FEED_QUEUE = int(os.getenv("CHANGE_FEED_QUEUE", 100))
+# rows a reconnecting client may replay before it is told to reload
+CHANGE_FEED_CATCHUP_MAX = int(os.getenv("CHANGE_FEED_CATCHUP_MAX", 500))
+
+MARK_SQL = "SELECT MIN_ACTIVE_ROWVERSION()"
+
+CHANGES_SQL = """
+SET NOCOUNT ON;
+DECLARE @since BINARY(8) = ?;
+DECLARE @until BINARY(8) = COALESCE(?, MIN_ACTIVE_ROWVERSION());
+
+SELECT @until;
+
+SELECT TOP (?) id, project_type, owner_email, assigned_dept, time_required,
+       status, priority, created_at, summary
+FROM projects
+WHERE dept_norm = ? AND row_version >= @since AND row_version < @until
+ORDER BY row_version;
+
+SELECT TOP (?) u.id, u.project_id, u.update_message, u.from_email, u.update_type, u.created_at
+FROM project_updates u
+JOIN projects p ON p.id = u.project_id
+WHERE u.row_version >= @since AND u.row_version < @until AND p.dept_norm = ?
+ORDER BY u.row_version;
+"""
+
+
+def _text(value):
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+
+def encode_mark(mark):
+    return bytes(mark).hex() if mark else None
+
+
+def decode_mark(value):
+    """Hex watermark from the client -> 8 bytes, or None if absent/invalid."""
+    try:
+        mark = bytes.fromhex(value or "")
+    except ValueError:
+        return None
+    return mark if len(mark) == 8 else None
+
+
+def current_mark(cur=None):
+    """Watermark for 'now' (read it *before* rendering a page)."""
+    conn = None
+    if cur is None:
+        conn = get_connection()
+        cur = conn.cursor()
+    try:
+        cur.execute(MARK_SQL)
+        return bytes(cur.fetchone()[0])
+    finally:
+        if conn is not None:
+            conn.close()
+
+
+def fetch_changes(dept, since, until=None, limit=CHANGE_FEED_CATCHUP_MAX, cur=None):
+    """
+    Changes in [since, until) for one department (until defaults to the
+    current safe mark). Returns (until, projects, updates, truncated).
+    """
+    conn = None
+    if cur is None:
+        conn = get_connection()
+        cur = conn.cursor()
+    dept = normalize(dept)
+    try:
+        cur.execute(CHANGES_SQL, (since, until, limit + 1, dept, limit + 1, dept))
+        until = bytes(cur.fetchone()[0])
+        cur.nextset()
+        project_rows = cur.fetchall()
+        cur.nextset()
+        update_rows = cur.fetchall()
+        while cur.nextset():
+            pass
+    finally:
+        if conn is not None:
+            conn.close()
+
+    truncated = len(project_rows) > limit or len(update_rows) > limit
+    projects = [{
+        "id": r[0], "project_type": r[1], "owner_email": r[2], "assigned_dept": r[3],
+        "time_required": r[4], "status": r[5], "priority": r[6],
+        "created_at": _text(r[7]), "summary": r[8],
+    } for r in project_rows[:limit]]
+    updates = [{
+        "id": r[0], "project_id": r[1], "message": r[2], "from_email": r[3],
+        "update_type": r[4], "created_at": _text(r[5]),
+    } for r in update_rows[:limit]]
+    return until, projects, updates, truncated
+
+
+# ------------------------------------------------------------
+# Events
+# ------------------------------------------------------------
+def changes_event(mark, projects, updates):
+    return {"type": "changes", "mark": encode_mark(mark), "projects": projects, "updates": updates}
+
+
+def reset_event(mark=None):
+    """Tell the client it missed changes and should reload the page."""
+    return {"type": "reset", "mark": encode_mark(mark)}
+
+
+def sse(event):
+    """One server-sent event; the watermark doubles as the event id."""
+    lines = [f"event: {event['type']}"]
+    if event.get("mark"):
+        lines.append(f"id: {event['mark']}")
+    lines.append("data: " + json.dumps(event, ensure_ascii=False, default=str))
+    return "\n".join(lines) + "\n\n"
+
+
+# ------------------------------------------------------------
+# Fan-out
+# ------------------------------------------------------------
+class Subscription:
+    def __init__(self, feed):
+        self.feed = feed
+        self.queue = queue.Queue(maxsize=CHANGE_FEED_QUEUE)
+        # live events parked while the client's catch-up replay is fetched
+        self._held = None
+        self._hold_lock = threading.Lock()
+
+    def hold(self):
+        """Park live events until release() so the catch-up goes out first."""
+        with self._hold_lock:
+            self._held = []
+
+    def release(self, first=None):
+        """Deliver `first` (the catch-up), then the live events parked meanwhile."""
+        with self._hold_lock:
+            held, self._held = self._held or [], None
+            for event in ([first] if first is not None else []) + held:
+                self._deliver(event)
+
+    def put(self, event):
+        with self._hold_lock:
+            if self._held is not None:
+                self._held.append(event)
+                return
+            self._deliver(event)
+
+    def _deliver(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # too slow: drop the backlog and make the client reload
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self.queue.put_nowait(reset_event())
+            except queue.Full:
+                pass
+
+    def get(self, timeout):
+        """Next event, or None after timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.feed.unsubscribe(self)
+
+
+class DepartmentFeed(threading.Thread):
+    """Polls one department and fans each delta out to its subscribers."""
+
+    def __init__(self, dept, interval=CHANGE_FEED_INTERVAL, idle_timeout=CHANGE_FEED_IDLE):
+        super().__init__(name=f"change-feed-{dept}", daemon=True)
+        self.dept = dept
+        self.interval = interval
+        self.idle_timeout = idle_timeout
+        self.mark = None
+        # oldest watermark of clients that joined before the first poll
+        self.start_mark = None
+        self.subscribers = set()
+        self.idle_since = time.monotonic()
+        self.stopped = False
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self.stats = {"polls": 0, "events": 0, "resets": 0, "errors": 0}
+
+    def attach(self, since=None):
+        """
+        Register a listener. Returns (subscription, replay_until): when the
+        feed is already past `since`, the caller replays [since, replay_until)
+        itself and then calls sub.release(); otherwise the feed starts from
+        `since` and replay_until is None.
+        """
+        sub = Subscription(self)
+        with self._lock:
+            self.subscribers.add(sub)
+            self.idle_since = None
+            if self.mark is None:
+                if since is not None and (self.start_mark is None or since < self.start_mark):
+                    self.start_mark = since
+                return sub, None
+            if since is not None and since < self.mark:
+                # held until the caller has queued the replay of [since, mark)
+                sub.hold()
+                return sub, self.mark
+            return sub, None
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self.subscribers.discard(sub)
+            if not self.subscribers:
+                self.idle_since = time.monotonic()
+
+    def poll(self):
+        with self._lock:
+            since = self.mark if self.mark is not None else self.start_mark
+        if since is None:
+            # nobody holds an older watermark: start from now
+            mark, projects, updates, truncated = current_mark(), [], [], False
+        else:
+            mark, projects, updates, truncated = fetch_changes(self.dept, since)
+        self._count("polls")
+        if truncated:
+            # more than one batch changed at once; clients reload instead
+            event = reset_event(mark)
+            self._count("resets")
+        elif projects or updates:
+            event = changes_event(mark, projects, updates)
+        else:
+            event = None
+        with self._lock:
+            if self.mark is None and self.start_mark is not None and (since is None or self.start_mark < since):
+                # a client with an older watermark joined during the first poll
+                mark = self.start_mark
+            self.mark = mark
+            subscribers = list(self.subscribers)
+        if event is not None:
+            self._count("events")
+            for sub in subscribers:
+                sub.put(event)
+
+    def _count(self, field):
+        with self._lock:
+            self.stats[field] += 1
+
+    def snapshot(self):
+        """Counters, subscriber count and watermark, read under the lock."""
+        with self._lock:
+            return dict(self.stats, subscribers=len(self.subscribers), mark=encode_mark(self.mark))
+
+    def idle_expired(self):
+        with self._lock:
+            return (not self.subscribers and self.idle_since is not None
+                    and time.monotonic() - self.idle_since >= self.idle_timeout)
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self._count("errors")
+                print(f"❌ Change feed poll failed ({self.dept}):", e)
+            if _retire_if_idle(self):
+                return
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+
+_feeds = {}
+_feeds_lock = threading.Lock()
+
+
+def _retire_if_idle(feed):
+    """Drop an idle feed from the registry; True if it should exit."""
+    with _feeds_lock:
+        if feed._stop_event.is_set() or feed.idle_expired():
+            if _feeds.get(feed.dept) is feed:
+                del _feeds[feed.dept]
+            feed.stopped = True
+            return True
+    return False
+
+
+def subscribe(dept, since=None):
+    """
+    Subscription to a department's changes, starting after watermark
+    `since` (bytes) if given. The department's feed is started on first
+    use. close() the subscription when the client goes away.
+    """
+    key = normalize(dept)
+    with _feeds_lock:
+        feed = _feeds.get(key)
+        if feed is None or feed.stopped:
+            feed = _feeds[key] = DepartmentFeed(key)
+            feed.start()
+        # attach under the registry lock so the feed cannot retire in between
+        sub, replay_until = feed.attach(since)
+
+    if replay_until is not None:
+        # the feed is already past this client's watermark; fill the gap
+        # live events published meanwhile wait in the subscription, so the
+        # client never applies an older row version over a newer one
+        try:
+            mark, projects, updates, truncated = fetch_changes(key, since, replay_until)
+            if truncated:
+                sub.release(reset_event(mark))
+            elif projects or updates:
+                sub.release(changes_event(mark, projects, updates))
+            else:
+                sub.release()
+        except Exception as e:
+            print(f"❌ Change feed catch-up failed ({key}):", e)
+            sub.release(reset_event())
+    return sub
+
+
+def known_mark(dept):
+    """Watermark of a running feed (no query), else the database's current one."""
+    with _feeds_lock:
+        feed = _feeds.get(normalize(dept))
+    if feed is not None and feed.mark is not None:
+        return feed.mark
+    return current_mark()
+
+
+def stats():
+    with _feeds_lock:
+        feeds = list(_feeds.values())
+    return {f.dept: f.snapshot() for f in feeds}
+
+
+def stop_all():
+    with _feeds_lock:
+        feeds = list(_feeds.values())
+    for feed in feeds:
+        feed.stop()
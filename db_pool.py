@@ -0,0 +1,232 @@
+# db_pool.py
+import threading
+import time
+from collections import deque
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    """
+    Proxy around a raw DBAPI connection borrowed from a ConnectionPool.
+    Everything (cursor, commit, rollback, ...) is forwarded to the real
+    connection; close() hands it back to the pool instead of disconnecting.
+    """
+
+    def __init__(self, pool, raw, created_at):
+        self._pool = pool
+        self._raw = raw
+        self._created_at = created_at
+        self._released = False
+
+    def __getattr__(self, name):
+        raw = self.__dict__.get("_raw")
+        if raw is None:
+            raise AttributeError(name)
+        return getattr(raw, name)
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self._pool._release(self._raw, self._created_at)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # same semantics as pyodbc's context manager (commit on success,
+        # rollback on error) but the connection always goes back to the pool
+        try:
+            if exc_type is None:
+                self._raw.commit()
+            else:
+                self._raw.rollback()
+        finally:
+            self.close()
+        return False
+
+    def __del__(self):
+        # safety net for code paths that forget close() (e.g. an exception
+        # inside a route) so the pool slot is not leaked forever
+        try:
+            if not self._released:
+                self.close()
+        except Exception:
+            pass
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of DBAPI connections.
+
+    - connect: zero-arg callable returning a new raw connection
+      (pyodbc.connect, sqlite3.connect, a fake DBAPI, ...)
+    - max_size: hard cap on open connections (idle + borrowed)
+    - max_lifetime: seconds after which a connection is closed and replaced
+    - health_check_after: idle seconds after which a borrowed connection is
+      validated with health_query before it is handed out
+    - borrow_timeout: seconds acquire() waits for a free slot
+    """
+
+    def __init__(self, connect, max_size=10, max_lifetime=1800,
+                 health_check_after=30, borrow_timeout=10, health_query="SELECT 1"):
+        if max_size < 1:
+            raise ValueError("max_size must be >= 1")
+        self._connect = connect
+        self.max_size = max_size
+        self.max_lifetime = max_lifetime
+        self.health_check_after = health_check_after
+        self.borrow_timeout = borrow_timeout
+        self.health_query = health_query
+
+        self._cond = threading.Condition()
+        self._idle = deque()  # (raw, created_at, last_used)
+        self._size = 0
+        self._closed = False
+        self._stats = {
+            "acquired": 0,
+            "released": 0,
+            "created": 0,
+            "reused": 0,
+            "recycled": 0,
+            "health_failures": 0,
+            "connect_errors": 0,
+            "timeouts": 0,
+            "waits": 0,
+            "wait_time_total": 0.0,
+            "wait_time_max": 0.0,
+        }
+
+    # ------------------------------
+    # Borrow / return
+    # ------------------------------
+    def acquire(self, timeout=None):
+        timeout = self.borrow_timeout if timeout is None else timeout
+        started = time.monotonic()
+        deadline = started + timeout
+        waited = False
+
+        while True:
+            entry = None
+            with self._cond:
+                if self._closed:
+                    raise RuntimeError("Connection pool is closed")
+                while not self._idle and self._size >= self.max_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats["timeouts"] += 1
+                        raise PoolTimeout(
+                            f"No database connection available within {timeout}s "
+                            f"(pool size {self.max_size})"
+                        )
+                    if not waited:
+                        waited = True
+                        self._stats["waits"] += 1
+                    self._cond.wait(remaining)
+                if self._idle:
+                    entry = self._idle.pop()  # LIFO: keep the hottest connections busy
+                else:
+                    self._size += 1  # reserve the slot, connect outside the lock
+
+            if entry is None:
+                try:
+                    raw = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._stats["connect_errors"] += 1
+                        self._cond.notify()
+                    raise
+                with self._cond:
+                    self._stats["created"] += 1
+                return self._checkout(raw, time.monotonic(), started)
+
+            raw, created_at, last_used = entry
+            now = time.monotonic()
+            if self._expired(created_at, now):
+                self._discard(raw, "recycled")
+                continue
+            if now - last_used >= self.health_check_after and not self._is_healthy(raw):
+                self._discard(raw, "health_failures")
+                continue
+            with self._cond:
+                self._stats["reused"] += 1
+            return self._checkout(raw, created_at, started)
+
+    def _checkout(self, raw, created_at, started):
+        wait = time.monotonic() - started
+        with self._cond:
+            self._stats["acquired"] += 1
+            self._stats["wait_time_total"] += wait
+            if wait > self._stats["wait_time_max"]:
+                self._stats["wait_time_max"] = wait
+        return PooledConnection(self, raw, created_at)
+
+    def _release(self, raw, created_at):
+        # never hand out a connection with a half-finished transaction
+        try:
+            raw.rollback()
+        except Exception:
+            self._discard(raw, "health_failures")
+            return
+
+        with self._cond:
+            self._stats["released"] += 1
+            keep = not self._closed and not self._expired(created_at, time.monotonic())
+            if keep:
+                self._idle.append((raw, created_at, time.monotonic()))
+                self._cond.notify()
+                return
+        self._discard(raw, "recycled")
+
+    def _discard(self, raw, reason):
+        try:
+            raw.close()
+        except Exception:
+            pass
+        with self._cond:
+            self._size -= 1
+            self._stats[reason] += 1
+            self._cond.notify()
+
+    # ------------------------------
+    # Health / lifetime
+    # ------------------------------
+    def _expired(self, created_at, now):
+        return bool(self.max_lifetime) and now - created_at >= self.max_lifetime
+
+    def _is_healthy(self, raw):
+        try:
+            cur = raw.cursor()
+            cur.execute(self.health_query)
+            cur.fetchall()
+            cur.close()
+            return True
+        except Exception:
+            return False
+
+    # ------------------------------
+    # Introspection / shutdown
+    # ------------------------------
+    def stats(self):
+        with self._cond:
+            data = dict(self._stats)
+            data["size"] = self._size
+            data["idle"] = len(self._idle)
+            data["in_use"] = self._size - len(self._idle)
+            data["max_size"] = self.max_size
+        return data
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for raw, _, _ in idle:
+            self._discard(raw, "recycled")
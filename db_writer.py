@@ -1,26 +1,144 @@
 # db_writer.py
+import os
+import json
+import threading
 import pyodbc
 from datetime import datetime
+from db_pool import ConnectionPool
+import dept_counters
+import read_cache
+import search_index
+import thread_index
+import metrics
+from project_filters import email_address
+
+CONNECTION_STRING = (
+    "DRIVER={ODBC Driver 17 for SQL Server};"
+    "SERVER=localhost;DATABASE=ApplessDB;Trusted_Connection=yes;"
+)
+
+# ------------------------------------------------------------
+# Connection pool (shared by the Flask routes and the ingest loop)
+# ------------------------------------------------------------
+_pool = None
+_pool_lock = threading.Lock()
+
+def _connect():
+    return pyodbc.connect(CONNECTION_STRING)
+
+def _pool_settings():
+    return {
+        "max_size": int(os.getenv("DB_POOL_SIZE", 10)),
+        "max_lifetime": float(os.getenv("DB_POOL_MAX_LIFETIME", 1800)),
+        "health_check_after": float(os.getenv("DB_POOL_HEALTH_CHECK_AFTER", 30)),
+        "borrow_timeout": float(os.getenv("DB_POOL_TIMEOUT", 10)),
+    }
+
+def configure_pool(connect=None, **options):
+    """
+    (Re)build the shared pool. `connect` defaults to pyodbc; pass e.g.
+    lambda: sqlite3.connect(":memory:", check_same_thread=False) to run
+    against a local stand-in. Options override the DB_POOL_* settings.
+    """
+    global _pool
+    settings = _pool_settings()
+    settings.update(options)
+    with _pool_lock:
+        old = _pool
+        _pool = ConnectionPool(connect or _connect, **settings)
+    if old is not None:
+        old.close()
+    return _pool
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(_connect, **_pool_settings())
+    return _pool
 
 def get_connection():
-    return pyodbc.connect(
-        "DRIVER={ODBC Driver 17 for SQL Server};"
-        "SERVER=localhost;DATABASE=ApplessDB;Trusted_Connection=yes;"
-    )
+    """Borrow a pooled connection; conn.close() returns it to the pool."""
+    return get_pool().acquire()
+
+def pool_stats():
+    return get_pool().stats()
 
+@metrics.timed("db_seconds", function="update_task_status")
 def update_task_status(task_id, new_status):
+    """Set one task's status. Returns True, or None on error."""
     try:
         conn = get_connection()
         cur = conn.cursor()
         cur.execute("""
             UPDATE projects
             SET status = ?
+            OUTPUT DELETED.assigned_dept, DELETED.status, DELETED.priority
             WHERE id = ?
         """, (new_status, task_id))
+        old = cur.fetchone()
+        if old is not None:
+            dept_counters.move(cur, old[0], old[1], new_status, old[2])
         conn.commit()
+        if old is not None:
+            read_cache.invalidate_departments(old[0])
+            search_index.index_status([task_id], new_status)
         print(f"✅ Task {task_id} updated to {new_status}")
+        return True
     except Exception as e:
         print("❌ DB Update Error:", e)
+        metrics.inc("db_errors_total", function="update_task_status")
+        return None
+    finally:
+        try:
+            conn.close()
+        except:
+            pass
+
+def _set_status_bulk(cur, task_ids, new_status):
+    """UPDATE + counter moves on an open cursor; returns the changed (id, dept) rows."""
+    cur.execute("""
+        UPDATE p
+        SET status = ?
+        OUTPUT DELETED.id, DELETED.assigned_dept, DELETED.status, DELETED.priority
+        FROM projects p
+        JOIN OPENJSON(?) WITH (id INT '$') j ON j.id = p.id
+        WHERE COALESCE(p.status_norm, '') <> LOWER(?)
+    """, (new_status, json.dumps([int(i) for i in task_ids]), new_status))
+    changed = cur.fetchall()
+    # one counter adjustment per (dept, old status, priority) bucket
+    moves = {}
+    for _, dept, old_status, priority in changed:
+        key = (dept, old_status, priority)
+        moves[key] = moves.get(key, 0) + 1
+    for (dept, old_status, priority), n in moves.items():
+        dept_counters.bump(cur, dept, old_status, priority, -n)
+        dept_counters.bump(cur, dept, new_status, priority, n)
+    return [(r[0], r[1]) for r in changed]
+
+@metrics.timed("db_seconds", function="update_tasks_status_bulk")
+def update_tasks_status_bulk(task_ids, new_status):
+    """
+    Set new_status on every id in task_ids with one UPDATE (ids travel as a
+    single JSON parameter). Rows already in that status are left alone.
+    Returns the ids that changed, or None on error.
+    """
+    if not task_ids:
+        return []
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        changed = _set_status_bulk(cur, task_ids, new_status)
+        conn.commit()
+        read_cache.invalidate_departments(*{r[1] for r in changed})
+        search_index.index_status([r[0] for r in changed], new_status)
+        print(f"✅ {len(changed)} tasks updated to {new_status}")
+        return [r[0] for r in changed]
+    except Exception as e:
+        print("❌ DB Update Error (bulk):", e)
+        metrics.inc("db_errors_total", function="update_tasks_status_bulk")
+        return None
     finally:
         try:
             conn.close()
@@ -38,50 +156,375 @@ def ensure_department_exists(name):
         return "IT"
     return mapping.get(name.lower(), "IT")
 
+def _project_row(data):
+    return (
+        data.get("project_type", "Unknown"),
+        data.get("owner_email", ""),
+        ensure_department_exists(data.get("assigned_dept")),
+        data.get("time_required", "Not specified"),
+        data.get("status", "pending"),
+        data.get("priority", "MEDIUM"),
+        data.get("summary", "No summary provided")
+    )
+
+def _search_row(project_id, row):
+    # (id, project_type, summary, dept, status) from a _project_row tuple
+    return (project_id, row[0], row[6], row[2], row[4])
+
+def _counter_key(data):
+    row = _project_row(data)
+    return row[2], row[4], row[5]  # dept, status, priority
+
+@metrics.timed("db_seconds", function="insert_project")
 def insert_project(data):
+    """
+    Insert one project and return its id (None on error). When
+    data["source_message_id"] is set, a second insert for the same
+    Message-ID is skipped and the existing id is returned.
+    data["thread_subject"] (the raw email subject) feeds the thread index.
+    """
     try:
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO projects (project_type, owner_email, assigned_dept, time_required, status, priority, summary)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (
-            data.get("project_type", "Unknown"),
-            data.get("owner_email", ""),
-            ensure_department_exists(data.get("assigned_dept")),
-            data.get("time_required", "Not specified"),
-            data.get("status", "pending"),
-            data.get("priority", "MEDIUM"),
-            data.get("summary", "No summary provided")
-        ))
+        mid = data.get("source_message_id") or None
+        if mid is None:
+            cur.execute("""
+                INSERT INTO projects (project_type, owner_email, assigned_dept, time_required, status, priority, summary, owner_address)
+                OUTPUT INSERTED.id
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, _project_row(data) + (email_address(data.get("owner_email")),))
+            row = cur.fetchone()
+            dept_counters.bump(cur, *_counter_key(data))
+        else:
+            cur.execute("""
+                INSERT INTO projects (project_type, owner_email, assigned_dept, time_required, status, priority, summary, owner_address, source_message_id)
+                OUTPUT INSERTED.id
+                SELECT ?, ?, ?, ?, ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM projects WITH (UPDLOCK, HOLDLOCK) WHERE source_message_id = ?
+                )
+            """, _project_row(data) + (email_address(data.get("owner_email")), mid, mid))
+            row = cur.fetchone()
+            if row is None:
+                cur.execute("SELECT id FROM projects WHERE source_message_id = ?", (mid,))
+                existing = cur.fetchone()
+                conn.commit()
+                print(f"↩ Project for {mid} already exists (id {existing[0]})")
+                return existing[0]
+            dept_counters.bump(cur, *_counter_key(data))
+        thread_index.record(cur, [(row[0], thread_index.keys_for(mid, data.get("thread_subject"), data.get("owner_email")))])
         conn.commit()
+        read_cache.invalidate_departments(_counter_key(data)[0])
+        search_index.index_projects([_search_row(row[0], _project_row(data))])
         print(f"🟩 Inserted new project: {data.get('project_type')}")
+        return row[0]
     except Exception as e:
         print("❌ DB Error insert:", e)
+        metrics.inc("db_errors_total", function="insert_project")
+        return None
     finally:
         try:
             conn.close()
         except:
             pass
 
-def insert_project_update(project_id, update_message, from_email, update_type="reply"):
+@metrics.timed("db_seconds", function="insert_project_update")
+def insert_project_update(project_id, update_message, from_email, update_type="reply", source_message_id=None,
+                          thread_subject=None):
     """
     Store an update for a project (admin reply or sender status message).
     update_type can be "reply" (admin) or "sender" (incoming sender update).
+    source_message_id (the inbound Message-ID) makes the insert idempotent;
+    it and thread_subject are recorded in the thread index.
+    Returns the update id (the existing one for a repeated Message-ID),
+    or None on error.
     """
     try:
         conn = get_connection()
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO project_updates (project_id, update_message, from_email, update_type, created_at)
-            VALUES (?, ?, ?, ?, ?)
-        """, (project_id, update_message, from_email, update_type, datetime.utcnow()))
+        if source_message_id:
+            cur.execute("""
+                INSERT INTO project_updates (project_id, update_message, from_email, update_type, created_at, source_message_id)
+                OUTPUT INSERTED.id
+                SELECT ?, ?, ?, ?, ?, ?
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM project_updates WITH (UPDLOCK, HOLDLOCK) WHERE source_message_id = ?
+                )
+            """, (project_id, update_message, from_email, update_type, datetime.utcnow(),
+                  source_message_id, source_message_id))
+        else:
+            cur.execute("""
+                INSERT INTO project_updates (project_id, update_message, from_email, update_type, created_at)
+                OUTPUT INSERTED.id
+                VALUES (?, ?, ?, ?, ?)
+            """, (project_id, update_message, from_email, update_type, datetime.utcnow()))
+        inserted = cur.fetchone()
+        if inserted is not None:
+            thread_index.record(cur, [(project_id, thread_index.keys_for(source_message_id, thread_subject, from_email))])
+            update_id = inserted[0]
+        else:
+            cur.execute("SELECT id FROM project_updates WHERE source_message_id = ?", (source_message_id,))
+            update_id = cur.fetchone()[0]
+        cur.execute("SELECT assigned_dept FROM projects WHERE id = ?", (project_id,))
+        dept = cur.fetchone()
         conn.commit()
+        if dept is not None:
+            read_cache.invalidate_departments(dept[0])
+        if inserted is not None:
+            search_index.index_updates([(inserted[0], project_id, update_message)])
         print(f"📝 Inserted update for project {project_id}")
+        return update_id
     except Exception as e:
         print("❌ DB Error insert_project_update:", e)
+        metrics.inc("db_errors_total", function="insert_project_update")
+        return None
+    finally:
+        try:
+            conn.close()
+        except:
+            pass
+
+# ------------------------------------------------------------
+# Bulk writes (one transaction per batch)
+# ------------------------------------------------------------
+# Rows go into a session temp table with fast_executemany, then one
+# set-based MERGE writes them and reports the generated ids. MERGE (not
+# INSERT ... SELECT) because only MERGE's OUTPUT can see the source row_no.
+# Rows whose source_message_id already exists are not inserted again;
+# their existing id is returned instead.
+
+def _dedupe(rows, mid_index):
+    """Keep the first row per Message-ID; return (unique_rows, alias map)."""
+    seen, unique, alias = {}, [], {}
+    for row_no, row in enumerate(rows):
+        mid = row[mid_index]
+        if mid and mid in seen:
+            alias[row_no] = seen[mid]
+            continue
+        if mid:
+            seen[mid] = row_no
+        unique.append((row_no,) + tuple(row))
+    return unique, alias
+
+def _merge_bulk(cur, temp_table, create_sql, staged, merge_sql, lookup_sql, after_merge_sql=None,
+                touched_sql=None):
+    """Returns ({row_no: id}, [departments of the newly inserted rows])."""
+    cur.execute(f"IF OBJECT_ID('tempdb..{temp_table}') IS NOT NULL DROP TABLE {temp_table}")
+    cur.execute(create_sql)
+    cur.fast_executemany = True
+    placeholders = ", ".join("?" for _ in staged[0])
+    cur.executemany(f"INSERT INTO {temp_table} VALUES ({placeholders})", staged)
+    cur.fast_executemany = False
+    cur.execute("IF OBJECT_ID('tempdb..#bulk_ids') IS NOT NULL DROP TABLE #bulk_ids")
+    cur.execute("CREATE TABLE #bulk_ids (row_no INT NOT NULL, id INT NOT NULL)")
+    cur.execute(merge_sql)
+    if after_merge_sql:
+        cur.execute(after_merge_sql)
+    cur.execute(lookup_sql)
+    ids = {r[0]: r[1] for r in cur.fetchall()}
+    touched = []
+    if touched_sql:
+        cur.execute(touched_sql)
+        touched = [r[0] for r in cur.fetchall()]
+    cur.execute(f"DROP TABLE {temp_table}")
+    cur.execute("DROP TABLE #bulk_ids")
+    return ids, touched
+
+def _insert_projects_bulk(cur, projects):
+    """MERGE on an open cursor; returns (ids in input order, rows, touched departments)."""
+    rows = [_project_row(d) + (d.get("source_message_id") or None, email_address(d.get("owner_email")))
+            for d in projects]
+    staged, alias = _dedupe(rows, 7)
+    ids, touched = _merge_bulk(
+        cur,
+        "#bulk_projects",
+        """
+        CREATE TABLE #bulk_projects (
+            row_no INT NOT NULL PRIMARY KEY,
+            project_type NVARCHAR(4000), owner_email NVARCHAR(4000), assigned_dept NVARCHAR(100),
+            time_required NVARCHAR(4000), status NVARCHAR(50), priority NVARCHAR(50),
+            summary NVARCHAR(MAX), source_message_id NVARCHAR(255), owner_address NVARCHAR(320)
+        )
+        """,
+        staged,
+        """
+        MERGE projects WITH (HOLDLOCK) AS t
+        USING #bulk_projects AS s
+           ON t.source_message_id = s.source_message_id
+        WHEN NOT MATCHED THEN
+            INSERT (project_type, owner_email, assigned_dept, time_required, status, priority, summary, source_message_id, owner_address)
+            VALUES (s.project_type, s.owner_email, s.assigned_dept, s.time_required, s.status, s.priority, s.summary, s.source_message_id, s.owner_address)
+        OUTPUT s.row_no, INSERTED.id INTO #bulk_ids (row_no, id);
+        """,
+        """
+        SELECT s.row_no, COALESCE(i.id, p.id)
+        FROM #bulk_projects s
+        LEFT JOIN #bulk_ids i ON i.row_no = s.row_no
+        LEFT JOIN projects p ON i.id IS NULL AND p.source_message_id = s.source_message_id
+        """,
+        after_merge_sql=dept_counters.BULK_BUMP_SQL,
+        touched_sql="""
+        SELECT DISTINCT s.assigned_dept
+        FROM #bulk_projects s JOIN #bulk_ids i ON i.row_no = s.row_no
+        """,
+    )
+    result = [ids.get(alias.get(n, n)) for n in range(len(rows))]
+    thread_index.record(cur, [
+        (pid, thread_index.keys_for(d.get("source_message_id"), d.get("thread_subject"), d.get("owner_email")))
+        for pid, d in zip(result, projects)
+    ])
+    return result, rows, touched
+
+def _insert_updates_bulk(cur, updates):
+    """MERGE on an open cursor; returns (ids in input order, rows, touched departments)."""
+    now = datetime.utcnow()
+    rows = [(
+        int(u["project_id"]),
+        u.get("update_message", ""),
+        u.get("from_email", ""),
+        u.get("update_type", "reply"),
+        now,
+        u.get("source_message_id") or None,
+    ) for u in updates]
+    staged, alias = _dedupe(rows, 5)
+    ids, touched = _merge_bulk(
+        cur,
+        "#bulk_updates",
+        """
+        CREATE TABLE #bulk_updates (
+            row_no INT NOT NULL PRIMARY KEY,
+            project_id INT NOT NULL, update_message NVARCHAR(MAX), from_email NVARCHAR(4000),
+            update_type NVARCHAR(50), created_at DATETIME2, source_message_id NVARCHAR(255)
+        )
+        """,
+        staged,
+        """
+        MERGE project_updates WITH (HOLDLOCK) AS t
+        USING #bulk_updates AS s
+           ON t.source_message_id = s.source_message_id
+        WHEN NOT MATCHED THEN
+            INSERT (project_id, update_message, from_email, update_type, created_at, source_message_id)
+            VALUES (s.project_id, s.update_message, s.from_email, s.update_type, s.created_at, s.source_message_id)
+        OUTPUT s.row_no, INSERTED.id INTO #bulk_ids (row_no, id);
+        """,
+        """
+        SELECT s.row_no, COALESCE(i.id, u.id)
+        FROM #bulk_updates s
+        LEFT JOIN #bulk_ids i ON i.row_no = s.row_no
+        LEFT JOIN project_updates u ON i.id IS NULL AND u.source_message_id = s.source_message_id
+        """,
+        touched_sql="""
+        SELECT DISTINCT p.assigned_dept
+        FROM #bulk_updates s
+        JOIN #bulk_ids i ON i.row_no = s.row_no
+        JOIN projects p ON p.id = s.project_id
+        """,
+    )
+    thread_index.record(cur, [
+        (row[0], thread_index.keys_for(u.get("source_message_id"), u.get("thread_subject"), u.get("from_email")))
+        for row, u in zip(rows, updates)
+    ])
+    return [ids.get(alias.get(n, n)) for n in range(len(rows))], rows, touched
+
+@metrics.timed("db_seconds", function="insert_projects_bulk")
+def insert_projects_bulk(projects):
+    """
+    Insert a list of project dicts (same keys as insert_project) in one
+    transaction. Returns the project ids in input order, or None on error.
+    """
+    if not projects:
+        return []
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        result, rows, touched = _insert_projects_bulk(cur, projects)
+        conn.commit()
+        read_cache.invalidate_departments(*touched)
+        print(f"🟩 Inserted {len(projects)} projects in one batch")
+    except Exception as e:
+        print("❌ DB Error insert_projects_bulk:", e)
+        metrics.inc("db_errors_total", function="insert_projects_bulk")
+        try:
+            conn.rollback()
+        except:
+            pass
+        return None
+    finally:
+        try:
+            conn.close()
+        except:
+            pass
+    # re-indexing a pre-existing (deduplicated) row just replaces it
+    search_index.index_projects([_search_row(pid, row) for pid, row in zip(result, rows) if pid is not None])
+    return result
+
+@metrics.timed("db_seconds", function="insert_project_updates_bulk")
+def insert_project_updates_bulk(updates):
+    """
+    Insert a list of update dicts {project_id, update_message, from_email,
+    update_type, source_message_id, thread_subject} in one transaction.
+    Returns the update ids in input order, or None on error.
+    """
+    if not updates:
+        return []
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        result, rows, touched = _insert_updates_bulk(cur, updates)
+        conn.commit()
+        read_cache.invalidate_departments(*touched)
+        print(f"📝 Inserted {len(updates)} project updates in one batch")
+    except Exception as e:
+        print("❌ DB Error insert_project_updates_bulk:", e)
+        metrics.inc("db_errors_total", function="insert_project_updates_bulk")
+        try:
+            conn.rollback()
+        except:
+            pass
+        return None
+    finally:
+        try:
+            conn.close()
+        except:
+            pass
+    search_index.index_updates([(uid, row[0], row[1]) for uid, row in zip(result, rows) if uid is not None])
+    return result
+
+@metrics.timed("db_seconds", function="write_ingest_batch")
+def write_ingest_batch(updates, resolve_ids, projects):
+    """
+    Ingest writer's group commit: sender updates, resolved statuses and new
+    projects in ONE transaction, so a failure leaves nothing half-written
+    and the caller can safely retry the emails one by one.
+    Returns the project ids in input order, or None on error (everything
+    rolled back).
+    """
+    if not (updates or resolve_ids or projects):
+        return []
+    try:
+        conn = get_connection()
+        cur = conn.cursor()
+        update_ids, update_rows, touched = _insert_updates_bulk(cur, updates) if updates else ([], [], [])
+        changed = _set_status_bulk(cur, resolve_ids, "resolved") if resolve_ids else []
+        project_ids, project_rows, new_depts = _insert_projects_bulk(cur, projects) if projects else ([], [], [])
+        conn.commit()
+        read_cache.invalidate_departments(*(set(touched) | {r[1] for r in changed} | set(new_depts)))
+        print(f"🟩 Wrote {len(projects)} projects, {len(updates)} updates, "
+              f"{len(changed)} resolved in one transaction")
+    except Exception as e:
+        print("❌ DB Error write_ingest_batch:", e)
+        metrics.inc("db_errors_total", function="write_ingest_batch")
+        try:
+            conn.rollback()
+        except:
+            pass
+        return None
     finally:
         try:
             conn.close()
         except:
             pass
+    search_index.index_updates([(uid, row[0], row[1]) for uid, row in zip(update_ids, update_rows) if uid is not None])
+    search_index.index_status([r[0] for r in changed], "resolved")
+    search_index.index_projects([_search_row(pid, row) for pid, row in zip(project_ids, project_rows) if pid is not None])
+    return project_ids
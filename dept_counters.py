@@ -0,0 +1,134 @@
+# dept_counters.py
+"""
+Per-department (status, priority) ticket counters kept in
+dept_status_counts. db_writer adjusts them in the same transaction as the
+project insert / status change, so the dashboard reads a handful of rows
+instead of scanning the department's whole history.
+
+    python dept_counters.py          verify counters against projects
+    python dept_counters.py --fix    verify and rewrite drifted counters
+"""
+import sys
+import db_writer
+
+PRIORITIES = ("high", "medium", "low")
+
+# keys are stored lower-cased, NULL as ''
+_NORM = "LOWER(COALESCE({col}, ''))"
+
+BUMP_SQL = """
+    MERGE dept_status_counts WITH (HOLDLOCK) AS t
+    USING (SELECT ? AS dept, ? AS status, ? AS priority, ? AS n) AS s
+       ON t.dept = s.dept AND t.status = s.status AND t.priority = s.priority
+    WHEN MATCHED THEN UPDATE SET cnt = t.cnt + s.n
+    WHEN NOT MATCHED THEN INSERT (dept, status, priority, cnt) VALUES (s.dept, s.status, s.priority, s.n);
+"""
+
+# used by db_writer.insert_projects_bulk right after its MERGE, while the
+# staged rows (#bulk_projects) and the inserted row numbers (#bulk_ids) exist
+BULK_BUMP_SQL = f"""
+    MERGE dept_status_counts WITH (HOLDLOCK) AS t
+    USING (
+        SELECT {_NORM.format(col="s.assigned_dept")} AS dept,
+               {_NORM.format(col="s.status")} AS status,
+               {_NORM.format(col="s.priority")} AS priority,
+               COUNT(*) AS n
+        FROM #bulk_projects s
+        JOIN #bulk_ids i ON i.row_no = s.row_no
+        GROUP BY {_NORM.format(col="s.assigned_dept")}, {_NORM.format(col="s.status")},
+                 {_NORM.format(col="s.priority")}
+    ) AS s
+       ON t.dept = s.dept AND t.status = s.status AND t.priority = s.priority
+    WHEN MATCHED THEN UPDATE SET cnt = t.cnt + s.n
+    WHEN NOT MATCHED THEN INSERT (dept, status, priority, cnt) VALUES (s.dept, s.status, s.priority, s.n);
+"""
+
+# the same aggregate straight from the base table (backfill / reconcile)
+BASE_COUNTS_SQL = f"""
+    SELECT {_NORM.format(col="assigned_dept")} AS dept,
+           {_NORM.format(col="status")} AS status,
+           {_NORM.format(col="priority")} AS priority,
+           COUNT(*) AS cnt
+    FROM projects
+    GROUP BY {_NORM.format(col="assigned_dept")}, {_NORM.format(col="status")}, {_NORM.format(col="priority")}
+"""
+
+
+def _key(value):
+    return (value or "").lower()
+
+
+def bump(cur, dept, status, priority, delta=1):
+    """Adjust one counter inside the caller's transaction."""
+    cur.execute(BUMP_SQL, (_key(dept), _key(status), _key(priority), delta))
+
+
+def move(cur, dept, old_status, new_status, priority):
+    """A project changed status: -1 on the old bucket, +1 on the new one."""
+    if _key(old_status) == _key(new_status):
+        return
+    bump(cur, dept, old_status, priority, -1)
+    bump(cur, dept, new_status, priority, 1)
+
+
+def fetch_dashboard_counts(cur, dept):
+    """Totals in the shape department_stats.html expects."""
+    cur.execute("SELECT status, priority, cnt FROM dept_status_counts WHERE dept = ?", (_key(dept),))
+    total = pending = resolved = 0
+    priority_count = {
+        "pending": {p: 0 for p in PRIORITIES},
+        "resolved": {p: 0 for p in PRIORITIES},
+    }
+    for status, priority, cnt in cur.fetchall():
+        total += cnt
+        if status == "pending":
+            pending += cnt
+        elif status == "resolved":
+            resolved += cnt
+        if status in priority_count and priority in PRIORITIES:
+            priority_count[status][priority] += cnt
+    return {"total": total, "pending": pending, "resolved": resolved, "priority_count": priority_count}
+
+
+def reconcile(fix=False):
+    """
+    Compare dept_status_counts with a GROUP BY over projects. Returns a list
+    of (dept, status, priority, counter_value, actual). With fix=True the
+    counters are rewritten from the base table in one transaction.
+    """
+    conn = db_writer.get_connection()
+    try:
+        cur = conn.cursor()
+        if fix:
+            # block writers while we rebuild so no bump is lost in between
+            cur.execute("SELECT COUNT(*) FROM dept_status_counts WITH (TABLOCKX, HOLDLOCK)")
+            cur.fetchall()
+        cur.execute(BASE_COUNTS_SQL)
+        actual = {(r[0], r[1], r[2]): r[3] for r in cur.fetchall()}
+        cur.execute("SELECT dept, status, priority, cnt FROM dept_status_counts")
+        stored = {(r[0], r[1], r[2]): r[3] for r in cur.fetchall()}
+
+        drift = []
+        for key in sorted(set(actual) | set(stored)):
+            have, want = stored.get(key, 0), actual.get(key, 0)
+            if have != want:
+                drift.append(key + (have, want))
+
+        if fix and drift:
+            cur.execute("DELETE FROM dept_status_counts")
+            cur.execute(f"INSERT INTO dept_status_counts (dept, status, priority, cnt) {BASE_COUNTS_SQL}")
+        conn.commit()
+        return drift
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    fix = "--fix" in sys.argv[1:]
+    drift = reconcile(fix=fix)
+    if not drift:
+        print("✅ Department counters match the projects table")
+    for dept, status, priority, have, want in drift:
+        print(f"❌ {dept or '(none)'} / {status or '(none)'} / {priority or '(none)'}: counter {have}, actual {want}")
+    if drift and fix:
+        print(f"🔧 Rebuilt counters ({len(drift)} buckets were off)")
@@ -0,0 +1,272 @@
+# email_daemon.py
+"""
+Long-running asyncio version of email_reader: keeps one IMAP session
+open (IDLE when imaplib2 is installed, polling with backoff otherwise)
+and runs LLM extractions concurrently through ChatGroq.ainvoke behind a
+rate-limit aware scheduler.
+
+    python email_daemon.py        (or: python email_reader.py --daemon)
+"""
+import os
+import random
+import signal
+import asyncio
+import imaplib
+
+import metrics
+import thread_index
+import ingest_ledger
+import llm_groq_extractor
+from llm_groq_extractor import aclassify_and_extract
+from rate_limiter import LLMScheduler
+from ingest_pipeline import FETCH_BATCH_SIZE, UidWatermark, fetch_chunk
+from email_reader import (
+    EMAIL, PASSWORD, SERVER, PORT,
+    get_last_uid, save_last_uid, parse_email, decide, write_email,
+)
+
+POLL_INTERVAL = float(os.getenv("DAEMON_POLL_INTERVAL", 15))
+POLL_MAX_INTERVAL = float(os.getenv("DAEMON_POLL_MAX_INTERVAL", 120))
+USE_IDLE = os.getenv("DAEMON_USE_IDLE", "1") == "1"
+# servers drop IDLE after ~30 min; re-issue well before that
+IDLE_TIMEOUT = float(os.getenv("DAEMON_IDLE_TIMEOUT", 300))
+MAX_INFLIGHT_EMAILS = int(os.getenv("DAEMON_MAX_INFLIGHT", 20))
+RECONNECT_MAX_DELAY = float(os.getenv("DAEMON_RECONNECT_MAX_DELAY", 300))
+
+
+def connect_imap():
+    """imaplib2 if available (it implements IDLE), plain imaplib otherwise."""
+    try:
+        import imaplib2
+        mail = imaplib2.IMAP4_SSL(SERVER, PORT)
+    except ImportError:
+        mail = imaplib.IMAP4_SSL(SERVER, PORT)
+    mail.login(EMAIL, PASSWORD)
+    mail.select("inbox")
+    return mail
+
+
+class EmailDaemon:
+    """
+    - connect: returns a logged-in imaplib-style client with INBOX selected
+    - ainvoke: async LLM call (defaults to ChatGroq.ainvoke)
+
+    Both are injectable so the daemon can run against fake IMAP / LLM servers.
+    """
+
+    def __init__(self, connect=connect_imap, ainvoke=None, use_idle=USE_IDLE,
+                 max_inflight=MAX_INFLIGHT_EMAILS):
+        self.connect = connect
+        self.scheduler = LLMScheduler(ainvoke or llm_groq_extractor.llm.ainvoke)
+        self.use_idle = use_idle
+        self.max_inflight = max_inflight
+        self.mail = None
+        self.ledger = None
+        self.stats = {"sessions": 0, "cycles": 0, "processed": 0, "failed": 0, "skipped": 0}
+        self._stop = None
+        self._slots = None
+        self._write_lock = None
+
+    # ------------------------------
+    # Lifecycle
+    # ------------------------------
+    def stop(self):
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self):
+        self._stop = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.max_inflight)
+        self._write_lock = asyncio.Lock()
+        delay = 1.0
+
+        while not self._stop.is_set():
+            try:
+                self.mail = await asyncio.to_thread(self.connect)
+                self.ledger = await asyncio.to_thread(ingest_ledger.open_ledger, self.mail, f"{EMAIL}/INBOX")
+                self.stats["sessions"] += 1
+                print("📬 IMAP session open")
+                delay = 1.0
+                await self._session()
+            except Exception as e:
+                print("❌ IMAP session error:", e)
+                await self._sleep(random.uniform(0.5, 1.5) * delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            finally:
+                await self._logout()
+
+        print("Email daemon stopped", self.stats, self.scheduler.stats)
+
+    async def _logout(self):
+        if self.mail is None:
+            return
+        try:
+            await asyncio.to_thread(self.mail.logout)
+        except Exception:
+            pass
+        self.mail = None
+
+    async def _sleep(self, seconds):
+        """Sleep that wakes up early on stop()."""
+        try:
+            await asyncio.wait_for(self._stop.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    # ------------------------------
+    # Wait for new mail
+    # ------------------------------
+    async def _session(self):
+        interval = POLL_INTERVAL
+        idle = self.use_idle and hasattr(self.mail, "idle")
+        while not self._stop.is_set():
+            found = await self.drain()
+            if found:
+                interval = POLL_INTERVAL
+                continue
+            if idle:
+                await self._idle()
+            else:
+                await self._sleep(interval)
+                interval = min(interval * 2, POLL_MAX_INTERVAL)
+
+    async def _idle(self):
+        waiter = asyncio.ensure_future(asyncio.to_thread(self.mail.idle, timeout=IDLE_TIMEOUT))
+        stopper = asyncio.ensure_future(self._stop.wait())
+        done, _ = await asyncio.wait({waiter, stopper}, return_when=asyncio.FIRST_COMPLETED)
+        if stopper in done:
+            # any command terminates IDLE
+            await asyncio.to_thread(self.mail.noop)
+        else:
+            stopper.cancel()
+        await waiter
+
+    # ------------------------------
+    # Process everything above the checkpoint
+    # ------------------------------
+    async def drain(self):
+        self.stats["cycles"] += 1
+        last_uid = get_last_uid()
+        with metrics.timed("imap_seconds", op="search"):
+            status, data = await asyncio.to_thread(self.mail.uid, "search", None, f"(UID {last_uid + 1}:*)")
+        if status != "OK":
+            raise RuntimeError(f"UID SEARCH failed: {status}")
+        uids = [int(u) for u in (data[0].split() if data and data[0] else [])
+                if int(u) > last_uid and ingest_ledger.owns(u)]
+        retry_uids = []
+        if self.ledger is not None:
+            try:
+                retry_uids = [u for u in await asyncio.to_thread(self.ledger.due_retries) if u <= last_uid]
+            except Exception as e:
+                print("❌ Could not read due retries from the ingest ledger:", e)
+        if not uids and not retry_uids:
+            return 0
+        print(f"\n=== Found {len(uids)} new emails, {len(retry_uids)} retries ===\n")
+
+        uids = retry_uids + uids
+        watermark = UidWatermark(uids)
+        tasks = []
+        try:
+            for i in range(0, len(uids), FETCH_BATCH_SIZE):
+                chunk = uids[i:i + FETCH_BATCH_SIZE]
+                if self.ledger is not None:
+                    try:
+                        owned = set(await asyncio.to_thread(self.ledger.claim, chunk))
+                    except Exception as e:
+                        # left unmarked, so the checkpoint cannot pass them
+                        print(f"❌ Could not claim UIDs {chunk[0]}-{chunk[-1]}:", e)
+                        continue
+                    for uid in chunk:
+                        if uid not in owned:
+                            self.stats["skipped"] += 1
+                            self._checkpoint(watermark, uid, last_uid)
+                    chunk = [u for u in chunk if u in owned]
+                    if not chunk:
+                        continue
+                messages = await asyncio.to_thread(fetch_chunk, self.mail, chunk)
+                await self._record("fetched", [u for u in chunk if u in messages])
+                for uid in chunk:
+                    await self._slots.acquire()
+                    tasks.append(asyncio.ensure_future(self._handle(uid, messages.get(uid), watermark, last_uid)))
+        except asyncio.CancelledError:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            # a FETCH that fails mid-drain must not leave handlers running into
+            # the reconnect, which drains again from the same checkpoint
+            if tasks:
+                await asyncio.gather(*tasks, return_exceptions=True)
+        return len(uids)
+
+    async def _record(self, state, uids, error=None):
+        """Ledger update off the event loop; False if it could not be written."""
+        if self.ledger is None or not uids:
+            return True
+        try:
+            await asyncio.to_thread(self.ledger.mark, state, uids, error)
+            return True
+        except Exception as e:
+            print(f"❌ Could not record {state} for UIDs {uids}:", e)
+            return False
+
+    def _checkpoint(self, watermark, uid, last_uid):
+        advanced = watermark.mark_done(uid)
+        # retried UIDs sit below the checkpoint; never move it backwards
+        if advanced is not None and advanced > last_uid:
+            save_last_uid(advanced)
+
+    async def _handle(self, uid, raw, watermark, last_uid):
+        done = True
+        try:
+            if raw is None:
+                raise LookupError("message not returned by FETCH")
+            parsed = parse_email(raw)
+            print(f"[EMAIL] From: {parsed['sender']}\nSubject: {parsed['subject']}")
+            decision = await asyncio.to_thread(thread_index.resolve, parsed)
+            if decision is None:
+                info = await aclassify_and_extract(
+                    parsed["subject"], parsed["body"], parsed.get("headers"), ainvoke=self.scheduler
+                )
+                decision = decide(parsed, info)
+            await self._record("classified", [uid])
+            # single writer: DB writes stay serialized like the sync pipeline
+            async with self._write_lock:
+                await asyncio.to_thread(write_email, parsed, decision)
+            self.stats["processed"] += 1
+            await self._record("written", [uid])
+        except asyncio.CancelledError:
+            # neither written nor recorded as failed: must be searched again
+            done = False
+            raise
+        except Exception as e:
+            print(f"Failed to process UID {uid}:", e)
+            self.stats["failed"] += 1
+            # unrecorded failures hold the checkpoint so they are searched again
+            done = await self._record("failed", [uid], e)
+        finally:
+            if done:
+                self._checkpoint(watermark, uid, last_uid)
+            self._slots.release()
+
+
+def main():
+    daemon = EmailDaemon()
+
+    async def runner():
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, daemon.stop)
+            except (NotImplementedError, RuntimeError):
+                pass  # Windows: Ctrl+C still raises KeyboardInterrupt
+        await daemon.run()
+
+    try:
+        asyncio.run(runner())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
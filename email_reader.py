@@ -1,11 +1,22 @@
 # email_reader.py
 import os
+import sys
 import imaplib
-import email
 from email.header import decode_header
 from dotenv import load_dotenv
-from llm_groq_extractor import extract_task_info, extract_status_update
-from db_writer import insert_project, update_task_status, insert_project_update
+from llm_groq_extractor import (
+    classify_and_extract, classify_and_extract_batch, batch_stats, LLM_BATCH_SIZE, EXTRACTION_MODE
+)
+from db_writer import (
+    insert_project, update_task_status, insert_project_update, write_ingest_batch
+)
+from ingest_pipeline import run_pipeline
+import preclassifier
+import thread_index
+import llm_cache
+import metrics
+import mime_reader
+import ingest_ledger
 
 load_dotenv()
 
@@ -14,23 +25,50 @@ PASSWORD = os.getenv("EMAIL_PASSWORD")
 SERVER = os.getenv("IMAP_SERVER", "imap.gmail.com")
 PORT = int(os.getenv("IMAP_PORT", 993))
 
-UID_FILE = "last_uid.txt"
+# one checkpoint per shard when INGEST_SHARD splits the mailbox
+UID_FILE = os.getenv("UID_FILE") or ingest_ledger.checkpoint_file("last_uid.txt")
+
+# "groq" (default) or "local" for the offline flan-t5 ONNX worker process
+EXTRACTOR_BACKEND = os.getenv("EXTRACTOR_BACKEND", "groq").lower()
+
+# writer stage commits queued results with one bulk insert per group
+DB_BULK_WRITES = os.getenv("DB_BULK_WRITES", "1") == "1"
+
+# backlogs at least this large are classified LLM_BATCH_SIZE emails per prompt
+LLM_BATCH_MIN_BACKLOG = int(os.getenv("LLM_BATCH_MIN_BACKLOG", 20))
 
 def get_last_uid():
     if os.path.exists(UID_FILE):
         try:
             with open(UID_FILE, "r") as f:
                 return int(f.read().strip())
-        except:
+        except (OSError, ValueError) as e:
+            # re-reading the mailbox is safe: inserts are idempotent per Message-ID
+            print(f"❌ Unreadable checkpoint {UID_FILE}, starting from UID 0:", e)
             return 0
     return 0
 
 def save_last_uid(uid):
+    """
+    Atomic checkpoint: write a temp file, fsync it, then rename it over
+    UID_FILE, so a crash leaves either the old or the new value on disk.
+    """
+    tmp = f"{UID_FILE}.tmp"
     try:
-        with open(UID_FILE, "w") as f:
+        with open(tmp, "w") as f:
             f.write(str(uid))
-    except:
-        pass
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, UID_FILE)
+        if hasattr(os, "O_DIRECTORY"):
+            # make the rename itself durable (POSIX only)
+            fd = os.open(os.path.dirname(os.path.abspath(UID_FILE)), os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    except OSError as e:
+        print(f"❌ Could not save checkpoint UID {uid}:", e)
 
 def clean_subject(raw):
     try:
@@ -42,92 +80,324 @@ def clean_subject(raw):
         return raw or ""
 
 def get_body(msg):
+    """
+    Text for the LLM: first inline text/plain part, else text/html converted
+    to text, cut to MIME_BODY_TOKEN_BUDGET. Attachments are never decoded.
+    """
     try:
-        if msg.is_multipart():
-            for part in msg.walk():
-                ctype = part.get_content_type()
-                if ctype == "text/plain":
-                    try:
-                        return part.get_payload(decode=True).decode("utf-8", errors="ignore")
-                    except:
-                        pass
-                if ctype == "text/html" and not part.get_content_maintype() == 'multipart':
-                    try:
-                        return part.get_payload(decode=True).decode("utf-8", errors="ignore")
-                    except:
-                        pass
-        else:
-            content = msg.get_payload(decode=True)
-            if content:
-                return content.decode("utf-8", errors="ignore")
+        return mime_reader.body_text(msg)
     except Exception:
-        pass
-    return ""
+        return ""
 
-def read_inbox():
-    last_uid = get_last_uid()
-    print(f"\nLast processed UID = {last_uid}")
+# ------------------------------------------------------------
+# Per-message stages (used by the ingest pipeline)
+# ------------------------------------------------------------
+@metrics.timed("mime_parse_seconds")
+def parse_email(raw):
+    """raw: RFC822 bytes, or a mime_reader.PartialMessage from a structure fetch."""
+    if isinstance(raw, mime_reader.PartialMessage):
+        msg, body = raw.headers, raw.body
+    else:
+        msg = mime_reader.parse_message(raw)
+        body = get_body(msg)
+    return {
+        "subject": clean_subject(msg.get("Subject", "")),
+        "sender": msg.get("From", ""),
+        "body": body,
+        "headers": {
+            "message_id": msg.get("Message-ID", ""),
+            "in_reply_to": msg.get("In-Reply-To", ""),
+            "references": msg.get("References", ""),
+        },
+    }
 
-    mail = imaplib.IMAP4_SSL(SERVER, PORT)
-    mail.login(EMAIL, PASSWORD)
-    mail.select("inbox")
+def classify_email(parsed):
+    """LLM stage: decide between status update and new project."""
+    subject, sender, body = parsed["subject"], parsed["sender"], parsed["body"]
+    print(f"[EMAIL] From: {sender}\nSubject: {subject}")
 
-    search_criteria = f"(UID {last_uid + 1}:*)"
-    status, data = mail.uid("search", None, search_criteria)
-    new_uids = data[0].split() if data and data[0] else []
-    print(f"\n=== Found {len(new_uids)} new emails ===\n")
+    # follow-ups and duplicate deliveries of a known thread skip the LLM
+    threaded = thread_index.resolve(parsed)
+    if threaded is not None:
+        return threaded
+
+    # one LLM call in "combined" mode, status check + task extraction otherwise
+    try:
+        if EXTRACTOR_BACKEND == "local":
+            import llm_extractor
+            info = llm_extractor.classify_and_extract(subject, body, parsed.get("headers"))
+        else:
+            info = classify_and_extract(subject, body, parsed.get("headers"))
+    except Exception as e:
+        print("Extraction error:", e)
+        return {"kind": "skip"}
+
+    return decide(parsed, info)
+
+def decide(parsed, info):
+    """Turn a classify_and_extract() result into a write_email() decision."""
+    # 1) Status update for an existing task
+    if info.get("is_status_update"):
+        return {"kind": "status", "status_info": info}
+
+    # 2) Otherwise treat as normal incoming request -> create project
+    extracted = info["task"]
+    extracted["owner_email"] = parsed["sender"]
+    # makes the insert idempotent if this email is ever processed twice
+    extracted["source_message_id"] = (parsed.get("headers") or {}).get("message_id") or None
+    extracted["thread_subject"] = parsed["subject"]
+    return {"kind": "project", "data": extracted}
+
+def _task_id(status_info):
+    """The status update's task id as an int (None if absent); ValueError if garbled."""
+    tid = status_info.get("task_id")
+    if tid is None or tid == "" or tid == 0:
+        return None
+    try:
+        return int(tid)
+    except (TypeError, ValueError):
+        raise ValueError(f"invalid task id {tid!r}")
+
+def write_email(parsed, decision, written=None):
+    """
+    DB stage: persist the classified email. Raises if a write failed so
+    the pipeline records the UID as failed instead of done. A new project
+    whose thread was written after classification (see
+    thread_index.recheck) is stored as an update instead; `written` is the
+    drain's thread_index.WrittenThreads.
+    """
+    subject, sender, body = parsed["subject"], parsed["sender"], parsed["body"]
+    message_id = (parsed.get("headers") or {}).get("message_id") or None
+
+    if decision["kind"] == "project":
+        decision = thread_index.recheck([parsed], written)[0] or decision
 
-    for uid in new_uids:
+    if decision["kind"] == "status":
+        status_info = decision["status_info"]
+        tid = _task_id(status_info)
+        new_status = status_info.get("new_status")
+        # insert the message into updates table for visibility
+        if tid:
+            update_id = insert_project_update(project_id=tid, update_message=f"Sender update: {subject}\n\n{body}", from_email=sender, update_type="sender",
+                                              source_message_id=message_id,
+                                              thread_subject=subject)
+            if update_id is None:
+                raise RuntimeError(f"insert of the update for project {tid} failed")
+            if written is not None:
+                written.add(message_id, tid)
+        if tid and new_status == "resolved":
+            if update_task_status(tid, "resolved") is None:
+                raise RuntimeError(f"resolving project {tid} failed")
+            print(f"✅ Marked task {tid} resolved (from incoming sender email)")
+        else:
+            print("ℹ Status update found but not marked resolved (no resolved keyword)")
+
+    elif decision["kind"] == "project":
+        project_id = insert_project(decision["data"])
+        if project_id is None:
+            raise RuntimeError("insert of the project failed")
+        if written is not None:
+            written.add(message_id, project_id)
+
+def write_email_batch(items, written=None):
+    """
+    Writer stage for a group of (uid, (parsed, decision)) items: sender
+    updates, resolved statuses and new projects in one transaction.
+    Returns [(uid, error)] for items rejected before the write (e.g. a
+    garbled task id); the rest are committed. Raises if a transaction
+    fails, and the pipeline retries the group one email at a time.
+
+    New projects are checked again against the thread index and
+    `written` (the drain's thread_index.WrittenThreads) first. A reply to
+    an earlier email of the same group needs that email's project id, so
+    the group is committed up to the reply first; if a later transaction
+    fails, the per-email retry skips what was committed as duplicates.
+    """
+    if written is None:
+        written = thread_index.WrittenThreads()
+    late = iter(thread_index.recheck(
+        [parsed for _, (parsed, decision) in items if decision["kind"] == "project"], written))
+
+    updates, resolved, projects, rejected = [], [], [], []
+    group = thread_index.WrittenThreads()   # Message-IDs of this group; only hits matter
+
+    def commit():
+        project_ids = write_ingest_batch(updates, sorted(set(resolved)), [data for _, data in projects])
+        if project_ids is None:
+            raise RuntimeError("batched ingest write failed")
+        for tid in sorted(set(resolved)):
+            print(f"✅ Marked task {tid} resolved (from incoming sender email)")
+        for u in updates:
+            written.add(u["source_message_id"], u["project_id"])
+        for (message_id, _), project_id in zip(projects, project_ids):
+            written.add(message_id, project_id)
+        del updates[:], resolved[:], projects[:]
+
+    for uid, (parsed, decision) in items:
+        message_id = (parsed.get("headers") or {}).get("message_id") or None
+        if decision["kind"] == "project":
+            decision = next(late) or decision
+        if decision["kind"] == "project" and group.lookup(parsed) is not None:
+            # its thread is earlier in this group: commit up to here first
+            commit()
+            decision = thread_index.recheck([parsed], written)[0] or decision
+        if decision["kind"] == "status":
+            info = decision["status_info"]
+            try:
+                tid = _task_id(info)
+            except ValueError as e:
+                rejected.append((uid, e))
+                continue
+            if not tid:
+                print("ℹ Status update found but not marked resolved (no resolved keyword)")
+                continue
+            updates.append({
+                "project_id": tid,
+                "update_message": f"Sender update: {parsed['subject']}\n\n{parsed['body']}",
+                "from_email": parsed["sender"],
+                "update_type": "sender",
+                "source_message_id": message_id,
+                "thread_subject": parsed["subject"],
+            })
+            group.add(message_id, tid)
+            if info.get("new_status") == "resolved":
+                resolved.append(tid)
+        elif decision["kind"] == "project":
+            projects.append((message_id, decision["data"]))
+            group.add(message_id, len(projects))
+
+    commit()
+    return rejected
+
+def process_email(uid, raw):
+    with metrics.profiled("ingest-email"):
+        parsed = parse_email(raw)
+        return parsed, classify_email(parsed)
+
+def process_email_batch(jobs):
+    """Batched variant of process_email for backlog drains."""
+    parsed_list = []
+    for uid, raw in jobs:
         try:
-            _, msg_data = mail.uid("fetch", uid, "(RFC822)")
-            raw = msg_data[0][1]
-            msg = email.message_from_bytes(raw)
+            parsed = parse_email(raw)
+            print(f"[EMAIL] From: {parsed['sender']}\nSubject: {parsed['subject']}")
         except Exception as e:
-            print("Failed to fetch message:", e)
-            save_last_uid(int(uid))
-            continue
+            parsed = e
+        parsed_list.append(parsed)
 
-        subject = clean_subject(msg.get("Subject", ""))
-        sender = msg.get("From", "")
-        body = get_body(msg)
+    ok = [p for p in parsed_list if not isinstance(p, Exception)]
+    threaded = dict(zip(map(id, ok), thread_index.resolve_many(ok)))
+    todo = [p for p in ok if threaded[id(p)] is None]
+    infos = iter(classify_and_extract_batch([(p["subject"], p["body"], p.get("headers")) for p in todo]))
 
-        print(f"[EMAIL] From: {sender}\nSubject: {subject}")
+    results = []
+    for p in parsed_list:
+        if isinstance(p, Exception):
+            results.append(p)
+        elif threaded[id(p)] is not None:
+            results.append((p, threaded[id(p)]))
+        else:
+            results.append((p, decide(p, next(infos))))
+    return results
 
-        # 1) Check status-update first
+def drain_mailbox(mail, last_uid, save_checkpoint, ledger=None):
+    """
+    Process every message above last_uid in the folder selected on `mail`,
+    plus the ledger's due retries. save_checkpoint(uid) receives the new
+    contiguous watermark. Returns the pipeline summary.
+    """
+    search_criteria = f"(UID {last_uid + 1}:*)"
+    with metrics.timed("imap_seconds", op="search"):
+        status, data = mail.uid("search", None, search_criteria)
+    new_uids = data[0].split() if data and data[0] else []
+    # "N:*" always matches the newest message, even when it is <= N
+    new_uids = [int(u) for u in new_uids if int(u) > last_uid and ingest_ledger.owns(u)]
+    print(f"\n=== Found {len(new_uids)} new emails ===\n")
+    retry_uids = []
+    if ledger is not None:
         try:
-            status_info = extract_status_update(subject, body)
+            retry_uids = [u for u in ledger.due_retries() if u <= last_uid]
         except Exception as e:
-            print("Status extraction error:", e)
-            status_info = {"is_status_update": False, "task_id": None, "new_status": None}
+            print("❌ Could not read due retries from the ingest ledger:", e)
+        if retry_uids:
+            print(f"=== Retrying {len(retry_uids)} earlier failures ===\n")
 
-        if status_info.get("is_status_update"):
-            tid = status_info.get("task_id")
-            new_status = status_info.get("new_status")
-            # insert the message into updates table for visibility
-            try:
-                if tid:
-                    insert_project_update(project_id=tid, update_message=f"Sender update: {subject}\n\n{body}", from_email=sender, update_type="sender")
-                if tid and new_status == "resolved":
-                    update_task_status(tid, "resolved")
-                    print(f"✅ Marked task {tid} resolved (from incoming sender email)")
-                else:
-                    print("ℹ Status update found but not marked resolved (no resolved keyword)")
-            except Exception as e:
-                print("Error handling status update:", e)
-            save_last_uid(int(uid))
-            continue
-
-        # 2) Otherwise treat as normal incoming request -> create project
+    def checkpoint(uid):
+        # retried UIDs sit below the checkpoint; never move it backwards
+        if uid > last_uid:
+            save_checkpoint(uid)
+
+    # the local worker batches concurrent requests itself; batched prompts
+    # are combined-only, so sequential mode classifies one email at a time
+    batched = (EXTRACTOR_BACKEND != "local" and LLM_BATCH_SIZE > 1 and EXTRACTION_MODE != "sequential"
+               and len(new_uids) >= LLM_BATCH_MIN_BACKLOG)
+    # emails classified before their thread was written are caught here
+    written = thread_index.WrittenThreads()
+    summary = run_pipeline(
+        mail,
+        retry_uids + new_uids,
+        process=process_email,
+        write=lambda uid, item: write_email(*item, written=written),
+        on_checkpoint=checkpoint,
+        process_batch=process_email_batch if batched else None,
+        group_size=LLM_BATCH_SIZE,
+        write_batch=(lambda items: write_email_batch(items, written)) if DB_BULK_WRITES else None,
+        claim=ledger.claim if ledger is not None else None,
+        on_state=ledger.mark if ledger is not None else None,
+        # an original must be written before the replies it answers
+        in_order=thread_index.THREAD_INDEX_ENABLED,
+    )
+    print(f"\n=== Processed {summary['written']} emails, {summary['failed']} failed, "
+          f"{summary['skipped']} owned by other workers (checkpoint UID = {summary['checkpoint']}) ===\n")
+    if ledger is not None:
         try:
-            extracted = extract_task_info(subject, body)
-            extracted["owner_email"] = sender
-            insert_project(extracted)
+            states = ledger.counts()
+            print(f"Ingest ledger: {states.get('failed', 0)} waiting for retry, {states.get('dead', 0)} dead")
         except Exception as e:
-            print("Error inserting project:", e)
+            print("❌ Could not read ingest ledger counts:", e)
+    return summary
 
-        save_last_uid(int(uid))
+def print_ingest_stats():
+    """Process-wide counters of the pre-LLM shortcuts and the LLM cache."""
+    threads = thread_index.stats()
+    print(f"Thread index: {threads['threaded']} follow-ups attached, {threads['duplicates']} duplicates "
+          f"skipped (hit rate {threads['hit_rate']:.0%}), {threads['late']} more caught at write time")
+    rules = preclassifier.stats()
+    print(f"Pre-classifier: {rules['decided']}/{rules['checked']} decided by rules "
+          f"(hit rate {rules['hit_rate']:.0%}), {rules['llm_calls_saved']} LLM calls saved")
+    b = batch_stats()
+    if b["batches"]:
+        print(f"LLM batching: {b['batched_emails']} emails in {b['batches']} prompts "
+              f"(avg {b['avg_batch_size']}, max {b['configured_batch_size']}), "
+              f"{b['splits']} splits, {b['single_fallbacks']} single-email retries")
+    cache = llm_cache.get_cache()
+    if cache is not None:
+        c = cache.stats()
+        print(f"LLM cache: {c['memory_hits'] + c['disk_hits']} hits, {c['misses']} misses "
+              f"(hit rate {c['hit_rate']:.0%}, {c['disk_entries']} entries on disk)")
 
-    mail.logout()
+def read_inbox():
+    last_uid = get_last_uid()
+    print(f"\nLast processed UID = {last_uid}")
+
+    mail = imaplib.IMAP4_SSL(SERVER, PORT)
+    mail.login(EMAIL, PASSWORD)
+    mail.select("inbox")
+    ledger = ingest_ledger.open_ledger(mail, f"{EMAIL}/INBOX")
+    try:
+        drain_mailbox(mail, last_uid, save_last_uid, ledger)
+        print_ingest_stats()
+    finally:
+        mail.logout()
 
 if __name__ == "__main__":
-    read_inbox()
+    if "--metrics-port" in sys.argv[1:]:
+        metrics.serve(int(sys.argv[sys.argv.index("--metrics-port") + 1]))
+    if "--daemon" in sys.argv[1:]:
+        from email_daemon import main as run_daemon
+        run_daemon()
+    elif "--coordinator" in sys.argv[1:]:
+        from ingest_coordinator import main as run_coordinator
+        run_coordinator()
+    else:
+        read_inbox()
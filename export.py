@@ -0,0 +1,165 @@
+# export.py
+"""
+Streaming ticket exports (CSV or JSONL, optionally gzipped).
+
+One forward-only query returns every matching project joined to its
+updates, ordered by project. Rows are pulled with fetchmany() and
+written out as they arrive, so memory stays flat however many projects
+and updates are exported; nothing is collected per project either.
+
+  csv    one row per update; project columns repeat, a project without
+         updates gets one row with empty update columns
+  jsonl  one line per project: {..., "updates": [...]}
+"""
+import os
+import io
+import csv
+import json
+import zlib
+
+from db_writer import get_connection
+from project_filters import project_filters, email_predicate
+
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", 1000))
+# bytes buffered before a chunk goes to the client
+EXPORT_CHUNK_BYTES = int(os.getenv("EXPORT_CHUNK_BYTES", 64 * 1024))
+
+FORMATS = {
+    "csv": "text/csv; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+}
+
+PROJECT_COLUMNS = (
+    "id", "project_type", "owner_email", "assigned_dept", "time_required",
+    "status", "priority", "created_at", "summary",
+)
+UPDATE_COLUMNS = ("id", "update_type", "from_email", "created_at", "message")
+CSV_HEADER = PROJECT_COLUMNS + (
+    "update_id", "update_type", "update_from_email", "update_created_at", "update_message",
+)
+
+EXPORT_SQL = """
+SELECT p.id, p.project_type, p.owner_email, p.assigned_dept, p.time_required,
+       p.status, p.priority, p.created_at, p.summary,
+       u.id, u.update_type, u.from_email, u.created_at, u.update_message
+FROM projects p
+LEFT JOIN project_updates u ON u.project_id = p.id
+WHERE {where}
+ORDER BY p.created_at DESC, p.id DESC, u.created_at ASC, u.id ASC
+"""
+
+
+def _text(value):
+    if value is None:
+        return None
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return value
+
+
+# ------------------------------------------------------------
+# Row source
+# ------------------------------------------------------------
+def stream_rows(where, params, fetch_rows=EXPORT_FETCH_ROWS):
+    """
+    Yield joined (project..., update...) rows in fetch_rows batches. The
+    pooled connection is held until the generator finishes or is closed.
+    """
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(EXPORT_SQL.format(where=where), params)
+        while True:
+            rows = cur.fetchmany(fetch_rows)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        conn.close()
+
+
+def department_rows(dept, status=None, priority=None, email=None):
+    where, params = project_filters(dept, status, priority, email, alias="p")
+    return stream_rows(where, params)
+
+
+def sender_rows(email):
+    where, params = email_predicate(email, alias="p")
+    return stream_rows(where, params)
+
+
+# ------------------------------------------------------------
+# Encoders (rows -> text pieces)
+# ------------------------------------------------------------
+def encode_csv(rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_HEADER)
+    for row in rows:
+        writer.writerow([_text(v) for v in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+
+def encode_jsonl(rows):
+    """
+    Projects are written incrementally: the object is opened at the first
+    row of a project and each update is appended as its row arrives.
+    """
+    n = len(PROJECT_COLUMNS)
+    current = None
+    for row in rows:
+        if row[0] != current:
+            if current is not None:
+                yield "]}\n"
+            current = row[0]
+            project = {c: _text(v) for c, v in zip(PROJECT_COLUMNS, row[:n])}
+            # drop the closing brace so the updates array can follow
+            yield json.dumps(project, ensure_ascii=False)[:-1] + ', "updates": ['
+            first = True
+        if row[n] is None:
+            continue
+        update = {c: _text(v) for c, v in zip(UPDATE_COLUMNS, row[n:])}
+        yield ("" if first else ", ") + json.dumps(update, ensure_ascii=False)
+        first = False
+    if current is not None:
+        yield "]}\n"
+
+
+ENCODERS = {"csv": encode_csv, "jsonl": encode_jsonl}
+
+
+# ------------------------------------------------------------
+# Chunking / compression
+# ------------------------------------------------------------
+def chunked(pieces, chunk_bytes=EXPORT_CHUNK_BYTES, compress=False):
+    """
+    Join text pieces into byte chunks of about chunk_bytes, gzipping on
+    the fly when compress=True.
+    """
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buf, size = [], 0
+    for piece in pieces:
+        data = piece.encode("utf-8")
+        buf.append(data)
+        size += len(data)
+        if size >= chunk_bytes:
+            out = b"".join(buf)
+            buf, size = [], 0
+            if gz is not None:
+                out = gz.compress(out)
+            if out:
+                yield out
+    out = b"".join(buf)
+    if gz is not None:
+        out = gz.compress(out) + gz.flush()
+    if out:
+        yield out
+
+
+def export(rows, fmt="csv", compress=False):
+    """Byte chunks of rows encoded as fmt ('csv' or 'jsonl')."""
+    return chunked(ENCODERS[fmt](rows), compress=compress)
@@ -0,0 +1,376 @@
+# ingest_coordinator.py
+"""
+Runs ingestion for several mailboxes / folders on any number of nodes.
+
+Each (address, folder) pair is one row in mailbox_leases (migration 0009)
+holding its owner, lease expiry, fencing epoch and UID checkpoint. A node:
+
+  - heartbeats into ingest_nodes and renews the leases it holds
+  - claims free or expired mailboxes up to its fair share,
+    ceil(mailboxes / live nodes), capped by INGEST_NODE_CAPACITY
+  - sheds mailboxes above that share when more nodes join
+  - runs one worker thread per owned mailbox (email_reader.drain_mailbox
+    in a poll loop)
+
+When a node dies its leases run out after INGEST_MAILBOX_LEASE_SECONDS and
+the survivors pick the mailboxes up, starting from the checkpoint in the
+table. A checkpoint write carries the epoch of the lease, so a node that
+lost its lease (e.g. after a long GC or network pause) cannot move the
+checkpoint any more; the per-UID ingest ledger keeps the overlap from
+processing a message twice.
+
+Mailboxes come from INGEST_MAILBOXES (JSON, or the path of a JSON file):
+
+    [{"address": "support@icici.com", "password_env": "SUPPORT_PASSWORD",
+      "server": "imap.gmail.com", "port": 993, "folders": ["INBOX", "Escalations"]}]
+
+Without it the EMAIL_ADDRESS inbox is the only mailbox, seeded from
+last_uid.txt.
+
+    python ingest_coordinator.py            run this node (or: email_reader.py --coordinator)
+    python ingest_coordinator.py --status   mailboxes, owners and checkpoints
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import imaplib
+import threading
+
+import ingest_ledger
+import email_reader
+from db_writer import get_connection
+
+INGEST_MAILBOXES = os.getenv("INGEST_MAILBOXES", "")
+INGEST_NODE_ID = os.getenv("INGEST_NODE_ID") or ingest_ledger.INGEST_WORKER_ID
+INGEST_NODE_CAPACITY = int(os.getenv("INGEST_NODE_CAPACITY", 4))
+INGEST_MAILBOX_LEASE_SECONDS = int(os.getenv("INGEST_MAILBOX_LEASE_SECONDS", 90))
+# well under the lease, so one missed beat does not lose the mailbox
+INGEST_HEARTBEAT_SECONDS = float(os.getenv("INGEST_HEARTBEAT_SECONDS", 20))
+INGEST_POLL_INTERVAL = float(os.getenv("INGEST_POLL_INTERVAL", 30))
+INGEST_RECONNECT_MAX_DELAY = float(os.getenv("INGEST_RECONNECT_MAX_DELAY", 300))
+
+ENSURE_SQL = """
+    MERGE mailbox_leases WITH (HOLDLOCK) AS t
+    USING (SELECT mailbox, last_uid FROM OPENJSON(?) WITH (mailbox NVARCHAR(400) '$.m', last_uid BIGINT '$.u')) AS s
+       ON t.mailbox = s.mailbox
+    WHEN NOT MATCHED THEN INSERT (mailbox, last_uid) VALUES (s.mailbox, s.last_uid);
+"""
+
+HEARTBEAT_SQL = """
+    MERGE ingest_nodes WITH (HOLDLOCK) AS t
+    USING (SELECT ? AS node_id, ? AS capacity) AS s
+       ON t.node_id = s.node_id
+    WHEN MATCHED THEN UPDATE SET heartbeat_at = SYSUTCDATETIME(), capacity = s.capacity
+    WHEN NOT MATCHED THEN INSERT (node_id, capacity) VALUES (s.node_id, s.capacity);
+"""
+
+LIVE_NODES_SQL = """
+    SELECT COUNT(*) FROM ingest_nodes
+    WHERE heartbeat_at >= DATEADD(SECOND, -?, SYSUTCDATETIME())
+"""
+
+ACQUIRE_SQL = """
+    WITH free AS (
+        SELECT TOP (?) *
+        FROM mailbox_leases WITH (ROWLOCK, UPDLOCK, READPAST)
+        WHERE mailbox IN (SELECT value FROM OPENJSON(?))
+          AND (owner IS NULL OR lease_until < SYSUTCDATETIME())
+        ORDER BY lease_until
+    )
+    UPDATE free
+    SET owner = ?, epoch = epoch + 1,
+        lease_until = DATEADD(SECOND, ?, SYSUTCDATETIME())
+    OUTPUT INSERTED.mailbox, INSERTED.epoch, INSERTED.last_uid, INSERTED.uidvalidity
+"""
+
+RENEW_SQL = """
+    UPDATE mailbox_leases
+    SET lease_until = DATEADD(SECOND, ?, SYSUTCDATETIME())
+    OUTPUT INSERTED.mailbox
+    WHERE owner = ? AND mailbox IN (SELECT value FROM OPENJSON(?))
+"""
+
+CHECKPOINT_SQL = """
+    UPDATE mailbox_leases
+    SET last_uid = ?, uidvalidity = ?, checkpoint_at = SYSUTCDATETIME()
+    WHERE mailbox = ? AND owner = ? AND epoch = ?
+"""
+
+RELEASE_SQL = """
+    UPDATE mailbox_leases
+    SET owner = NULL, lease_until = NULL
+    WHERE mailbox = ? AND owner = ? AND epoch = ?
+"""
+
+
+def _execute(sql, params, fetch=False):
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        rows = cur.fetchall() if fetch else None
+        count = cur.rowcount
+        conn.commit()
+        return rows if fetch else count
+    finally:
+        conn.close()
+
+
+# ------------------------------------------------------------
+# Mailbox configuration
+# ------------------------------------------------------------
+class Mailbox:
+    def __init__(self, address, password, server, port, folder):
+        self.address = address
+        self.password = password
+        self.server = server
+        self.port = int(port)
+        self.folder = folder
+        # same key the ingest ledger uses for this folder
+        self.key = f"{address}/{folder}"
+
+    def connect(self):
+        mail = imaplib.IMAP4_SSL(self.server, self.port)
+        mail.login(self.address, self.password)
+        folder = self.folder if self.folder.isalnum() else '"' + self.folder.replace('"', '\\"') + '"'
+        status, data = mail.select(folder)
+        if status != "OK":
+            mail.logout()
+            raise RuntimeError(f"SELECT {self.folder} failed: {data}")
+        return mail
+
+
+def load_mailboxes(config=INGEST_MAILBOXES):
+    if not config:
+        return [Mailbox(email_reader.EMAIL, email_reader.PASSWORD, email_reader.SERVER,
+                        email_reader.PORT, "INBOX")]
+    if os.path.exists(config):
+        with open(config, "r") as f:
+            entries = json.load(f)
+    else:
+        entries = json.loads(config)
+    mailboxes = []
+    for entry in entries:
+        password = entry.get("password") or os.getenv(entry.get("password_env", ""), "")
+        for folder in entry.get("folders") or ["INBOX"]:
+            mailboxes.append(Mailbox(
+                entry["address"], password,
+                entry.get("server", email_reader.SERVER), entry.get("port", email_reader.PORT),
+                folder,
+            ))
+    return mailboxes
+
+
+# ------------------------------------------------------------
+# Leases
+# ------------------------------------------------------------
+class Lease:
+    """One owned mailbox; the epoch fences checkpoint writes."""
+
+    def __init__(self, mailbox, node_id, epoch, last_uid, uidvalidity):
+        self.mailbox = mailbox
+        self.node_id = node_id
+        self.epoch = epoch
+        self.last_uid = int(last_uid or 0)
+        self.uidvalidity = int(uidvalidity or 0)
+        self.lost = threading.Event()
+
+    def save_checkpoint(self, uid):
+        if self.lost.is_set():
+            return
+        try:
+            updated = _execute(CHECKPOINT_SQL, (int(uid), self.uidvalidity, self.mailbox.key,
+                                                self.node_id, self.epoch))
+        except Exception as e:
+            # the next checkpoint covers this one
+            print(f"❌ Could not save checkpoint {uid} for {self.mailbox.key}:", e)
+            return
+        if updated == 0:
+            print(f"⚠ Lease on {self.mailbox.key} was taken over; stopping its worker")
+            self.lost.set()
+            return
+        self.last_uid = int(uid)
+
+    def release(self):
+        try:
+            _execute(RELEASE_SQL, (self.mailbox.key, self.node_id, self.epoch))
+        except Exception as e:
+            print(f"❌ Could not release {self.mailbox.key} (its lease will expire):", e)
+
+
+class MailboxWorker(threading.Thread):
+    """Drains one leased mailbox in a poll loop until stopped or the lease is lost."""
+
+    def __init__(self, lease, stop_event):
+        super().__init__(name=f"ingest-{lease.mailbox.key}", daemon=True)
+        self.lease = lease
+        self.stop_event = stop_event
+
+    def _stopped(self):
+        return self.stop_event.is_set() or self.lease.lost.is_set()
+
+    def _wait(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self._stopped() and time.monotonic() < deadline:
+            self.stop_event.wait(min(1.0, deadline - time.monotonic()))
+
+    def run(self):
+        lease, delay = self.lease, 1.0
+        try:
+            while not self._stopped():
+                mail = None
+                try:
+                    mail = lease.mailbox.connect()
+                    validity = ingest_ledger.uidvalidity(mail)
+                    if validity and lease.uidvalidity and validity != lease.uidvalidity:
+                        # the server renumbered the folder; old UIDs mean nothing now
+                        print(f"⚠ UIDVALIDITY of {lease.mailbox.key} changed, starting from UID 0")
+                        lease.last_uid = 0
+                    lease.uidvalidity = validity or lease.uidvalidity
+                    ledger = ingest_ledger.open_ledger(mail, lease.mailbox.key, lease.uidvalidity)
+                    print(f"📬 {lease.mailbox.key}: owned by {lease.node_id} (epoch {lease.epoch}, "
+                          f"last UID {lease.last_uid})")
+                    delay = 1.0
+                    while not self._stopped():
+                        email_reader.drain_mailbox(mail, lease.last_uid, lease.save_checkpoint, ledger)
+                        self._wait(INGEST_POLL_INTERVAL)
+                except Exception as e:
+                    print(f"❌ {lease.mailbox.key} session error:", e)
+                    self._wait(random.uniform(0.5, 1.5) * delay)
+                    delay = min(delay * 2, INGEST_RECONNECT_MAX_DELAY)
+                finally:
+                    if mail is not None:
+                        try:
+                            mail.logout()
+                        except Exception:
+                            pass
+        finally:
+            if not lease.lost.is_set():
+                lease.release()
+
+
+# ------------------------------------------------------------
+# Node
+# ------------------------------------------------------------
+class Coordinator:
+    def __init__(self, mailboxes=None, node_id=INGEST_NODE_ID, capacity=INGEST_NODE_CAPACITY):
+        self.mailboxes = {m.key: m for m in (mailboxes or load_mailboxes())}
+        self.node_id = node_id
+        self.capacity = capacity
+        self.workers = {}   # mailbox key -> MailboxWorker
+        self.stop_event = threading.Event()
+
+    def register(self):
+        # the single-inbox setup carries its file checkpoint over
+        seed = {f"{email_reader.EMAIL}/INBOX": email_reader.get_last_uid()}
+        _execute(ENSURE_SQL, (json.dumps([{"m": key, "u": seed.get(key, 0)} for key in self.mailboxes]),))
+
+    def fair_share(self):
+        rows = _execute(LIVE_NODES_SQL, (INGEST_MAILBOX_LEASE_SECONDS,), fetch=True)
+        live = max(1, rows[0][0])
+        return min(self.capacity, math.ceil(len(self.mailboxes) / live))
+
+    def _reap(self):
+        for key, worker in list(self.workers.items()):
+            if not worker.is_alive():
+                del self.workers[key]
+
+    def _renew(self):
+        if not self.workers:
+            return
+        rows = _execute(RENEW_SQL, (INGEST_MAILBOX_LEASE_SECONDS, self.node_id, json.dumps(list(self.workers))),
+                        fetch=True)
+        held = {r[0] for r in rows}
+        for key, worker in self.workers.items():
+            if key not in held and not worker.lease.lost.is_set():
+                print(f"⚠ Lost the lease on {key}; stopping its worker")
+                worker.lease.lost.set()
+
+    def _acquire(self, count):
+        free = [k for k in self.mailboxes if k not in self.workers]
+        if count <= 0 or not free:
+            return
+        rows = _execute(ACQUIRE_SQL, (count, json.dumps(free), self.node_id, INGEST_MAILBOX_LEASE_SECONDS),
+                        fetch=True)
+        for key, epoch, last_uid, validity in rows:
+            worker = MailboxWorker(Lease(self.mailboxes[key], self.node_id, epoch, last_uid, validity), threading.Event())
+            self.workers[key] = worker
+            worker.start()
+
+    def _shed(self, count):
+        """Stop `count` running workers; each releases its lease when it exits."""
+        # a worker already stopping (shed earlier, or its lease lost) frees
+        # nothing more, so it must not use up one of the `count` slots
+        running = [key for key, worker in self.workers.items() if not worker._stopped()]
+        for key in running[:max(0, count)]:
+            print(f"↪ Handing {key} back for rebalancing")
+            self.workers[key].stop_event.set()
+
+    def tick(self):
+        """One heartbeat: renew, rebalance, claim."""
+        _execute(HEARTBEAT_SQL, (self.node_id, self.capacity))
+        self._reap()
+        self._renew()
+        share = self.fair_share()
+        active = [w for w in self.workers.values() if not w._stopped()]
+        if len(active) > share:
+            self._shed(len(active) - share)
+        else:
+            self._acquire(share - len(self.workers))
+
+    def run(self):
+        self.register()
+        print(f"🧭 Ingest node {self.node_id}: {len(self.mailboxes)} mailboxes, capacity {self.capacity}")
+        while not self.stop_event.is_set():
+            try:
+                self.tick()
+            except Exception as e:
+                print("❌ Coordinator heartbeat failed:", e)
+            self.stop_event.wait(INGEST_HEARTBEAT_SECONDS)
+        self.shutdown()
+
+    def shutdown(self, timeout=30):
+        for worker in self.workers.values():
+            worker.stop_event.set()
+        for worker in self.workers.values():
+            worker.join(timeout)
+        self.workers.clear()
+
+    def stop(self):
+        self.stop_event.set()
+
+
+def status():
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT mailbox, owner, lease_until, epoch, last_uid, checkpoint_at,
+                   CASE WHEN lease_until >= SYSUTCDATETIME() THEN 1 ELSE 0 END
+            FROM mailbox_leases ORDER BY mailbox
+        """)
+        return cur.fetchall()
+    finally:
+        conn.close()
+
+
+def main():
+    coordinator = Coordinator()
+    try:
+        coordinator.run()
+    except KeyboardInterrupt:
+        coordinator.stop()
+        coordinator.shutdown()
+    email_reader.print_ingest_stats()
+
+
+if __name__ == "__main__":
+    if "--status" in sys.argv[1:]:
+        for mailbox, owner, lease_until, epoch, last_uid, checkpoint_at, live in status():
+            holder = f"{owner} until {lease_until}" if live else "unowned"
+            print(f"{mailbox}: {holder}, epoch {epoch}, last UID {last_uid} (saved {checkpoint_at})")
+    else:
+        main()
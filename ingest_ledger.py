@@ -0,0 +1,260 @@
+# ingest_ledger.py
+"""
+Per-message ingest ledger (ingest_ledger table, migration 0008).
+
+Every UID a worker takes on gets a row keyed by (mailbox, UIDVALIDITY,
+uid) and moves through
+
+    claimed -> fetched -> classified -> written
+                                     \\-> failed -> (retried with backoff) ... -> dead
+
+A worker claims a batch with one MERGE before fetching it. The claim
+fails for UIDs that are already written, dead, or leased by another
+live worker. So several email_reader / daemon processes can share a
+mailbox without processing a message twice. A lease that runs out
+(the worker crashed) makes the UID claimable again.
+
+Failed UIDs stay behind the checkpoint. Each run picks up the ones whose
+backoff has passed (due_retries) alongside the new mail. After
+INGEST_MAX_ATTEMPTS they are parked as 'dead' for a human to look at:
+
+    python ingest_ledger.py            counts per state
+    python ingest_ledger.py --dead     list dead UIDs with their last error
+
+INGEST_SHARD=i/n makes a worker consider only UIDs with uid % n == i.
+Shards never contend, and each keeps its own checkpoint file.
+"""
+import os
+import sys
+import json
+import socket
+
+from db_writer import get_connection
+
+INGEST_LEDGER = os.getenv("INGEST_LEDGER", "1") == "1"
+INGEST_WORKER_ID = os.getenv("INGEST_WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}"
+INGEST_SHARD = os.getenv("INGEST_SHARD", "0/1")
+# must cover one fetch batch going through the queue, LLM and writer
+INGEST_LEASE_SECONDS = int(os.getenv("INGEST_LEASE_SECONDS", 600))
+INGEST_MAX_ATTEMPTS = int(os.getenv("INGEST_MAX_ATTEMPTS", 5))
+INGEST_RETRY_BASE = int(os.getenv("INGEST_RETRY_BASE", 60))
+INGEST_RETRY_MAX = int(os.getenv("INGEST_RETRY_MAX", 6 * 3600))
+INGEST_RETRY_BATCH = int(os.getenv("INGEST_RETRY_BATCH", 200))
+
+IN_FLIGHT = ("claimed", "fetched", "classified")
+
+CLAIM_SQL = """
+    MERGE ingest_ledger WITH (HOLDLOCK) AS t
+    USING (
+        SELECT ? AS mailbox, ? AS uidvalidity, j.uid
+        FROM OPENJSON(?) WITH (uid BIGINT '$') j
+    ) AS s
+       ON t.mailbox = s.mailbox AND t.uidvalidity = s.uidvalidity AND t.uid = s.uid
+    WHEN MATCHED AND (
+            (t.state = 'failed' AND t.next_attempt_at <= SYSUTCDATETIME())
+         OR (t.state IN ('claimed', 'fetched', 'classified') AND t.locked_until < SYSUTCDATETIME())
+    ) THEN UPDATE SET
+        state = 'claimed', attempts = t.attempts + 1, locked_by = ?,
+        locked_until = DATEADD(SECOND, ?, SYSUTCDATETIME()), updated_at = SYSUTCDATETIME()
+    WHEN NOT MATCHED THEN
+        INSERT (mailbox, uidvalidity, uid, state, attempts, locked_by, locked_until)
+        VALUES (s.mailbox, s.uidvalidity, s.uid, 'claimed', 1, ?, DATEADD(SECOND, ?, SYSUTCDATETIME()))
+    OUTPUT INSERTED.uid;
+"""
+
+DUE_SQL = """
+    SELECT TOP (?) uid
+    FROM ingest_ledger
+    WHERE mailbox = ? AND uidvalidity = ?
+      AND ((state = 'failed' AND next_attempt_at <= SYSUTCDATETIME())
+        OR (state IN ('claimed', 'fetched', 'classified') AND locked_until < SYSUTCDATETIME()))
+      AND uid % ? = ?
+    ORDER BY uid
+"""
+
+# only rows this worker still holds; a lease taken over by someone else is left alone
+_OWNED = """
+    WHERE mailbox = ? AND uidvalidity = ? AND locked_by = ?
+      AND uid IN (SELECT uid FROM OPENJSON(?) WITH (uid BIGINT '$'))
+"""
+
+PROGRESS_SQL = """
+    UPDATE ingest_ledger
+    SET state = ?, locked_until = DATEADD(SECOND, ?, SYSUTCDATETIME()), updated_at = SYSUTCDATETIME()
+""" + _OWNED
+
+WRITTEN_SQL = """
+    UPDATE ingest_ledger
+    SET state = 'written', locked_by = NULL, locked_until = NULL, last_error = NULL,
+        updated_at = SYSUTCDATETIME()
+""" + _OWNED
+
+# backoff doubles per attempt: base * 2^(attempts-1), capped at INGEST_RETRY_MAX
+FAILED_SQL = """
+    UPDATE ingest_ledger
+    SET state = CASE WHEN ? = 1 OR attempts >= ? THEN 'dead' ELSE 'failed' END,
+        next_attempt_at = DATEADD(SECOND,
+            CAST(CASE WHEN ? * POWER(2.0, attempts - 1) > ? THEN ? ELSE ? * POWER(2.0, attempts - 1) END AS INT),
+            SYSUTCDATETIME()),
+        locked_by = NULL, locked_until = NULL, last_error = ?, updated_at = SYSUTCDATETIME()
+""" + _OWNED
+
+
+# ------------------------------------------------------------
+# Sharding
+# ------------------------------------------------------------
+def parse_shard(value):
+    """'2/4' -> (2, 4); anything invalid means a single shard."""
+    try:
+        index, count = (int(x) for x in str(value).split("/", 1))
+    except ValueError:
+        return 0, 1
+    if count < 1 or not 0 <= index < count:
+        return 0, 1
+    return index, count
+
+
+SHARD_INDEX, SHARD_COUNT = parse_shard(INGEST_SHARD)
+
+
+def owns(uid):
+    return int(uid) % SHARD_COUNT == SHARD_INDEX
+
+
+def checkpoint_file(base):
+    """Per-shard checkpoint: last_uid.txt -> last_uid.shard1of4.txt"""
+    if SHARD_COUNT == 1:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.shard{SHARD_INDEX}of{SHARD_COUNT}{ext}"
+
+
+def is_permanent(error):
+    """The message is gone from the mailbox; retrying cannot help."""
+    return isinstance(error, LookupError)
+
+
+# ------------------------------------------------------------
+# Ledger
+# ------------------------------------------------------------
+class Ledger:
+    """Ledger rows of one mailbox generation (name + UIDVALIDITY) for this worker."""
+
+    def __init__(self, mailbox, uidvalidity, worker_id=INGEST_WORKER_ID):
+        self.mailbox = mailbox
+        self.uidvalidity = int(uidvalidity)
+        self.worker_id = worker_id
+
+    def _execute(self, sql, params, fetch=False):
+        conn = get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(sql, params)
+            rows = cur.fetchall() if fetch else None
+            conn.commit()
+            return rows
+        finally:
+            conn.close()
+
+    def _owned(self, uids):
+        return (self.mailbox, self.uidvalidity, self.worker_id, json.dumps([int(u) for u in uids]))
+
+    def claim(self, uids):
+        """The subset of uids this worker now holds a lease on."""
+        uids = [int(u) for u in uids]
+        if not uids:
+            return []
+        rows = self._execute(CLAIM_SQL, (
+            self.mailbox, self.uidvalidity, json.dumps(uids),
+            self.worker_id, INGEST_LEASE_SECONDS,
+            self.worker_id, INGEST_LEASE_SECONDS,
+        ), fetch=True)
+        claimed = {int(r[0]) for r in rows}
+        return [u for u in uids if u in claimed]
+
+    def due_retries(self, limit=INGEST_RETRY_BATCH):
+        """Failed UIDs past their backoff, and UIDs whose worker's lease ran out."""
+        rows = self._execute(DUE_SQL, (limit, self.mailbox, self.uidvalidity, SHARD_COUNT, SHARD_INDEX),
+                             fetch=True)
+        return [int(r[0]) for r in rows]
+
+    def mark(self, state, uids, error=None):
+        """Record progress; 'failed' schedules a retry (or parks the UID as dead)."""
+        uids = [int(u) for u in uids]
+        if not uids:
+            return
+        if state == "written":
+            self._execute(WRITTEN_SQL, self._owned(uids))
+        elif state == "failed":
+            self._execute(FAILED_SQL, (
+                1 if is_permanent(error) else 0, INGEST_MAX_ATTEMPTS,
+                INGEST_RETRY_BASE, INGEST_RETRY_MAX, INGEST_RETRY_MAX, INGEST_RETRY_BASE,
+                str(error)[:2000],
+            ) + self._owned(uids))
+        else:
+            # every step renews the lease
+            self._execute(PROGRESS_SQL, (state, INGEST_LEASE_SECONDS) + self._owned(uids))
+
+    def counts(self):
+        rows = self._execute("""
+            SELECT state, COUNT(*) FROM ingest_ledger
+            WHERE mailbox = ? AND uidvalidity = ?
+            GROUP BY state
+        """, (self.mailbox, self.uidvalidity), fetch=True)
+        return {r[0]: r[1] for r in rows}
+
+
+def uidvalidity(mail):
+    """UIDVALIDITY of the selected mailbox (0 if the server did not say)."""
+    try:
+        _, data = mail.response("UIDVALIDITY")
+        return int(data[0]) if data and data[0] else 0
+    except Exception:
+        return 0
+
+
+def open_ledger(mail, mailbox, validity=None):
+    """
+    Ledger for the mailbox selected on `mail`, or None when INGEST_LEDGER
+    is off or migration 0008 has not been applied. Pass validity when the
+    caller already read UIDVALIDITY (imaplib hands it out only once).
+    """
+    if not INGEST_LEDGER:
+        return None
+    try:
+        conn = get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT OBJECT_ID('ingest_ledger', 'U')")
+            exists = cur.fetchone()[0] is not None
+        finally:
+            conn.close()
+    except Exception as e:
+        print("❌ Ingest ledger unavailable:", e)
+        return None
+    if not exists:
+        print("ℹ ingest_ledger table missing (run migrations.py); ingesting without a ledger")
+        return None
+    return Ledger(mailbox, uidvalidity(mail) if validity is None else validity)
+
+
+if __name__ == "__main__":
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        if "--dead" in sys.argv[1:]:
+            cur.execute("""
+                SELECT mailbox, uidvalidity, uid, attempts, updated_at, last_error
+                FROM ingest_ledger WHERE state = 'dead' ORDER BY mailbox, uid
+            """)
+            for mailbox, validity, uid, attempts, updated_at, error in cur.fetchall():
+                print(f"{mailbox} [{validity}] UID {uid}: {attempts} attempts, {updated_at}: {error}")
+        else:
+            cur.execute("""
+                SELECT mailbox, uidvalidity, state, COUNT(*) FROM ingest_ledger
+                GROUP BY mailbox, uidvalidity, state ORDER BY mailbox, uidvalidity, state
+            """)
+            for mailbox, validity, state, n in cur.fetchall():
+                print(f"{mailbox} [{validity}] {state:<10} {n}")
+    finally:
+        conn.close()
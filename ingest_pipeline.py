@@ -0,0 +1,365 @@
+# ingest_pipeline.py
+import os
+import re
+import queue
+import threading
+
+import metrics
+import mime_reader
+from mime_reader import IMAP_FETCH_MODE
+
+FETCH_BATCH_SIZE = int(os.getenv("IMAP_FETCH_BATCH", 50))
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", 4))
+INGEST_QUEUE_SIZE = int(os.getenv("INGEST_QUEUE_SIZE", 100))
+# BODY.PEEK[] downloads the same bytes as RFC822 but does not set \Seen
+IMAP_FETCH_PEEK = os.getenv("IMAP_FETCH_PEEK", "0") == "1"
+
+_UID_RE = re.compile(rb"UID (\d+)")
+_STOP = object()
+_SKIPPED = object()
+# a UID that will produce no result (its claim failed); only unblocks in-order writes
+_DROPPED = object()
+
+
+# ------------------------------------------------------------
+# Batched FETCH
+# ------------------------------------------------------------
+def parse_fetch_response(data):
+    """
+    Turn an imaplib FETCH response into {uid: raw_bytes}.
+    imaplib returns (b'7 (UID 123 RFC822 {4512}', b'<message>') tuples
+    separated by b')' items; some servers put the UID after the literal.
+    """
+    messages = {}
+    for i, part in enumerate(data or []):
+        if not isinstance(part, tuple) or len(part) < 2:
+            continue
+        meta, payload = part[0], part[1]
+        match = _UID_RE.search(meta or b"")
+        if not match and i + 1 < len(data) and isinstance(data[i + 1], bytes):
+            match = _UID_RE.search(data[i + 1])
+        if match:
+            messages[int(match.group(1))] = payload
+    return messages
+
+
+def fetch_chunk(mail, uids, peek=IMAP_FETCH_PEEK, mode=IMAP_FETCH_MODE):
+    """
+    {uid: message} for one batch. In "structure" mode a message is a
+    mime_reader.PartialMessage (headers + bounded text body, attachments
+    never downloaded); messages it cannot handle, and everything in
+    "full" mode, come back as raw RFC822 bytes.
+    """
+    uids = [int(u) for u in uids]
+    messages, rest = {}, uids
+    if mode == "structure":
+        with metrics.timed("imap_seconds", op="fetch_structure"):
+            messages, rest = mime_reader.fetch_partial(mail, uids, peek)
+        metrics.inc("imap_fetched_bytes_total", sum(m.fetched_bytes for m in messages.values()),
+                    mode="structure")
+    if rest:
+        item = "(UID BODY.PEEK[])" if peek else "(UID RFC822)"
+        uid_set = ",".join(str(u) for u in rest)
+        with metrics.timed("imap_seconds", op="fetch"):
+            status, data = mail.uid("fetch", uid_set, item)
+        if status != "OK":
+            raise RuntimeError(f"UID FETCH {uid_set} failed: {status}")
+        full = parse_fetch_response(data)
+        metrics.inc("imap_fetched_bytes_total", sum(len(r) for r in full.values()), mode="full")
+        messages.update(full)
+    metrics.inc("imap_fetched_messages_total", len(uids))
+    return messages
+
+
+def fetch_batches(mail, uids, batch_size=FETCH_BATCH_SIZE, peek=IMAP_FETCH_PEEK, mode=IMAP_FETCH_MODE):
+    """
+    Yield (uids_in_batch, {uid: message}) using multi-message UID FETCHes
+    per batch instead of one round-trip per message (see fetch_chunk).
+    """
+    for i in range(0, len(uids), batch_size):
+        chunk = [int(u) for u in uids[i:i + batch_size]]
+        yield chunk, fetch_chunk(mail, chunk, peek, mode)
+
+
+# ------------------------------------------------------------
+# Checkpoint watermark
+# ------------------------------------------------------------
+class UidWatermark:
+    """
+    Tracks completion of a known, ordered set of UIDs. The watermark only
+    moves to uid N once every UID <= N in the set has been marked done,
+    so a crash never skips a message that was still in flight.
+    """
+
+    def __init__(self, uids):
+        self._order = sorted(int(u) for u in uids)
+        self._done = set()
+        self._pos = 0
+        self._lock = threading.Lock()
+        self.value = None
+
+    def mark_done(self, uid):
+        """Return the new watermark if it advanced, else None."""
+        with self._lock:
+            self._done.add(int(uid))
+            advanced = False
+            while self._pos < len(self._order) and self._order[self._pos] in self._done:
+                self._done.discard(self._order[self._pos])
+                self.value = self._order[self._pos]
+                self._pos += 1
+                advanced = True
+            return self.value if advanced else None
+
+
+class UidReorder:
+    """
+    Hands results to the writer in UID order: a result waits until every
+    lower UID of the set has arrived, so an original is written before
+    the replies that were classified ahead of it. Writer thread only.
+    """
+
+    def __init__(self, uids):
+        self._order = sorted(int(u) for u in uids)
+        self._held = {}
+        self._pos = 0
+
+    def push(self, jobs):
+        """Add (uid, item, error) results; return the ones now due, in order."""
+        for job in jobs:
+            self._held[int(job[0])] = job
+        due = []
+        while self._pos < len(self._order) and self._order[self._pos] in self._held:
+            due.append(self._held.pop(self._order[self._pos]))
+            self._pos += 1
+        return due
+
+    def flush(self):
+        """Everything still held (a UID never arrived), in UID order."""
+        due = [self._held[uid] for uid in sorted(self._held)]
+        self._held.clear()
+        return due
+
+
+# ------------------------------------------------------------
+# Pipeline: fetcher -> N workers -> single writer
+# ------------------------------------------------------------
+def run_pipeline(mail, uids, process, write, on_checkpoint=None,
+                 batch_size=FETCH_BATCH_SIZE, workers=INGEST_WORKERS,
+                 queue_size=INGEST_QUEUE_SIZE, peek=IMAP_FETCH_PEEK,
+                 process_batch=None, group_size=1,
+                 write_batch=None, write_group_size=50,
+                 claim=None, on_state=None, in_order=False):
+    """
+    - process(uid, message) -> item     runs on the worker pool (parse/LLM);
+                                        message is raw bytes or a PartialMessage
+    - write(uid, item)                  runs on one writer thread (DB)
+    - on_checkpoint(uid)                called with the contiguous watermark
+    - process_batch([(uid, raw), ...]) -> [item or Exception, ...]
+                                        optional; workers then take up to
+                                        group_size queued messages at once
+    - write_batch([(uid, item), ...]) -> [(uid, error), ...] or None
+                                        optional; the writer then commits up
+                                        to write_group_size finished items
+                                        per call (one DB transaction) and
+                                        fails the UIDs it returns. If it
+                                        raises, the group is retried item
+                                        by item through write()
+    - claim([uid, ...]) -> [uid, ...]   optional; called before each FETCH
+                                        batch, UIDs it does not return are
+                                        skipped (owned by another worker)
+    - on_state(state, [uid, ...], error=None)
+                                        optional ledger hook: "fetched",
+                                        "classified", "written", "failed"
+    - in_order                          write results in UID order instead
+                                        of as workers finish them (a result
+                                        waits for the lower UIDs)
+
+    With on_state set, a failed UID only counts as done for the checkpoint
+    once its failure is recorded (the ledger retries it later); a UID whose
+    claim or failure could not be recorded holds the checkpoint back.
+    The IMAP connection is only touched from the calling thread.
+    Returns a small summary dict.
+    """
+    work_q = queue.Queue(maxsize=queue_size)
+    result_q = queue.Queue(maxsize=queue_size)
+    watermark = UidWatermark(uids)
+    summary = {"found": len(uids), "fetched": 0, "written": 0, "failed": 0, "skipped": 0, "checkpoint": None}
+    summary_lock = threading.Lock()
+
+    def count(key, n=1):
+        with summary_lock:
+            summary[key] += n
+
+    def record(state, uid_list, error=None):
+        """on_state, logged instead of raised; returns False if it failed."""
+        if on_state is None or not uid_list:
+            return True
+        try:
+            on_state(state, uid_list, error)
+            return True
+        except Exception as e:
+            print(f"❌ Could not record {state} for UIDs {uid_list}:", e)
+            return False
+
+    def worker():
+        while True:
+            job = work_q.get()
+            if job is _STOP:
+                return
+            if process_batch is None:
+                uid, raw = job
+                try:
+                    item = process(uid, raw)
+                except Exception as e:
+                    result_q.put((uid, None, e))
+                    continue
+                record("classified", [uid])
+                result_q.put((uid, item, None))
+                continue
+
+            # only groups what is already queued, so a quiet inbox adds no latency
+            jobs, stop = [job], False
+            while len(jobs) < group_size:
+                try:
+                    nxt = work_q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _STOP:
+                    stop = True
+                    break
+                jobs.append(nxt)
+            try:
+                items = process_batch(jobs)
+            except Exception as e:
+                items = [e] * len(jobs)
+            record("classified", [uid for (uid, _), item in zip(jobs, items) if not isinstance(item, Exception)])
+            for (uid, _), item in zip(jobs, items):
+                if isinstance(item, Exception):
+                    result_q.put((uid, None, item))
+                else:
+                    result_q.put((uid, item, None))
+            if stop:
+                return
+
+    reorder = UidReorder(uids) if in_order else None
+
+    def writer():
+        stop = False
+        while not stop:
+            job = result_q.get()
+            jobs = []
+            if job is _STOP:
+                stop = True
+            else:
+                jobs.append(job)
+            while not stop and write_batch is not None and len(jobs) < write_group_size:
+                try:
+                    nxt = result_q.get_nowait()
+                except queue.Empty:
+                    break
+                if nxt is _STOP:
+                    stop = True
+                    break
+                jobs.append(nxt)
+
+            if reorder is not None:
+                jobs = reorder.push(jobs) + (reorder.flush() if stop else [])
+            jobs = [j for j in jobs if j[1] is not _DROPPED]
+            size = write_group_size if write_batch is not None else 1
+            for i in range(0, len(jobs), size):
+                write_group(jobs[i:i + size])
+
+    def write_group(jobs):
+        """Write one group and advance the checkpoint past it."""
+        ready, failed, written = [], [], []
+        for uid, item, error in jobs:
+            if item is _SKIPPED:
+                count("skipped")
+            elif error is not None:
+                print(f"Failed to process UID {uid}:", error)
+                failed.append((uid, error))
+            else:
+                ready.append((uid, item))
+
+        if write_batch is not None and ready:
+            try:
+                rejected = dict(write_batch(ready) or ())
+                for uid, _ in ready:
+                    if uid in rejected:
+                        print(f"Failed to write UID {uid}:", rejected[uid])
+                        failed.append((uid, rejected[uid]))
+                    else:
+                        written.append(uid)
+                ready = []
+            except Exception as e:
+                # write the group one email at a time so a single bad item
+                # fails alone
+                print(f"Batch write of UIDs {[u for u, _ in ready]} failed, retrying one by one:", e)
+        for uid, item in ready:
+            try:
+                write(uid, item)
+                written.append(uid)
+            except Exception as e:
+                print(f"Failed to write UID {uid}:", e)
+                failed.append((uid, e))
+
+        count("written", len(written))
+        count("failed", len(failed))
+        record("written", written)
+        held = set()
+        for uid, error in failed:
+            if not record("failed", [uid], error):
+                held.add(uid)
+
+        for uid, _, _ in jobs:
+            if uid in held:
+                continue
+            advanced = watermark.mark_done(uid)
+            if advanced is not None:
+                summary["checkpoint"] = advanced
+                if on_checkpoint:
+                    on_checkpoint(advanced)
+
+    worker_threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, workers))]
+    writer_thread = threading.Thread(target=writer, daemon=True)
+    for t in worker_threads:
+        t.start()
+    writer_thread.start()
+
+    try:
+        for i in range(0, len(uids), batch_size):
+            chunk = [int(u) for u in uids[i:i + batch_size]]
+            if claim is not None:
+                try:
+                    owned = set(claim(chunk))
+                except Exception as e:
+                    # not marked done either: the checkpoint stays before these
+                    print(f"❌ Could not claim UIDs {chunk[0]}-{chunk[-1]}:", e)
+                    for uid in chunk:
+                        result_q.put((uid, _DROPPED, None))
+                    continue
+                for uid in chunk:
+                    if uid not in owned:
+                        result_q.put((uid, _SKIPPED, None))
+                chunk = [u for u in chunk if u in owned]
+                if not chunk:
+                    continue
+            messages = fetch_chunk(mail, chunk, peek)
+            record("fetched", [u for u in chunk if u in messages])
+            for uid in chunk:
+                raw = messages.get(uid)
+                if raw is None:
+                    # expunged between SEARCH and FETCH: nothing to do
+                    result_q.put((uid, None, LookupError("message not returned by FETCH")))
+                    continue
+                count("fetched")
+                work_q.put((uid, raw))
+    finally:
+        for _ in worker_threads:
+            work_q.put(_STOP)
+        for t in worker_threads:
+            t.join()
+        result_q.put(_STOP)
+        writer_thread.join()
+
+    return summary
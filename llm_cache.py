@@ -0,0 +1,179 @@
+# llm_cache.py
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "1") == "1"
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "llm_cache.sqlite3")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", 7 * 24 * 3600))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", 50000))
+LLM_CACHE_MEMORY_ENTRIES = int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", 2000))
+
+_SUBJECT_PREFIX_RE = re.compile(r"^(?:\s*(?:re|fw|fwd|aw|wg|tr)\s*:\s*)+", re.IGNORECASE)
+_WS_RE = re.compile(r"\s+")
+
+
+# ------------------------------------------------------------
+# Keys
+# ------------------------------------------------------------
+def normalize_subject(subject):
+    """'RE: Fwd:  VPN  down' and 'vpn down' are the same request."""
+    return _WS_RE.sub(" ", _SUBJECT_PREFIX_RE.sub("", subject or "")).strip().casefold()
+
+
+def normalize_body(body):
+    """Whitespace/case-insensitive; quoting markers ('> ') are dropped."""
+    lines = (line.lstrip("> \t") for line in (body or "").splitlines())
+    return _WS_RE.sub(" ", " ".join(lines)).strip().casefold()
+
+
+def make_key(kind, prompt_version, model, subject, body):
+    h = hashlib.sha256()
+    for part in (kind, prompt_version, model, normalize_subject(subject), normalize_body(body)):
+        h.update(part.encode("utf-8", errors="ignore"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+# ------------------------------------------------------------
+# Two-level cache: in-process LRU in front of a SQLite file
+# ------------------------------------------------------------
+class LLMCache:
+    """
+    Bounded LRU + TTL cache for JSON-serializable LLM results.
+    The SQLite file survives restarts of the email_reader process;
+    hits from the in-memory front never touch disk or network.
+    The disk size bound is enforced every 100 stores.
+    """
+
+    def __init__(self, path=LLM_CACHE_PATH, ttl=LLM_CACHE_TTL,
+                 max_entries=LLM_CACHE_MAX_ENTRIES, memory_entries=LLM_CACHE_MEMORY_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_entries = memory_entries
+        # key -> (json payload, created_at); decoding per hit hands every
+        # caller its own copy, so mutating a result cannot poison the cache
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS ix_llm_cache_last_access ON llm_cache(last_access)")
+        self._db.commit()
+        self._stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0, "stores": 0, "expired": 0, "evicted": 0}
+
+    def _fresh(self, created_at, now):
+        return not self.ttl or now - created_at < self.ttl
+
+    def _remember(self, key, payload, created_at):
+        self._memory[key] = (payload, created_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if self._fresh(entry[1], now):
+                    self._memory.move_to_end(key)
+                    self._stats["memory_hits"] += 1
+                    return json.loads(entry[0])
+                del self._memory[key]
+
+            row = self._db.execute(
+                "SELECT value, created_at FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self._stats["misses"] += 1
+                return None
+            if not self._fresh(row[1], now):
+                self._db.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                self._db.commit()
+                self._stats["expired"] += 1
+                self._stats["misses"] += 1
+                return None
+
+            self._db.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self._remember(key, row[0], row[1])
+            self._stats["disk_hits"] += 1
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        now = time.time()
+        payload = json.dumps(value)
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, payload, now, now),
+            )
+            self._stats["stores"] += 1
+            # COUNT(*) is a full index scan, so trim in batches
+            if self._stats["stores"] % 100 == 1:
+                self._evict(now)
+            self._db.commit()
+            self._remember(key, payload, now)
+
+    def _evict(self, now):
+        if self.ttl:
+            cur = self._db.execute("DELETE FROM llm_cache WHERE created_at <= ?", (now - self.ttl,))
+            self._stats["expired"] += max(cur.rowcount, 0)
+        (count,) = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+        overflow = count - self.max_entries
+        if overflow > 0:
+            self._db.execute("""
+                DELETE FROM llm_cache WHERE key IN (
+                    SELECT key FROM llm_cache ORDER BY last_access ASC LIMIT ?
+                )
+            """, (overflow,))
+            self._stats["evicted"] += overflow
+
+    def stats(self):
+        with self._lock:
+            data = dict(self._stats)
+            (data["disk_entries"],) = self._db.execute("SELECT COUNT(*) FROM llm_cache").fetchone()
+            data["memory_entries"] = len(self._memory)
+        lookups = data["memory_hits"] + data["disk_hits"] + data["misses"]
+        data["hit_rate"] = round((data["memory_hits"] + data["disk_hits"]) / lookups, 4) if lookups else 0.0
+        return data
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self._db.execute("DELETE FROM llm_cache")
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Shared cache instance, or None when LLM_CACHE_ENABLED=0."""
+    global _cache
+    if not LLM_CACHE_ENABLED:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = LLMCache()
+    return _cache
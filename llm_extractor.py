@@ -1,36 +1,118 @@
 import torch_patch
+import os
 import json
 import re
-from transformers import AutoTokenizer
-from optimum.onnxruntime import ORTModelForSeq2SeqLM
+import time
+import queue
+import shutil
+import threading
+import multiprocessing
+from concurrent.futures import Future
+import preclassifier
+import metrics
 
 
 # =========================================
 # LLM Extractor using Hugging Face Optimum + ONNXRuntime
 # =========================================
 
-model_name = "google/flan-t5-base"
+model_name = os.getenv("LOCAL_MODEL_NAME", "google/flan-t5-base")
 
-print(f"Loading model '{model_name}' using Optimum ONNXRuntime backend...")
+# exported (and optionally int8-quantized) ONNX files live here so a
+# restart is a load, not a re-export
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", "onnx_models")
+ONNX_QUANTIZE = os.getenv("ONNX_QUANTIZE", "0") == "1"
+LOCAL_BATCH_SIZE = int(os.getenv("LOCAL_BATCH_SIZE", 8))
+# how long the worker waits to fill a micro-batch after the first request
+LOCAL_BATCH_WAIT_MS = float(os.getenv("LOCAL_BATCH_WAIT_MS", 20))
+LOCAL_MAX_INPUT_TOKENS = int(os.getenv("LOCAL_MAX_INPUT_TOKENS", 512))
+LOCAL_MAX_NEW_TOKENS = int(os.getenv("LOCAL_MAX_NEW_TOKENS", 200))
 
-# Load tokenizer
-tokenizer = AutoTokenizer.from_pretrained(model_name)
+tokenizer = None
+model = None
+_load_lock = threading.Lock()
 
-# Load or export ONNX model
-try:
-    model = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True)
-except Exception as e:
-    print("❌ ONNX model load failed:", e)
-    print("Falling back to normal model — please verify optimum installation.")
-    raise SystemExit()
 
-print("✅ Model loaded successfully (ONNXRuntime backend)")
+def _artifact_dir(quantized):
+    name = model_name.replace("/", "--") + ("-int8" if quantized else "")
+    return os.path.join(ONNX_CACHE_DIR, name)
 
-def extract_task_info(subject: str, body: str):
+
+def _export(export_dir):
+    from transformers import AutoTokenizer
+    from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+    print(f"Exporting '{model_name}' to ONNX (one-time) -> {export_dir}")
+    exported = ORTModelForSeq2SeqLM.from_pretrained(model_name, export=True)
+    exported.save_pretrained(export_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(export_dir)
+
+
+def _quantize(export_dir, quant_dir):
+    """Dynamic int8 quantization of every exported ONNX graph."""
+    from optimum.onnxruntime import ORTQuantizer
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+
+    print(f"Quantizing ONNX model to int8 (one-time) -> {quant_dir}")
+    qconfig = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+    os.makedirs(quant_dir, exist_ok=True)
+    for fname in os.listdir(export_dir):
+        src = os.path.join(export_dir, fname)
+        if fname.endswith(".onnx"):
+            ORTQuantizer.from_pretrained(export_dir, file_name=fname).quantize(
+                save_dir=quant_dir, quantization_config=qconfig
+            )
+        elif os.path.isfile(src) and not fname.endswith(".onnx_data"):
+            shutil.copy(src, quant_dir)  # config, tokenizer files
+
+
+def load_model(quantize=ONNX_QUANTIZE):
     """
-    Extract structured project details from email subject and body using FLAN-T5 (ONNX).
+    Load tokenizer + ONNX model once per process, exporting/quantizing into
+    ONNX_CACHE_DIR only if the artifacts are not there yet.
     """
-    prompt = f"""
+    global tokenizer, model
+    with _load_lock:
+        if model is not None:
+            return tokenizer, model
+
+        from transformers import AutoTokenizer
+        from optimum.onnxruntime import ORTModelForSeq2SeqLM
+
+        export_dir = _artifact_dir(False)
+        try:
+            if not os.path.exists(os.path.join(export_dir, "config.json")):
+                _export(export_dir)
+
+            load_dir, kwargs = export_dir, {}
+            if quantize:
+                load_dir = _artifact_dir(True)
+                if not os.path.exists(os.path.join(load_dir, "config.json")):
+                    _quantize(export_dir, load_dir)
+                files = set(os.listdir(load_dir))
+                for arg, stem in (("encoder_file_name", "encoder_model"),
+                                  ("decoder_file_name", "decoder_model"),
+                                  ("decoder_with_past_file_name", "decoder_with_past_model")):
+                    if f"{stem}_quantized.onnx" in files:
+                        kwargs[arg] = f"{stem}_quantized.onnx"
+
+            print(f"Loading model '{model_name}' using Optimum ONNXRuntime backend from {load_dir}...")
+            tokenizer = AutoTokenizer.from_pretrained(load_dir)
+            model = ORTModelForSeq2SeqLM.from_pretrained(load_dir, **kwargs)
+        except Exception as e:
+            print("❌ ONNX model load failed:", e)
+            print("Falling back to normal model — please verify optimum installation.")
+            raise SystemExit()
+
+        print("✅ Model loaded successfully (ONNXRuntime backend)")
+        return tokenizer, model
+
+
+# -----------------------------------------
+# Prompting / parsing
+# -----------------------------------------
+def build_prompt(subject, body):
+    return f"""
     Read the following email and extract task details as JSON.
 
     Subject: {subject}
@@ -41,34 +123,221 @@ def extract_task_info(subject: str, body: str):
     time_required, priority (LOW, MEDIUM, HIGH), status (pending or resolved)
     """
 
-    try:
-        inputs = tokenizer(prompt, return_tensors="pt")
-        outputs = model.generate(**inputs, max_new_tokens=200)
-        text = tokenizer.decode(outputs[0], skip_special_tokens=True)
 
-        # Parse JSON from output
-        match = re.search(r"\{.*\}", text, re.DOTALL)
-        if match:
+def _fallback(subject):
+    return {
+        "owner_email": "",
+        "project_type": subject or "Unknown",
+        "assigned_dept": "IT",
+        "time_required": "",
+        "priority": "MEDIUM",
+        "status": "pending",
+    }
+
+
+def parse_output(text, subject):
+    match = re.search(r"\{.*\}", text or "", re.DOTALL)
+    if match:
+        try:
             data = json.loads(match.group(0))
-        else:
-            data = {
-                "owner_email": "",
-                "project_type": subject or "Unknown",
-                "assigned_dept": "IT",
-                "time_required": "",
-                "priority": "MEDIUM",
-                "status": "pending",
-            }
-
-        return data
+            if isinstance(data, dict):
+                return data
+        except ValueError:
+            pass
+    return _fallback(subject)
+
+
+def generate_batch(prompts, batch_size=LOCAL_BATCH_SIZE, max_new_tokens=LOCAL_MAX_NEW_TOKENS):
+    """
+    Run prompts through model.generate in padded micro-batches. Prompts are
+    sorted by length first so each batch pads to a similar size; results
+    come back in the original order.
+    """
+    tok, mdl = load_model()
+    order = sorted(range(len(prompts)), key=lambda i: len(prompts[i]))
+    outputs = [None] * len(prompts)
+    for start in range(0, len(order), batch_size):
+        idx = order[start:start + batch_size]
+        inputs = tok(
+            [prompts[i] for i in idx],
+            return_tensors="pt",
+            padding=True,
+            truncation=True,
+            max_length=LOCAL_MAX_INPUT_TOKENS,
+        )
+        generated = mdl.generate(**inputs, max_new_tokens=max_new_tokens)
+        for i, text in zip(idx, tok.batch_decode(generated, skip_special_tokens=True)):
+            outputs[i] = text
+    return outputs
 
+
+def extract_task_info_batch(emails):
+    """emails: list of (subject, body). Returns dicts in the same order."""
+    if not emails:
+        return []
+    try:
+        texts = generate_batch([build_prompt(s, b) for s, b in emails])
+        return [parse_output(t, s) for t, (s, _) in zip(texts, emails)]
     except Exception as e:
         print("❌ LLM extraction failed:", e)
-        return {
-            "owner_email": "",
-            "project_type": subject or "Unknown",
-            "assigned_dept": "IT",
-            "time_required": "",
-            "priority": "MEDIUM",
-            "status": "pending",
-        }
+        return [_fallback(s) for s, _ in emails]
+
+
+def extract_task_info(subject: str, body: str):
+    """
+    Extract structured project details from email subject and body using FLAN-T5 (ONNX).
+    """
+    return extract_task_info_batch([(subject, body)])[0]
+
+
+# -----------------------------------------
+# Persistent model worker process
+# -----------------------------------------
+_STOP = None
+
+
+def _worker_main(requests, responses, quantize):
+    """Child process: load once, then serve dynamic micro-batches forever."""
+    try:
+        load_model(quantize)
+    except BaseException as e:  # load_model raises SystemExit on failure
+        responses.put(("error", repr(e)))
+        return
+    responses.put(("ready", None))
+    while True:
+        first = requests.get()
+        if first is _STOP:
+            return
+        batch = [first]
+        deadline = time.monotonic() + LOCAL_BATCH_WAIT_MS / 1000.0
+        while len(batch) < LOCAL_BATCH_SIZE:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = requests.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is _STOP:
+                requests.put(_STOP)  # finish this batch, stop on the next loop
+                break
+            batch.append(item)
+
+        results = extract_task_info_batch([(s, b) for _, s, b in batch])
+        for (req_id, _, _), result in zip(batch, results):
+            responses.put((req_id, result))
+
+
+class InferenceWorker:
+    """
+    Keeps flan-t5 loaded in a separate process. Threads (e.g. the
+    email_reader pipeline workers) submit emails; concurrent submissions are
+    grouped into one generate() call by the worker.
+
+        worker = InferenceWorker()
+        info = worker.extract(subject, body)
+        worker.close()
+    """
+
+    def __init__(self, quantize=ONNX_QUANTIZE, start_timeout=600):
+        ctx = multiprocessing.get_context("spawn")
+        self._requests = ctx.Queue()
+        self._responses = ctx.Queue()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._next_id = 0
+        self._process = ctx.Process(
+            target=_worker_main, args=(self._requests, self._responses, quantize), daemon=True
+        )
+        self._process.start()
+
+        tag, detail = self._responses.get(timeout=start_timeout)
+        if tag != "ready":
+            raise RuntimeError(f"Inference worker failed to start: {detail}")
+        self._reader = threading.Thread(target=self._read_responses, daemon=True)
+        self._reader.start()
+
+    def _read_responses(self):
+        while True:
+            try:
+                req_id, result = self._responses.get(timeout=1.0)
+            except queue.Empty:
+                if not self._process.is_alive():
+                    self._fail_pending(RuntimeError("Inference worker exited"))
+                    return
+                continue
+            with self._lock:
+                future = self._futures.pop(req_id, None)
+            if future is not None:
+                future.set_result(result)
+
+    def _fail_pending(self, error):
+        with self._lock:
+            pending, self._futures = self._futures, {}
+        for future in pending.values():
+            future.set_exception(error)
+
+    def submit(self, subject, body):
+        future = Future()
+        with self._lock:
+            req_id = self._next_id
+            self._next_id += 1
+            self._futures[req_id] = future
+        self._requests.put((req_id, subject, body))
+        return future
+
+    def extract(self, subject, body, timeout=None):
+        return self.submit(subject, body).result(timeout)
+
+    def extract_batch(self, emails, timeout=None):
+        futures = [self.submit(s, b) for s, b in emails]
+        return [f.result(timeout) for f in futures]
+
+    def close(self):
+        self._requests.put(_STOP)
+        self._process.join(timeout=10)
+        if self._process.is_alive():
+            self._process.terminate()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def get_worker():
+    """Shared InferenceWorker for this process (started on first use)."""
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = InferenceWorker()
+        return _worker
+
+
+def classify_and_extract(subject, body, headers=None):
+    """
+    Offline counterpart of llm_groq_extractor.classify_and_extract: status
+    updates are decided by the rule engine, new requests by flan-t5.
+    """
+    verdict = preclassifier.preclassify(subject, body, headers)
+    result = {
+        "is_status_update": False,
+        "task_id": verdict["task_id"],
+        "new_status": verdict["new_status"],
+        "raw_text": f"Subject: {subject}\n\n{body or ''}",
+        "task": None,
+    }
+    if verdict["is_status_update"] and (verdict["certain"] or verdict["new_status"]):
+        result["is_status_update"] = True
+        return result
+
+    with metrics.timed("llm_call_seconds", function="local_extract"):
+        data = get_worker().extract(subject, body)
+    result["task"] = {
+        "project_type": data.get("project_type") or subject or "Unknown",
+        "assigned_dept": data.get("assigned_dept") or "IT",
+        "time_required": data.get("time_required") or "Not specified",
+        "priority": data.get("priority") or "MEDIUM",
+        "status": data.get("status") or "pending",
+        "summary": data.get("summary") or subject or "No summary provided",
+    }
+    return result
@@ -2,22 +2,81 @@
 import os
 import json
 import re
+import time
+import threading
 from dotenv import load_dotenv
 from langchain_groq import ChatGroq
+import preclassifier
+import llm_cache
+import metrics
 
 load_dotenv()
 
+MODEL_NAME = "llama-3.1-8b-instant"
+
+# "combined" = one prompt for status verdict + task fields,
+# "sequential" = the original extract_status_update -> extract_task_info path
+# (one email per call; batched prompts are combined-only, so batching is off)
+EXTRACTION_MODE = os.getenv("LLM_EXTRACTION_MODE", "combined").lower()
+
+# bump a version whenever its prompt changes so cached answers are not reused
+PROMPT_VERSIONS = {"task": "task-v1", "status": "status-v1", "combined": "combined-v1"}
+
 llm = ChatGroq(
-    model="llama-3.1-8b-instant",
+    model=MODEL_NAME,
     temperature=0,
     groq_api_key=os.getenv("GROQ_API_KEY")
 )
 
+
+def _cache_key(kind, subject, body):
+    if llm_cache.get_cache() is None:
+        return None
+    return llm_cache.make_key(kind, PROMPT_VERSIONS[kind], MODEL_NAME, subject, body)
+
+
+def _cache_get(kind, subject, body):
+    """Return (key, cached_result) - both None when caching is disabled."""
+    key = _cache_key(kind, subject, body)
+    if key is None:
+        return None, None
+    return key, llm_cache.get_cache().get(key)
+
+
+def _cache_put(key, result):
+    cache = llm_cache.get_cache()
+    if cache is not None and key is not None:
+        cache.put(key, result)
+
+
+def _json_from(text):
+    """First {...} block of an LLM reply, parsed; raises ValueError if absent."""
+    json_match = re.search(r"\{.*\}", text, re.DOTALL)
+    if not json_match:
+        raise ValueError("No JSON found in LLM response")
+    return json.loads(json_match.group(0))
+
+
+def _invoke(function, prompt):
+    """llm.invoke with latency and token counts recorded under `function`."""
+    start = time.perf_counter()
+    response = llm.invoke(prompt)
+    metrics.record_llm(function, response, time.perf_counter() - start)
+    return response
+
+
+async def _ainvoke(ainvoke, function, prompt):
+    # includes time spent waiting in the caller's rate-limit scheduler
+    start = time.perf_counter()
+    response = await ainvoke(prompt)
+    metrics.record_llm(function, response, time.perf_counter() - start)
+    return response
+
 # ------------------------------
 # A) Extract NORMAL project info
 # ------------------------------
-def extract_task_info(subject, body):
-    prompt = f"""
+def build_task_prompt(subject, body):
+    return f"""
 Extract the following fields from this email and return STRICT JSON:
 - project_type (short label)
 - assigned_dept (HR / Finance / IT / Hardware)
@@ -31,48 +90,55 @@ Email Body: {body}
 
 Return ONLY JSON.
 """
+
+
+def parse_task_response(text, subject):
+    return _task_from_data(_json_from(text.strip()), subject)
+
+
+def _task_from_data(data, subject):
+    if not isinstance(data, dict):
+        raise ValueError("task response is not a JSON object")
+    return {
+        "project_type": data.get("project_type", (subject or "Unknown")[:100]),
+        "assigned_dept": data.get("assigned_dept", "IT"),
+        "time_required": data.get("time_required", "Not specified"),
+        "priority": data.get("priority", "MEDIUM"),
+        "status": data.get("status", "pending"),
+        "summary": data.get("summary", subject or "No summary provided")
+    }
+
+
+def task_fallback(subject):
+    return {
+        "project_type": subject or "Unknown",
+        "assigned_dept": "IT",
+        "time_required": "Not specified",
+        "priority": "MEDIUM",
+        "status": "pending",
+        "summary": subject or "No summary provided"
+    }
+
+
+def extract_task_info(subject, body):
+    key, cached = _cache_get("task", subject, body)
+    if cached is not None:
+        return cached
     try:
-        response = llm.invoke(prompt)
-        text = response.content.strip()
-        json_match = re.search(r"\{.*\}", text, re.DOTALL)
-        if not json_match:
-            raise ValueError("No JSON found in LLM response")
-        data = json.loads(json_match.group(0))
-        return {
-            "project_type": data.get("project_type", (subject or "Unknown")[:100]),
-            "assigned_dept": data.get("assigned_dept", "IT"),
-            "time_required": data.get("time_required", "Not specified"),
-            "priority": data.get("priority", "MEDIUM"),
-            "status": data.get("status", "pending"),
-            "summary": data.get("summary", subject or "No summary provided")
-        }
+        response = _invoke("extract_task_info", build_task_prompt(subject, body))
+        result = parse_task_response(response.content, subject)
+        _cache_put(key, result)
+        return result
     except Exception as e:
         print("LLM extraction error:", e)
-        return {
-            "project_type": subject or "Unknown",
-            "assigned_dept": "IT",
-            "time_required": "Not specified",
-            "priority": "MEDIUM",
-            "status": "pending",
-            "summary": subject or "No summary provided"
-        }
+        return task_fallback(subject)
 
 # ---------------------------------------
 # B) Extract STATUS UPDATE from any email
 # ---------------------------------------
-def extract_status_update(subject, body):
-    """
-    Return dict:
-    {
-      "is_status_update": bool,
-      "task_id": int or None,
-      "new_status": "resolved" / "pending" / "in-progress" / None,
-      "raw_text": "..."
-    }
-    Uses LLM first; fallback to regex and keyword heuristics.
-    """
+def build_status_prompt(subject, body):
     combined = f"Subject: {subject}\n\n{body or ''}"
-    prompt = f"""
+    return f"""
 Detect if this email is a STATUS UPDATE. Return STRICT JSON only.
 
 Rules:
@@ -92,22 +158,22 @@ Return JSON ONLY in exactly this structure:
 Email:
 {combined}
 """
-    try:
-        response = llm.invoke(prompt)
-        text = response.content.strip()
-        json_match = re.search(r"\{.*\}", text, re.DOTALL)
-        if json_match:
-            data = json.loads(json_match.group(0))
-            return {
-                "is_status_update": bool(data.get("is_status_update")),
-                "task_id": data.get("task_id"),
-                "new_status": data.get("new_status"),
-                "raw_text": text
-            }
-    except Exception as e:
-        print("Status update detection via LLM failed:", e)
 
-    # --- fallback heuristic (regex + keywords) ---
+
+def parse_status_response(text):
+    text = text.strip()
+    data = _json_from(text)
+    return {
+        "is_status_update": bool(data.get("is_status_update")),
+        "task_id": data.get("task_id"),
+        "new_status": data.get("new_status"),
+        "raw_text": text
+    }
+
+
+def status_heuristic(subject, body):
+    """Regex + keyword fallback used when the LLM call fails."""
+    combined = f"Subject: {subject}\n\n{body or ''}"
     lower = combined.lower() if combined else ""
     # find task id like "task 138" or "#138" or "ticket 138"
     id_match = re.search(r"(?:task|ticket|id)\s*[:#]?\s*(\d{1,6})", lower)
@@ -129,3 +195,520 @@ Email:
 
     is_status = (tid is not None) and (new_status is not None)
     return {"is_status_update": bool(is_status), "task_id": tid, "new_status": new_status, "raw_text": combined}
+
+
+def _rule_verdict(subject, body, headers):
+    """Pre-classifier verdict when the rules are certain, else None."""
+    verdict = preclassifier.preclassify(subject, body, headers)
+    if not verdict["certain"]:
+        return None
+    return {
+        "is_status_update": verdict["is_status_update"],
+        "task_id": verdict["task_id"],
+        "new_status": verdict["new_status"],
+        "raw_text": f"Subject: {subject}\n\n{body or ''}",
+    }
+
+
+def extract_status_update(subject, body, headers=None, precheck=True):
+    """
+    Return dict:
+    {
+      "is_status_update": bool,
+      "task_id": int or None,
+      "new_status": "resolved" / "pending" / "in-progress" / None,
+      "raw_text": "..."
+    }
+    Deterministic rules first (reply headers / our own subject pattern);
+    then LLM; fallback to regex and keyword heuristics.
+    """
+    if precheck:
+        verdict = _rule_verdict(subject, body, headers)
+        if verdict is not None:
+            preclassifier.record_saved_calls(1)
+            return verdict
+
+    key, cached = _cache_get("status", subject, body)
+    if cached is not None:
+        return cached
+    try:
+        response = _invoke("extract_status_update", build_status_prompt(subject, body))
+        result = parse_status_response(response.content)
+        _cache_put(key, result)
+        return result
+    except Exception as e:
+        print("Status update detection via LLM failed:", e)
+
+    # --- fallback heuristic (regex + keywords) ---
+    return status_heuristic(subject, body)
+
+# ---------------------------------------------------------------
+# C) Combined status verdict + task fields in ONE call
+# ---------------------------------------------------------------
+DEPARTMENTS = ("HR", "Finance", "IT", "Hardware")
+PRIORITIES = ("LOW", "MEDIUM", "HIGH")
+STATUSES = ("pending", "resolved")
+
+TASK_FIELDS = ("project_type", "assigned_dept", "time_required", "priority", "status", "summary")
+
+
+def _validate_combined(data):
+    """
+    Strict schema check for the combined response. Returns a normalized
+    dict or raises ValueError so the caller can fall back.
+    """
+    if not isinstance(data, dict):
+        raise ValueError("combined response is not a JSON object")
+
+    is_status = data.get("is_status_update")
+    if not isinstance(is_status, bool):
+        raise ValueError("is_status_update must be true/false")
+
+    task_id = data.get("task_id")
+    if isinstance(task_id, str) and task_id.strip().isdigit():
+        task_id = int(task_id.strip())
+    if task_id is not None and (isinstance(task_id, bool) or not isinstance(task_id, int)):
+        raise ValueError("task_id must be a number or null")
+
+    new_status = data.get("new_status")
+    if new_status is not None and new_status not in STATUSES:
+        raise ValueError(f"new_status must be one of {STATUSES} or null")
+
+    result = {"is_status_update": is_status, "task_id": task_id, "new_status": new_status, "task": None}
+    if is_status:
+        return result
+
+    task = data.get("task")
+    if not isinstance(task, dict):
+        raise ValueError("task object is required when is_status_update is false")
+    missing = [k for k in TASK_FIELDS if not isinstance(task.get(k), str) or not task.get(k).strip()]
+    if missing:
+        raise ValueError(f"task is missing fields: {', '.join(missing)}")
+
+    dept = next((d for d in DEPARTMENTS if d.lower() == task["assigned_dept"].strip().lower()), None)
+    priority = task["priority"].strip().upper()
+    status = task["status"].strip().lower()
+    if dept is None:
+        raise ValueError(f"assigned_dept must be one of {DEPARTMENTS}")
+    if priority not in PRIORITIES:
+        raise ValueError(f"priority must be one of {PRIORITIES}")
+    if status not in STATUSES:
+        raise ValueError(f"status must be one of {STATUSES}")
+
+    result["task"] = {
+        "project_type": task["project_type"].strip()[:100],
+        "assigned_dept": dept,
+        "time_required": task["time_required"].strip(),
+        "priority": priority,
+        "status": status,
+        "summary": task["summary"].strip(),
+    }
+    return result
+
+
+def build_combined_prompt(subject, body):
+    return f"""
+Classify this email and extract task details. Return STRICT JSON only.
+
+Step 1 - STATUS UPDATE detection:
+- If email mentions "task" or "ticket" with an ID → extract task_id
+- resolved, completed, done, fixed, solved, closed, no longer needed → new_status = "resolved"
+- in progress, working on, pending → new_status = "pending"
+- An email is a status update only if it refers to an existing task.
+
+Step 2 - If it is NOT a status update, fill "task":
+- project_type (short label)
+- assigned_dept (HR / Finance / IT / Hardware)
+- time_required
+- priority (LOW/MEDIUM/HIGH)
+- status (pending/resolved)
+- summary (2 lines)
+If it IS a status update, "task" must be null.
+
+Return JSON ONLY in exactly this structure:
+{{
+  "is_status_update": true/false,
+  "task_id": number or null,
+  "new_status": "resolved" / "pending" / null,
+  "task": {{
+    "project_type": "...", "assigned_dept": "...", "time_required": "...",
+    "priority": "...", "status": "...", "summary": "..."
+  }} or null
+}}
+
+Email Subject: {subject}
+Email Body: {body}
+"""
+
+
+def parse_combined_response(text):
+    text = text.strip()
+    result = _validate_combined(_json_from(text))
+    result["raw_text"] = text
+    return result
+
+
+def extract_email_info(subject, body, headers=None, precheck=True):
+    """
+    One LLM round-trip for both questions. Returns
+    {"is_status_update", "task_id", "new_status", "raw_text", "task"}
+    where task is an extract_task_info-style dict (or None for status updates).
+    Falls back to the two-call path if the response fails validation.
+    """
+    result = _rule_verdict(subject, body, headers) if precheck else None
+    if result is not None:
+        result["task"] = None
+        if result["is_status_update"]:
+            preclassifier.record_saved_calls(1)
+        else:
+            # still one call, but without the status-detection instructions
+            result["task"] = extract_task_info(subject, body)
+        return result
+
+    key, cached = _cache_get("combined", subject, body)
+    if cached is not None:
+        return cached
+    try:
+        response = _invoke("extract_email_info", build_combined_prompt(subject, body))
+        result = parse_combined_response(response.content)
+        _cache_put(key, result)
+        return result
+    except Exception as e:
+        print("Combined extraction failed, using two-call path:", e)
+    return extract_email_info_sequential(subject, body, headers, precheck=False)
+
+
+def extract_email_info_sequential(subject, body, headers=None, precheck=True):
+    """Original two-call path: status detection first, task fields second."""
+    try:
+        status_info = extract_status_update(subject, body, headers, precheck=precheck)
+    except Exception as e:
+        print("Status extraction error:", e)
+        status_info = {"is_status_update": False, "task_id": None, "new_status": None}
+
+    result = _merge_status(status_info)
+    if not result["is_status_update"]:
+        result["task"] = extract_task_info(subject, body)
+    return result
+
+
+def _merge_status(status_info):
+    return {
+        "is_status_update": bool(status_info.get("is_status_update")),
+        "task_id": status_info.get("task_id"),
+        "new_status": status_info.get("new_status"),
+        "raw_text": status_info.get("raw_text"),
+        "task": None,
+    }
+
+
+def classify_and_extract(subject, body, headers=None):
+    if EXTRACTION_MODE == "sequential":
+        return extract_email_info_sequential(subject, body, headers)
+    return extract_email_info(subject, body, headers)
+
+
+# ---------------------------------------------------------------
+# D) Async variants (ChatGroq.ainvoke) for the email daemon
+# ---------------------------------------------------------------
+# Same prompts, cache and fallbacks as above. `ainvoke` lets the caller put
+# a rate-limit aware scheduler in front of llm.ainvoke.
+async def aextract_task_info(subject, body, ainvoke=None):
+    ainvoke = ainvoke or llm.ainvoke
+    key, cached = _cache_get("task", subject, body)
+    if cached is not None:
+        return cached
+    try:
+        response = await _ainvoke(ainvoke, "aextract_task_info", build_task_prompt(subject, body))
+        result = parse_task_response(response.content, subject)
+        _cache_put(key, result)
+        return result
+    except Exception as e:
+        print("LLM extraction error:", e)
+        return task_fallback(subject)
+
+
+async def aextract_status_update(subject, body, headers=None, precheck=True, ainvoke=None):
+    ainvoke = ainvoke or llm.ainvoke
+    if precheck:
+        verdict = _rule_verdict(subject, body, headers)
+        if verdict is not None:
+            preclassifier.record_saved_calls(1)
+            return verdict
+
+    key, cached = _cache_get("status", subject, body)
+    if cached is not None:
+        return cached
+    try:
+        response = await _ainvoke(ainvoke, "aextract_status_update", build_status_prompt(subject, body))
+        result = parse_status_response(response.content)
+        _cache_put(key, result)
+        return result
+    except Exception as e:
+        print("Status update detection via LLM failed:", e)
+    return status_heuristic(subject, body)
+
+
+async def aextract_email_info_sequential(subject, body, headers=None, precheck=True, ainvoke=None):
+    try:
+        status_info = await aextract_status_update(subject, body, headers, precheck, ainvoke)
+    except Exception as e:
+        print("Status extraction error:", e)
+        status_info = {"is_status_update": False, "task_id": None, "new_status": None}
+
+    result = _merge_status(status_info)
+    if not result["is_status_update"]:
+        result["task"] = await aextract_task_info(subject, body, ainvoke)
+    return result
+
+
+async def aextract_email_info(subject, body, headers=None, ainvoke=None):
+    ainvoke = ainvoke or llm.ainvoke
+    result = _rule_verdict(subject, body, headers)
+    if result is not None:
+        result["task"] = None
+        if result["is_status_update"]:
+            preclassifier.record_saved_calls(1)
+        else:
+            result["task"] = await aextract_task_info(subject, body, ainvoke)
+        return result
+
+    key, cached = _cache_get("combined", subject, body)
+    if cached is not None:
+        return cached
+    try:
+        response = await _ainvoke(ainvoke, "aextract_email_info", build_combined_prompt(subject, body))
+        result = parse_combined_response(response.content)
+        _cache_put(key, result)
+        return result
+    except Exception as e:
+        print("Combined extraction failed, using two-call path:", e)
+    return await aextract_email_info_sequential(subject, body, headers, precheck=False, ainvoke=ainvoke)
+
+
+async def aclassify_and_extract(subject, body, headers=None, ainvoke=None):
+    if EXTRACTION_MODE == "sequential":
+        return await aextract_email_info_sequential(subject, body, headers, ainvoke=ainvoke)
+    return await aextract_email_info(subject, body, headers, ainvoke=ainvoke)
+
+
+# ---------------------------------------------------------------
+# E) Batched prompts: N emails per llm.invoke during backlog drains
+# ---------------------------------------------------------------
+LLM_BATCH_SIZE = int(os.getenv("LLM_BATCH_SIZE", 8))
+# prompt-side budget (~4 chars/token) for one batched request
+LLM_BATCH_TOKEN_BUDGET = int(os.getenv("LLM_BATCH_TOKEN_BUDGET", 6000))
+
+_batch_lock = threading.Lock()
+_batch_stats = {"batches": 0, "batched_emails": 0, "llm_calls": 0, "splits": 0,
+                "single_fallbacks": 0, "cache_hits": 0}
+
+
+def _count_batch(key, n=1):
+    with _batch_lock:
+        _batch_stats[key] += n
+
+
+def batch_stats():
+    with _batch_lock:
+        data = dict(_batch_stats)
+    data["avg_batch_size"] = round(data["batched_emails"] / data["batches"], 2) if data["batches"] else 0.0
+    data["configured_batch_size"] = LLM_BATCH_SIZE
+    return data
+
+
+def _estimate_tokens(text):
+    return max(1, len(text or "") // 4)
+
+
+def pack_batches(entries, max_size=None, token_budget=None):
+    """
+    Greedy packing of (subject, body, ...) entries into lists bounded by
+    both max_size and token_budget. An oversized email gets its own batch.
+    """
+    max_size = max_size or LLM_BATCH_SIZE
+    token_budget = token_budget or LLM_BATCH_TOKEN_BUDGET
+    batches, current, used = [], [], 0
+    for entry in entries:
+        cost = _estimate_tokens(entry[1]) + _estimate_tokens(entry[2]) + 20
+        if current and (len(current) >= max_size or used + cost > token_budget):
+            batches.append(current)
+            current, used = [], 0
+        current.append(entry)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+_BATCH_INSTRUCTIONS = {
+    "task": """
+For EACH email below, extract the following fields:
+- project_type (short label)
+- assigned_dept (HR / Finance / IT / Hardware)
+- time_required
+- priority (LOW/MEDIUM/HIGH)
+- status (pending/resolved)
+- summary (2 lines)
+
+Return ONLY a JSON array with one object per email, in this shape:
+[{"index": <email index>, "project_type": "...", "assigned_dept": "...",
+  "time_required": "...", "priority": "...", "status": "...", "summary": "..."}]
+""",
+    "combined": """
+For EACH email below, decide whether it is a STATUS UPDATE for an existing
+task and, if it is NOT, extract the task details.
+- If email mentions "task" or "ticket" with an ID → extract task_id
+- resolved, completed, done, fixed, solved, closed, no longer needed → new_status = "resolved"
+- in progress, working on, pending → new_status = "pending"
+- task fields: project_type (short label), assigned_dept (HR / Finance / IT / Hardware),
+  time_required, priority (LOW/MEDIUM/HIGH), status (pending/resolved), summary (2 lines)
+- For status updates "task" must be null.
+
+Return ONLY a JSON array with one object per email, in this shape:
+[{"index": <email index>, "is_status_update": true/false, "task_id": number or null,
+  "new_status": "resolved" / "pending" / null,
+  "task": {"project_type": "...", "assigned_dept": "...", "time_required": "...",
+            "priority": "...", "status": "...", "summary": "..."} or null}]
+""",
+}
+
+
+def build_batch_prompt(kind, emails):
+    """emails: list of (subject, body); the position in the list is the index."""
+    parts = [_BATCH_INSTRUCTIONS[kind]]
+    for i, (subject, body) in enumerate(emails):
+        parts.append(f"### Email {i}\nSubject: {subject}\nBody: {body}\n")
+    return "\n".join(parts)
+
+
+def parse_batch_response(text):
+    """{index: object} for every well-formed array element."""
+    match = re.search(r"\[.*\]", text or "", re.DOTALL)
+    if not match:
+        raise ValueError("No JSON array found in LLM response")
+    items = json.loads(match.group(0))
+    if not isinstance(items, list):
+        raise ValueError("batched response is not a JSON array")
+    by_index = {}
+    for obj in items:
+        if isinstance(obj, dict) and isinstance(obj.get("index"), int):
+            by_index[obj["index"]] = obj
+    return by_index
+
+
+def _batch_item(kind, obj, subject):
+    if kind == "task":
+        # stricter than the single-email path: a half-filled element usually
+        # means the model lost track of the batch, so retry it
+        missing = [k for k in TASK_FIELDS if k not in obj]
+        if missing:
+            raise ValueError(f"batched task is missing fields: {', '.join(missing)}")
+        return _task_from_data(obj, subject)
+    result = _validate_combined(obj)
+    result["raw_text"] = json.dumps(obj)
+    return result
+
+
+def _single(kind, subject, body, headers):
+    _count_batch("single_fallbacks")
+    if kind == "task":
+        return extract_task_info(subject, body)
+    return extract_email_info(subject, body, headers, precheck=False)
+
+
+def _run_batch(kind, entries, results):
+    """
+    entries: list of (position, subject, body, headers). Fills results[position].
+    Items missing or malformed in the batched reply are split off and
+    retried in smaller batches; a single leftover uses the one-email path.
+    """
+    if len(entries) == 1:
+        pos, subject, body, headers = entries[0]
+        results[pos] = _single(kind, subject, body, headers)
+        return
+
+    _count_batch("batches")
+    _count_batch("batched_emails", len(entries))
+    _count_batch("llm_calls")
+    try:
+        response = _invoke(f"batch_{kind}", build_batch_prompt(kind, [(e[1], e[2]) for e in entries]))
+        by_index = parse_batch_response(response.content)
+    except Exception as e:
+        print("Batched extraction failed:", e)
+        by_index = {}
+
+    failed = []
+    for i, (pos, subject, body, headers) in enumerate(entries):
+        try:
+            results[pos] = _batch_item(kind, by_index[i], subject)
+            _cache_put(_cache_key(kind, subject, body), results[pos])
+        except Exception:
+            failed.append((pos, subject, body, headers))
+
+    if not failed:
+        return
+    _count_batch("splits")
+    if len(failed) == len(entries):
+        # nothing usable came back: bisect so one bad email cannot sink the rest
+        mid = len(failed) // 2
+        _run_batch(kind, failed[:mid], results)
+        _run_batch(kind, failed[mid:], results)
+    else:
+        _run_batch(kind, failed, results)
+
+
+def _extract_batch(kind, entries, max_size, token_budget):
+    results = [None] * len(entries)
+    pending = []
+    for pos, (subject, body, headers) in enumerate(entries):
+        key, cached = _cache_get(kind, subject, body)
+        if cached is not None:
+            _count_batch("cache_hits")
+            results[pos] = cached
+        else:
+            pending.append((pos, subject, body, headers))
+    for batch in pack_batches(pending, max_size, token_budget):
+        _run_batch(kind, batch, results)
+    return results
+
+
+def extract_task_info_batch(emails, max_size=None, token_budget=None):
+    """
+    Batched extract_task_info: emails is a list of (subject, body).
+    Returns task dicts in the same order.
+    """
+    return _extract_batch("task", [(s, b, None) for s, b in emails], max_size, token_budget)
+
+
+def classify_and_extract_batch(emails, max_size=None, token_budget=None):
+    """
+    Batched classify_and_extract: emails is a list of (subject, body, headers).
+    Rule-certain emails skip the LLM; the rest share combined prompts.
+    Returns extract_email_info-style dicts in the same order.
+    In sequential mode every email takes the two-call path on its own.
+    """
+    if EXTRACTION_MODE == "sequential":
+        return [classify_and_extract(subject, body, headers) for subject, body, headers in emails]
+    results = [None] * len(emails)
+    combined, combined_pos, tasks, task_pos = [], [], [], []
+    for pos, (subject, body, headers) in enumerate(emails):
+        verdict = _rule_verdict(subject, body, headers)
+        if verdict is None:
+            combined.append((subject, body, headers))
+            combined_pos.append(pos)
+        elif verdict["is_status_update"]:
+            preclassifier.record_saved_calls(1)
+            verdict["task"] = None
+            results[pos] = verdict
+        else:
+            # certainly a new request: the shorter task-only prompt is enough
+            results[pos] = verdict
+            tasks.append((subject, body, None))
+            task_pos.append(pos)
+
+    for pos, task in zip(task_pos, _extract_batch("task", tasks, max_size, token_budget)):
+        results[pos]["task"] = task
+    for pos, result in zip(combined_pos, _extract_batch("combined", combined, max_size, token_budget)):
+        results[pos] = result
+    return results
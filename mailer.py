@@ -1,14 +1,31 @@
 # mailer.py
 import os
+import time
+import queue
 import smtplib
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 from email.message import EmailMessage
 from dotenv import load_dotenv
+import metrics
 
 load_dotenv()
 
 # Default SMTP settings for Gmail. Change if you use another SMTP provider.
 SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
 SMTP_PORT = int(os.getenv("SMTP_PORT", 587))  # use 465 for SSL, 587 for STARTTLS
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", 20))
+# a local debugging server (python -m aiosmtpd -n -l localhost:1025) speaks
+# neither STARTTLS nor AUTH: SMTP_STARTTLS=0 SMTP_AUTH=0
+SMTP_STARTTLS = os.getenv("SMTP_STARTTLS", "1" if SMTP_PORT == 587 else "0") == "1"
+SMTP_AUTH = os.getenv("SMTP_AUTH", "1") == "1"
+
+# authenticated sessions kept open between sends
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 2))
+# servers drop idle sessions; recycle ours before they do
+SMTP_POOL_IDLE = float(os.getenv("SMTP_POOL_IDLE", 60))
+SMTP_MAX_PER_SESSION = int(os.getenv("SMTP_MAX_PER_SESSION", 100))
 
 EMAIL_ADDRESS = os.getenv("EMAIL_ADDRESS")
 EMAIL_APP_PASSWORD = os.getenv("EMAIL_PASSWORD")  # your Gmail app password
@@ -19,7 +36,180 @@ if not EMAIL_ADDRESS or not EMAIL_APP_PASSWORD:
     pass
 
 
-def send_email(to_address: str, subject: str, body: str, html: str = None, from_address: str = None):
+def build_message(to_address, subject, body, html=None, from_address=None, message_id=None):
+    """EmailMessage with the same defaults send_email applies."""
+    if not to_address:
+        raise ValueError("Missing to_address")
+
+    msg = EmailMessage()
+    msg["From"] = from_address or EMAIL_ADDRESS
+    msg["To"] = to_address
+    msg["Subject"] = (subject or "(no subject)").replace("\n", "").replace("\r", "")
+    if message_id:
+        msg["Message-ID"] = message_id
+    msg.set_content(body or "")
+
+    if html:
+        msg.add_alternative(html, subtype="html")
+    return msg
+
+
+# ------------------------------------------------------------
+# SMTP session pool
+# ------------------------------------------------------------
+class _Session:
+    __slots__ = ("smtp", "opened", "last_used", "sent")
+
+    def __init__(self, smtp):
+        self.smtp = smtp
+        self.opened = self.last_used = time.monotonic()
+        self.sent = 0
+
+
+class SMTPPool:
+    """
+    Keeps up to max_size logged-in SMTP sessions. A session idle longer
+    than idle_timeout, or one that has sent max_per_session messages, is
+    closed instead of reused.
+
+        with pool.session() as smtp:
+            smtp.send_message(msg)
+    """
+
+    def __init__(self, max_size=SMTP_POOL_SIZE, idle_timeout=SMTP_POOL_IDLE,
+                 max_per_session=SMTP_MAX_PER_SESSION):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_per_session = max_per_session
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.stats = {"opened": 0, "reused": 0, "discarded": 0, "sent": 0}
+        self._stats_lock = threading.Lock()
+
+    def _count(self, field):
+        # sessions are taken and returned from several sender threads
+        with self._stats_lock:
+            self.stats[field] += 1
+
+    def _open(self):
+        if SMTP_AUTH and (not EMAIL_ADDRESS or not EMAIL_APP_PASSWORD):
+            raise ValueError("Missing EMAIL_ADDRESS or EMAIL_PASSWORD in environment")
+        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+        server.ehlo()
+        if SMTP_STARTTLS:
+            server.starttls()
+            server.ehlo()
+        if SMTP_AUTH:
+            server.login(EMAIL_ADDRESS, EMAIL_APP_PASSWORD)
+        self._count("opened")
+        return _Session(server)
+
+    @staticmethod
+    def _close(session):
+        try:
+            session.smtp.quit()
+        except Exception:
+            try:
+                session.smtp.close()
+            except Exception:
+                pass
+
+    def _take(self):
+        while True:
+            try:
+                session = self._idle.get_nowait()
+            except queue.Empty:
+                return self._open()
+            if time.monotonic() - session.last_used < self.idle_timeout:
+                self._count("reused")
+                return session
+            self._close(session)
+
+    @contextmanager
+    def session(self):
+        self._slots.acquire()
+        session = None
+        try:
+            session = self._take()
+            yield session.smtp
+            session.sent += 1
+            self._count("sent")
+        except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused, smtplib.SMTPDataError):
+            # smtplib already sent RSET; the session is still usable
+            raise
+        except Exception:
+            # the connection state is unknown after any error
+            if session is not None:
+                self._count("discarded")
+                self._close(session)
+                session = None
+            raise
+        finally:
+            if session is not None:
+                session.last_used = time.monotonic()
+                if session.sent >= self.max_per_session:
+                    self._close(session)
+                else:
+                    self._idle.put(session)
+            self._slots.release()
+
+    def send(self, msg):
+        """
+        Send one message. A pooled session the server already dropped is
+        retried once on a fresh connection.
+        """
+        with metrics.timed("smtp_send_seconds"):
+            try:
+                try:
+                    with self.session() as smtp:
+                        smtp.send_message(msg)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    with self.session() as smtp:
+                        smtp.send_message(msg)
+            except Exception as e:
+                metrics.inc("smtp_errors_total", error=type(e).__name__)
+                raise
+
+    def send_many(self, messages, concurrency=None):
+        """
+        Send messages over the pooled sessions, up to `concurrency` (default:
+        pool size) in parallel. Returns one exception-or-None per message.
+        """
+        def send_one(msg):
+            try:
+                self.send(msg)
+                return None
+            except Exception as e:
+                return e
+
+        workers = max(1, min(concurrency or self.max_size, len(messages)))
+        if workers == 1:
+            return [send_one(m) for m in messages]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(send_one, messages))
+
+    def close(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = SMTPPool()
+        return _pool
+
+
+def send_email(to_address: str, subject: str, body: str, html: str = None, from_address: str = None,
+               message_id: str = None):
     """
     Send an email.
 
@@ -29,47 +219,18 @@ def send_email(to_address: str, subject: str, body: str, html: str = None, from_
       - body (str): plain-text body
       - html (str): optional html body (if provided, the email will be multipart/alternative)
       - from_address (str): optional from (defaults to EMAIL_ADDRESS)
+      - message_id (str): optional Message-ID header (replies to it come back
+        with this id in In-Reply-To / References)
 
     Raises:
       - ValueError if environment/missing args
       - smtplib.SMTPException / other exceptions from smtplib on failure
     """
-    if not EMAIL_ADDRESS or not EMAIL_APP_PASSWORD:
+    if SMTP_AUTH and (not EMAIL_ADDRESS or not EMAIL_APP_PASSWORD):
         raise ValueError("Missing EMAIL_ADDRESS or EMAIL_PASSWORD in environment")
 
-    if not to_address:
-        raise ValueError("Missing to_address")
-
-    if not subject:
-        subject = "(no subject)"
-
-    if from_address is None:
-        from_address = EMAIL_ADDRESS
-
-    # build EmailMessage
-    msg = EmailMessage()
-    msg["From"] = from_address
-    msg["To"] = to_address
-    msg["Subject"] = subject
-    msg.set_content(body or "")
-
-    if html:
-        msg.add_alternative(html, subtype="html")
-
-    # connect and send
-    try:
-        # Using STARTTLS (port 587)
-        server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20)
-        server.ehlo()
-        if SMTP_PORT == 587:
-            server.starttls()
-            server.ehlo()
-
-        server.login(EMAIL_ADDRESS, EMAIL_APP_PASSWORD)
-        server.send_message(msg)
-        server.quit()
-        print(f"✅ Email sent to {to_address} (subject: {subject})")
-        return True
-    except Exception as e:
-        # raise to caller so app.py can respond with JSON error message
-        raise e
+    msg = build_message(to_address, subject, body, html, from_address, message_id)
+    # sessions come from the shared pool; no connect/STARTTLS/login per mail
+    get_pool().send(msg)
+    print(f"✅ Email sent to {to_address} (subject: {msg['Subject']})")
+    return True
@@ -0,0 +1,265 @@
+# metrics.py
+"""
+In-process latency histograms and counters, rendered in the Prometheus
+text format by app.py at /metrics.
+
+    with metrics.timed("db_seconds", function="insert_project"):
+        ...
+
+    @metrics.timed("smtp_send_seconds")
+    def send(...): ...
+
+Each process keeps its own numbers: the ingest loop (email_reader.py)
+serves them with `python email_reader.py --metrics-port 9101`.
+
+METRICS_LOG=1 prints one JSON line per timed block; METRICS_SLOW_MS
+prints only blocks slower than that. PROFILE_SAMPLE_RATE (0..1) runs
+cProfile on that share of requests / messages and writes .prof files to
+PROFILE_DIR (open with `python -m pstats` or snakeviz).
+"""
+import os
+import json
+import time
+import random
+import threading
+import functools
+from contextlib import contextmanager
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_PREFIX = os.getenv("METRICS_PREFIX", "appless_")
+METRICS_LOG = os.getenv("METRICS_LOG", "0") == "1"
+METRICS_SLOW_MS = float(os.getenv("METRICS_SLOW_MS", 0))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# seconds; covers a 1 ms DB call up to a slow LLM round-trip
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+HELP = {
+    "imap_seconds": "IMAP command latency (search / fetch).",
+    "imap_fetched_messages_total": "Messages requested by UID FETCH.",
+    "imap_fetched_bytes_total": "Message bytes downloaded (structure = headers + text parts only).",
+    "mime_parse_seconds": "Time to parse one raw message (headers + get_body).",
+    "thread_index_hits_total": "Emails matched to a known thread before classification (no LLM call).",
+    "llm_call_seconds": "LLM round-trip per extractor function.",
+    "llm_tokens_total": "LLM tokens per extractor function (prompt / completion).",
+    "db_seconds": "db_writer / repository call latency.",
+    "db_errors_total": "db_writer calls that rolled back.",
+    "smtp_send_seconds": "SMTP send latency per message.",
+    "smtp_errors_total": "SMTP sends that raised.",
+    "http_request_seconds": "Flask request latency per route (until the view returns its response; streamed bodies are not included).",
+}
+
+_lock = threading.Lock()
+_histograms = {}   # name -> {labels_tuple: [bucket counts..., sum, count]}
+_counters = {}     # name -> {labels_tuple: value}
+_collectors = []   # callables returning [(name, labels_dict, value)] gauges
+
+
+def _labels(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+# ------------------------------------------------------------
+# Recording
+# ------------------------------------------------------------
+def observe(name, seconds, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = _labels(labels)
+    with _lock:
+        series = _histograms.setdefault(name, {})
+        entry = series.get(key)
+        if entry is None:
+            entry = series[key] = [0] * len(BUCKETS) + [0.0, 0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                entry[i] += 1
+        entry[-2] += seconds
+        entry[-1] += 1
+
+
+def inc(name, amount=1, **labels):
+    if not METRICS_ENABLED or not amount:
+        return
+    key = _labels(labels)
+    with _lock:
+        series = _counters.setdefault(name, {})
+        series[key] = series.get(key, 0) + amount
+
+
+def log_timing(name, seconds, labels):
+    ms = seconds * 1000
+    if METRICS_LOG or (METRICS_SLOW_MS and ms >= METRICS_SLOW_MS):
+        print(json.dumps({"event": "timing", "metric": name, "ms": round(ms, 2), **labels}, default=str))
+
+
+class timed:
+    """Context manager / decorator that records the block's duration."""
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        observe(self.name, seconds, **self.labels)
+        log_timing(self.name, seconds, self.labels)
+        return False
+
+    def __call__(self, fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with timed(self.name, **self.labels):
+                return fn(*args, **kwargs)
+        return wrapper
+
+
+def record_llm(function, response, seconds=None):
+    """Latency (if given) and token usage of one LangChain chat response."""
+    if seconds is not None:
+        observe("llm_call_seconds", seconds, function=function)
+        log_timing("llm_call_seconds", seconds, {"function": function})
+    usage = getattr(response, "usage_metadata", None) or {}
+    prompt = usage.get("input_tokens")
+    completion = usage.get("output_tokens")
+    if prompt is None:
+        # older langchain-groq only fills response_metadata
+        token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        prompt = token_usage.get("prompt_tokens")
+        completion = token_usage.get("completion_tokens")
+    inc("llm_tokens_total", prompt or 0, function=function, kind="prompt")
+    inc("llm_tokens_total", completion or 0, function=function, kind="completion")
+
+
+def register_collector(fn):
+    """fn() -> [(name, labels_dict, value)], read at every scrape."""
+    _collectors.append(fn)
+    return fn
+
+
+# ------------------------------------------------------------
+# Exposition
+# ------------------------------------------------------------
+def _fmt_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    inner = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                     for k, v in pairs)
+    return "{" + inner + "}"
+
+
+def render():
+    """All series in the Prometheus text exposition format (0.0.4)."""
+    with _lock:
+        histograms = {n: {k: list(v) for k, v in s.items()} for n, s in _histograms.items()}
+        counters = {n: dict(s) for n, s in _counters.items()}
+
+    lines = []
+    for name in sorted(histograms):
+        full = METRICS_PREFIX + name
+        if name in HELP:
+            lines.append(f"# HELP {full} {HELP[name]}")
+        lines.append(f"# TYPE {full} histogram")
+        for key, entry in sorted(histograms[name].items()):
+            for bound, count in zip(BUCKETS, entry):
+                lines.append(f"{full}_bucket{_fmt_labels(key, [('le', bound)])} {count}")
+            lines.append(f"{full}_bucket{_fmt_labels(key, [('le', '+Inf')])} {entry[-1]}")
+            lines.append(f"{full}_sum{_fmt_labels(key)} {entry[-2]:.6f}")
+            lines.append(f"{full}_count{_fmt_labels(key)} {entry[-1]}")
+
+    for name in sorted(counters):
+        full = METRICS_PREFIX + name
+        if name in HELP:
+            lines.append(f"# HELP {full} {HELP[name]}")
+        lines.append(f"# TYPE {full} counter")
+        for key, value in sorted(counters[name].items()):
+            lines.append(f"{full}{_fmt_labels(key)} {value}")
+
+    gauges = {}
+    for collect in list(_collectors):
+        try:
+            for name, labels, value in collect():
+                gauges.setdefault(name, []).append((_labels(labels), value))
+        except Exception as e:
+            print("❌ Metrics collector failed:", e)
+    for name in sorted(gauges):
+        full = METRICS_PREFIX + name
+        lines.append(f"# TYPE {full} gauge")
+        for key, value in gauges[name]:
+            lines.append(f"{full}{_fmt_labels(key)} {value}")
+
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def serve(port, host="0.0.0.0"):
+    """/metrics over a bare HTTP server thread, for processes without Flask."""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    print(f"📈 Metrics on http://{host}:{port}/metrics")
+    return server
+
+
+# ------------------------------------------------------------
+# Sampling profiler
+# ------------------------------------------------------------
+def start_profile(rate=None):
+    """A running cProfile.Profile for a sampled share of calls, else None."""
+    rate = PROFILE_SAMPLE_RATE if rate is None else rate
+    if rate <= 0 or random.random() >= rate:
+        return None
+    import cProfile
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+
+def stop_profile(profile, name):
+    """Stop a profile from start_profile() and dump it under PROFILE_DIR."""
+    if profile is None:
+        return None
+    profile.disable()
+    safe = "".join(c if c.isalnum() or c in "-_" else "_" for c in name).strip("_") or "profile"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_DIR, f"{safe}-{int(time.time() * 1000)}.prof")
+    try:
+        profile.dump_stats(path)
+    except Exception as e:
+        print("❌ Could not write profile:", e)
+        return None
+    return path
+
+
+@contextmanager
+def profiled(name, rate=None):
+    """Profile the block for a sampled share of calls (this thread only)."""
+    profile = start_profile(rate)
+    try:
+        yield
+    finally:
+        stop_profile(profile, name)
@@ -0,0 +1,354 @@
+# migrations.py
+"""
+Versioned schema changes for ApplessDB. Every statement is idempotent, and
+applied versions are recorded in schema_migrations.
+
+    python migrations.py             apply pending migrations
+    python migrations.py --status    list applied / pending versions
+"""
+import sys
+from db_writer import get_connection
+import dept_counters
+
+# (version, [statements]) - each statement runs as its own batch, so a
+# column added by one statement can be indexed by the next
+MIGRATIONS = [
+    ("0001_source_message_id", [
+        """
+        IF COL_LENGTH('projects', 'source_message_id') IS NULL
+            ALTER TABLE projects ADD source_message_id NVARCHAR(255) NULL
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ux_projects_source_message_id')
+            CREATE UNIQUE INDEX ux_projects_source_message_id
+                ON projects(source_message_id) WHERE source_message_id IS NOT NULL
+        """,
+        """
+        IF COL_LENGTH('project_updates', 'source_message_id') IS NULL
+            ALTER TABLE project_updates ADD source_message_id NVARCHAR(255) NULL
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ux_project_updates_source_message_id')
+            CREATE UNIQUE INDEX ux_project_updates_source_message_id
+                ON project_updates(source_message_id) WHERE source_message_id IS NOT NULL
+        """,
+    ]),
+    ("0002_dept_counters", [
+        """
+        IF OBJECT_ID('dept_status_counts', 'U') IS NULL
+            CREATE TABLE dept_status_counts (
+                dept NVARCHAR(100) NOT NULL,
+                status NVARCHAR(50) NOT NULL,
+                priority NVARCHAR(50) NOT NULL,
+                cnt INT NOT NULL,
+                CONSTRAINT pk_dept_status_counts PRIMARY KEY (dept, status, priority)
+            )
+        """,
+        # backfill from the existing rows; later writes keep it current
+        """
+        IF NOT EXISTS (SELECT 1 FROM dept_status_counts)
+            INSERT INTO dept_status_counts (dept, status, priority, cnt)
+        """ + dept_counters.BASE_COUNTS_SQL,
+    ]),
+    # keyset pagination walks (created_at, id) newest-first; updates are
+    # read per project in the same order
+    ("0003_pagination_indexes", [
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_created_id')
+            CREATE INDEX ix_projects_created_id
+                ON projects(created_at DESC, id DESC)
+                INCLUDE (assigned_dept, status, priority, owner_email)
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_project_updates_project_created')
+            CREATE INDEX ix_project_updates_project_created
+                ON project_updates(project_id, created_at DESC, id DESC)
+        """,
+    ]),
+    # persisted lower-cased copies so filters are sargable (see
+    # project_filters.py); owner_email_rev serves domain / suffix searches
+    ("0004_normalized_columns", [
+        """
+        IF COL_LENGTH('projects', 'dept_norm') IS NULL
+            ALTER TABLE projects ADD
+                dept_norm AS CAST(LOWER(assigned_dept) AS NVARCHAR(100)) PERSISTED,
+                status_norm AS CAST(LOWER(status) AS NVARCHAR(50)) PERSISTED,
+                priority_norm AS CAST(LOWER(priority) AS NVARCHAR(50)) PERSISTED,
+                owner_email_norm AS CAST(LOWER(owner_email) AS NVARCHAR(320)) PERSISTED,
+                owner_email_rev AS CAST(REVERSE(LOWER(owner_email)) AS NVARCHAR(320)) PERSISTED
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_dept_status_priority_created')
+            CREATE INDEX ix_projects_dept_status_priority_created
+                ON projects(dept_norm, status_norm, priority_norm, created_at DESC, id DESC)
+        """,
+        # department page without status/priority filters
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_dept_created')
+            CREATE INDEX ix_projects_dept_created
+                ON projects(dept_norm, created_at DESC, id DESC)
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_owner_email_norm')
+            CREATE INDEX ix_projects_owner_email_norm
+                ON projects(owner_email_norm, created_at DESC, id DESC)
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_owner_email_rev')
+            CREATE INDEX ix_projects_owner_email_rev
+                ON projects(owner_email_rev)
+        """,
+        """
+        IF COL_LENGTH('departments', 'name_norm') IS NULL
+            ALTER TABLE departments ADD name_norm AS CAST(LOWER(name) AS NVARCHAR(100)) PERSISTED
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_departments_name_norm')
+            CREATE INDEX ix_departments_name_norm ON departments(name_norm)
+        """,
+    ]),
+    # durable queue for outbound mail (outbox.py)
+    ("0005_outbox", [
+        """
+        IF OBJECT_ID('outbox', 'U') IS NULL
+            CREATE TABLE outbox (
+                id INT IDENTITY(1, 1) PRIMARY KEY,
+                project_id INT NULL,
+                to_address NVARCHAR(320) NOT NULL,
+                subject NVARCHAR(998) NOT NULL,
+                body NVARCHAR(MAX) NOT NULL,
+                message_id NVARCHAR(255) NULL,
+                resolve BIT NOT NULL DEFAULT 0,
+                status NVARCHAR(20) NOT NULL DEFAULT 'queued',
+                attempts INT NOT NULL DEFAULT 0,
+                next_attempt_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                locked_until DATETIME2 NULL,
+                last_error NVARCHAR(2000) NULL,
+                created_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                sent_at DATETIME2 NULL
+            )
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_outbox_due')
+            CREATE INDEX ix_outbox_due ON outbox(status, next_attempt_at)
+        """,
+    ]),
+    # change feed for the live department board (change_feed.py). rowversion
+    # is database-wide and bumped on every insert/update, so one watermark
+    # covers new projects, status flips and new updates.
+    ("0006_change_feed", [
+        """
+        IF COL_LENGTH('projects', 'row_version') IS NULL
+            ALTER TABLE projects ADD row_version ROWVERSION
+        """,
+        """
+        IF COL_LENGTH('project_updates', 'row_version') IS NULL
+            ALTER TABLE project_updates ADD row_version ROWVERSION
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_dept_row_version')
+            CREATE INDEX ix_projects_dept_row_version
+                ON projects(dept_norm, row_version)
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_project_updates_row_version')
+            CREATE INDEX ix_project_updates_row_version
+                ON project_updates(row_version) INCLUDE (project_id)
+        """,
+    ]),
+    # thread index (thread_index.py): hashed Message-ID / subject keys ->
+    # project. The backfill hashes the Message-IDs already stored; subject
+    # keys only exist for mail ingested from now on.
+    ("0007_thread_index", [
+        """
+        IF OBJECT_ID('thread_keys', 'U') IS NULL
+            CREATE TABLE thread_keys (
+                key_hash BINARY(16) NOT NULL PRIMARY KEY,
+                kind CHAR(1) NOT NULL,
+                project_id INT NOT NULL,
+                created_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                last_seen_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+            )
+        """,
+        """
+        INSERT INTO thread_keys (key_hash, kind, project_id)
+        SELECT s.key_hash, 'm', MIN(s.project_id)
+        FROM (
+            SELECT CONVERT(BINARY(16), HASHBYTES('SHA2_256',
+                       N'm:' + LTRIM(RTRIM(REPLACE(REPLACE(source_message_id, '<', ''), '>', ''))))) AS key_hash,
+                   id AS project_id
+            FROM projects WHERE source_message_id IS NOT NULL
+            UNION ALL
+            SELECT CONVERT(BINARY(16), HASHBYTES('SHA2_256',
+                       N'm:' + LTRIM(RTRIM(REPLACE(REPLACE(source_message_id, '<', ''), '>', ''))))),
+                   project_id
+            FROM project_updates WHERE source_message_id IS NOT NULL
+        ) s
+        WHERE NOT EXISTS (SELECT 1 FROM thread_keys t WHERE t.key_hash = s.key_hash)
+        GROUP BY s.key_hash
+        """,
+    ]),
+    # per-message ingest state, leases and retries (ingest_ledger.py)
+    ("0008_ingest_ledger", [
+        """
+        IF OBJECT_ID('ingest_ledger', 'U') IS NULL
+            CREATE TABLE ingest_ledger (
+                mailbox NVARCHAR(400) NOT NULL,
+                uidvalidity BIGINT NOT NULL,
+                uid BIGINT NOT NULL,
+                state NVARCHAR(20) NOT NULL,
+                attempts INT NOT NULL DEFAULT 0,
+                next_attempt_at DATETIME2 NULL,
+                locked_by NVARCHAR(200) NULL,
+                locked_until DATETIME2 NULL,
+                last_error NVARCHAR(2000) NULL,
+                created_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                updated_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                CONSTRAINT pk_ingest_ledger PRIMARY KEY (mailbox, uidvalidity, uid)
+            )
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_ingest_ledger_due')
+            CREATE INDEX ix_ingest_ledger_due
+                ON ingest_ledger(mailbox, uidvalidity, state, next_attempt_at)
+                INCLUDE (locked_until)
+        """,
+    ]),
+    # mailbox ownership and checkpoints for ingest_coordinator.py
+    ("0009_ingest_leases", [
+        """
+        IF OBJECT_ID('mailbox_leases', 'U') IS NULL
+            CREATE TABLE mailbox_leases (
+                mailbox NVARCHAR(400) NOT NULL PRIMARY KEY,
+                owner NVARCHAR(200) NULL,
+                lease_until DATETIME2 NULL,
+                epoch INT NOT NULL DEFAULT 0,
+                last_uid BIGINT NOT NULL DEFAULT 0,
+                uidvalidity BIGINT NOT NULL DEFAULT 0,
+                checkpoint_at DATETIME2 NULL
+            )
+        """,
+        """
+        IF OBJECT_ID('ingest_nodes', 'U') IS NULL
+            CREATE TABLE ingest_nodes (
+                node_id NVARCHAR(200) NOT NULL PRIMARY KEY,
+                capacity INT NOT NULL,
+                started_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                heartbeat_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+            )
+        """,
+    ]),
+    # owner_email holds the raw From header ("Alice <alice@corp.com>"), so
+    # the 0004 email columns never matched a bare address. owner_address is
+    # the parseaddr-normalized address (db_writer fills it on insert); the
+    # backfill takes what is between < > or else the whole value, and the
+    # email columns are rebuilt on top of it.
+    ("0010_owner_address", [
+        """
+        IF COL_LENGTH('projects', 'owner_address') IS NULL
+            ALTER TABLE projects ADD owner_address NVARCHAR(320) NULL
+        """,
+        """
+        UPDATE projects
+        SET owner_address = LEFT(LOWER(LTRIM(RTRIM(
+            CASE WHEN CHARINDEX('<', owner_email) > 0
+                      AND CHARINDEX('>', owner_email, CHARINDEX('<', owner_email)) > 0
+                 THEN SUBSTRING(owner_email, CHARINDEX('<', owner_email) + 1,
+                                CHARINDEX('>', owner_email, CHARINDEX('<', owner_email)) - CHARINDEX('<', owner_email) - 1)
+                 ELSE owner_email END))), 320)
+        WHERE owner_address IS NULL AND owner_email IS NOT NULL
+        """,
+        """
+        IF EXISTS (SELECT 1 FROM sys.computed_columns
+                   WHERE object_id = OBJECT_ID('projects') AND name = 'owner_email_norm'
+                     AND definition NOT LIKE '%owner_address%')
+        BEGIN
+            IF EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_owner_email_norm')
+                DROP INDEX ix_projects_owner_email_norm ON projects
+            IF EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_owner_email_rev')
+                DROP INDEX ix_projects_owner_email_rev ON projects
+            ALTER TABLE projects DROP COLUMN owner_email_norm, owner_email_rev
+        END
+        """,
+        """
+        IF COL_LENGTH('projects', 'owner_email_norm') IS NULL
+            ALTER TABLE projects ADD
+                owner_email_norm AS CAST(LOWER(owner_address) AS NVARCHAR(320)) PERSISTED,
+                owner_email_rev AS CAST(REVERSE(LOWER(owner_address)) AS NVARCHAR(320)) PERSISTED
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_owner_email_norm')
+            CREATE INDEX ix_projects_owner_email_norm
+                ON projects(owner_email_norm, created_at DESC, id DESC)
+        """,
+        """
+        IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'ix_projects_owner_email_rev')
+            CREATE INDEX ix_projects_owner_email_rev
+                ON projects(owner_email_rev)
+        """,
+    ]),
+]
+
+
+def _ensure_version_table(cur):
+    cur.execute("""
+        IF OBJECT_ID('schema_migrations', 'U') IS NULL
+            CREATE TABLE schema_migrations (
+                version NVARCHAR(100) NOT NULL PRIMARY KEY,
+                applied_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+            )
+    """)
+
+
+def applied_versions(cur):
+    _ensure_version_table(cur)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {r[0] for r in cur.fetchall()}
+
+
+def apply_migrations(verbose=True):
+    """Apply every pending migration, one transaction per version."""
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        done = applied_versions(cur)
+        conn.commit()
+        applied = []
+        for version, statements in MIGRATIONS:
+            if version in done:
+                continue
+            try:
+                for sql in statements:
+                    cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (version) VALUES (?)", (version,))
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                print(f"❌ Migration {version} failed:", e)
+                raise
+            applied.append(version)
+            if verbose:
+                print(f"✅ Applied migration {version}")
+        return applied
+    finally:
+        conn.close()
+
+
+def migration_status():
+    conn = get_connection()
+    try:
+        done = applied_versions(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    return [(version, version in done) for version, _ in MIGRATIONS]
+
+
+if __name__ == "__main__":
+    if "--status" in sys.argv[1:]:
+        for version, is_applied in migration_status():
+            print(f"{'applied' if is_applied else 'pending'}  {version}")
+    else:
+        applied = apply_migrations()
+        if not applied:
+            print("Schema is up to date")
@@ -0,0 +1,398 @@
+# mime_reader.py
+"""
+Size-bounded message bodies for the LLM.
+
+Structure mode (IMAP_FETCH_MODE=structure, the default) never downloads
+a whole message:
+
+  1. one UID FETCH per batch for BODYSTRUCTURE + the header block
+  2. the first text/plain part (else text/html) is chosen from the
+     structure; attachments and other parts are never fetched
+  3. one partial FETCH (BODY.PEEK[<section>]<0.N>) per section group,
+     N sized from the token budget
+
+The partial text is decoded (base64 / quoted-printable, charset), HTML
+is turned into plain text and the result is cut to MIME_BODY_TOKEN_BUDGET.
+body_text() applies the same rules to an already downloaded message
+(full mode, or messages whose BODYSTRUCTURE could not be read).
+"""
+import os
+import re
+import html
+import quopri
+import base64
+import binascii
+from email import policy
+from email.parser import BytesParser, BytesFeedParser
+from html.parser import HTMLParser
+
+# "structure" = BODYSTRUCTURE + partial text fetch, "full" = whole RFC822
+IMAP_FETCH_MODE = os.getenv("IMAP_FETCH_MODE", "structure").lower()
+# body handed to the LLM, in tokens (~4 characters each)
+MIME_BODY_TOKEN_BUDGET = int(os.getenv("MIME_BODY_TOKEN_BUDGET", 1000))
+# hard cap on bytes fetched for one text part
+MIME_FETCH_MAX_BYTES = int(os.getenv("MIME_FETCH_MAX_BYTES", 256 * 1024))
+
+TRUNCATED_MARK = "\n[... truncated]"
+CHARS_PER_TOKEN = 4
+
+
+class PartialMessage:
+    """Headers plus an already decoded, bounded body (structure mode)."""
+
+    __slots__ = ("headers", "body", "fetched_bytes", "truncated")
+
+    def __init__(self, headers, body, fetched_bytes=0, truncated=False):
+        self.headers = headers          # email.message.Message, headers only
+        self.body = body
+        self.fetched_bytes = fetched_bytes
+        self.truncated = truncated
+
+
+# ------------------------------------------------------------
+# IMAP response tokenizer
+# ------------------------------------------------------------
+_ATOM_END = b" ()\r\n"
+
+
+def _read(data, pos):
+    """One value at data[pos:]: list, string, literal, atom or None (NIL)."""
+    n = len(data)
+    while pos < n and data[pos] in b" \r\n":
+        pos += 1
+    c = data[pos:pos + 1]
+    if c == b"(":
+        items, pos = [], pos + 1
+        while True:
+            while pos < n and data[pos] in b" \r\n":
+                pos += 1
+            if pos >= n:
+                raise ValueError("unterminated list")
+            if data[pos:pos + 1] == b")":
+                return items, pos + 1
+            value, pos = _read(data, pos)
+            items.append(value)
+    if c == b'"':
+        out, pos = bytearray(), pos + 1
+        while pos < n and data[pos:pos + 1] != b'"':
+            if data[pos:pos + 1] == b"\\":
+                pos += 1
+            out += data[pos:pos + 1]
+            pos += 1
+        return bytes(out), pos + 1
+    if c == b"{":
+        end = data.index(b"}", pos)
+        size = int(data[pos + 1:end])
+        start = end + 1
+        if data[start:start + 2] == b"\r\n":
+            start += 2
+        return data[start:start + size], start + size
+    start = pos
+    while pos < n and data[pos] not in _ATOM_END:
+        if data[pos:pos + 1] == b"[":
+            # BODY[HEADER.FIELDS (A B)] keeps spaces and parens inside []
+            pos = data.index(b"]", pos)
+        pos += 1
+    atom = data[start:pos]
+    if not atom:
+        raise ValueError(f"unexpected {c!r} at {pos}")
+    return (None if atom.upper() == b"NIL" else atom), pos
+
+
+def _join_response(data):
+    """imaplib FETCH data (bytes and (prefix, literal) tuples) as one stream."""
+    out = []
+    for part in data or []:
+        if isinstance(part, tuple):
+            out.append(part[0] + b"\r\n" + part[1])
+        elif isinstance(part, bytes):
+            out.append(part)
+    return b" ".join(out)
+
+
+def parse_fetch(data):
+    """{uid: {ITEM: value}} from a UID FETCH response; BODY keys lose '<origin>'."""
+    stream = _join_response(data)
+    result, pos = {}, 0
+    while True:
+        while pos < len(stream) and stream[pos] in b" \r\n":
+            pos += 1
+        if pos >= len(stream):
+            return result
+        _, pos = _read(stream, pos)          # message sequence number
+        items, pos = _read(stream, pos)
+        if not isinstance(items, list):
+            continue
+        attrs = {}
+        for key, value in zip(items[::2], items[1::2]):
+            name = key.decode("ascii", "replace").upper().replace(".PEEK", "")
+            attrs[re.sub(r"<\d+>$", "", name)] = value
+        if attrs.get("UID"):
+            uid = int(attrs["UID"])
+            result.setdefault(uid, {}).update(attrs)
+
+
+# ------------------------------------------------------------
+# BODYSTRUCTURE
+# ------------------------------------------------------------
+class TextPart:
+    __slots__ = ("section", "subtype", "charset", "encoding", "size")
+
+    def __init__(self, section, subtype, charset, encoding, size):
+        self.section = section
+        self.subtype = subtype
+        self.charset = charset
+        self.encoding = encoding
+        self.size = size
+
+
+def _s(value):
+    return value.decode("utf-8", "replace") if isinstance(value, bytes) else value
+
+
+def _params(value):
+    if not isinstance(value, list):
+        return {}
+    return {(_s(k) or "").lower(): _s(v) for k, v in zip(value[::2], value[1::2])}
+
+
+def _text_parts(node, section=""):
+    """Yield (TextPart, is_attachment) for every text/* leaf, in order."""
+    if isinstance(node[0], list):
+        i = 0
+        while i < len(node) and isinstance(node[i], list):
+            child = f"{section}.{i + 1}" if section else str(i + 1)
+            yield from _text_parts(node[i], child)
+            i += 1
+        return
+    ctype = (_s(node[0]) or "").lower()
+    if ctype != "text":
+        return  # attachments, images, message/rfc822: never fetched
+    subtype = (_s(node[1]) or "").lower()
+    # text parts: type subtype params id desc encoding size lines [md5 disposition ...]
+    disposition = node[9] if len(node) > 9 else None
+    is_attachment = (isinstance(disposition, list) and disposition
+                     and (_s(disposition[0]) or "").lower() == "attachment")
+    yield TextPart(
+        section or "1",
+        subtype,
+        _params(node[2]).get("charset") or "utf-8",
+        (_s(node[5]) or "7bit").lower(),
+        int(node[6] or 0),
+    ), bool(is_attachment)
+
+
+def choose_text_part(structure):
+    """First inline text/plain part, else the first inline text/html, else None."""
+    parts = [p for p, attached in _text_parts(structure) if not attached]
+    for subtype in ("plain", "html"):
+        for part in parts:
+            if part.subtype == subtype:
+                return part
+    return None
+
+
+def fetch_limit(part, token_budget=None):
+    """
+    Bytes worth fetching for the budget (encoding and markup need more).
+    Deliberately not capped at part.size: the limit is a partial-FETCH
+    group key, and a <0.N> fetch past the end of a part returns it whole.
+    """
+    chars = (token_budget or MIME_BODY_TOKEN_BUDGET) * CHARS_PER_TOKEN
+    limit = chars * 2                      # multi-byte charsets, quoted-printable
+    if part.encoding == "base64":
+        limit = limit * 4 // 3 + 4
+    if part.subtype == "html":
+        limit *= 4                         # tags, styles, inline CSS
+    return min(limit, MIME_FETCH_MAX_BYTES)
+
+
+# ------------------------------------------------------------
+# Decoding / HTML / budget
+# ------------------------------------------------------------
+def decode_part(raw, encoding, charset, partial=False):
+    """Transfer-decode raw part bytes (possibly cut short) and return str."""
+    encoding = (encoding or "").lower()
+    if encoding == "base64":
+        compact = re.sub(rb"[^A-Za-z0-9+/=]", b"", raw)
+        if partial:
+            compact = compact[:len(compact) // 4 * 4]
+        try:
+            raw = base64.b64decode(compact)
+        except (binascii.Error, ValueError):
+            raw = b""
+    elif encoding == "quoted-printable":
+        if partial:
+            # do not leave a cut "=X" escape at the end
+            raw = re.sub(rb"=[0-9A-Fa-f]?$", b"", raw)
+        raw = quopri.decodestring(raw)
+    try:
+        return raw.decode(charset or "utf-8", errors="ignore")
+    except LookupError:
+        return raw.decode("utf-8", errors="ignore")
+
+
+class _HTMLText(HTMLParser):
+    BLOCK = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6",
+             "blockquote", "pre", "table", "ul", "ol", "hr"}
+    SKIP = {"script", "style", "head", "title"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.out = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+        elif tag in self.BLOCK:
+            self.out.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP:
+            self.skipping = max(0, self.skipping - 1)
+        elif tag in self.BLOCK:
+            self.out.append("\n")
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.out.append(data)
+
+
+def html_to_text(markup):
+    parser = _HTMLText()
+    try:
+        parser.feed(markup)
+        parser.close()
+        text = "".join(parser.out)
+    except Exception:
+        text = html.unescape(re.sub(r"<[^>]*>", " ", markup))
+    text = re.sub(r"[ \t\r\f\v]+", " ", text)
+    return re.sub(r"\s*\n\s*(\n\s*)*", lambda m: "\n\n" if m.group(1) else "\n", text).strip()
+
+
+def truncate_to_budget(text, token_budget=None):
+    """Cut text to about token_budget tokens, at a word boundary."""
+    limit = (token_budget or MIME_BODY_TOKEN_BUDGET) * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text, False
+    cut = text[:limit]
+    space = cut.rfind(" ", limit - 200)
+    if space > 0:
+        cut = cut[:space]
+    return cut.rstrip() + TRUNCATED_MARK, True
+
+
+def finish_body(text, subtype, token_budget=None, partial=False):
+    if subtype == "html":
+        text = html_to_text(text)
+    text, cut = truncate_to_budget(text.strip(), token_budget)
+    if partial and not cut:
+        text += TRUNCATED_MARK
+    return text
+
+
+# ------------------------------------------------------------
+# Whole-message path
+# ------------------------------------------------------------
+def _is_attachment(part):
+    return (part.get("Content-Disposition") or "").strip().lower().startswith("attachment")
+
+
+def body_text(msg, token_budget=None):
+    """
+    Bounded body of a parsed message: first inline text/plain, else
+    text/html as text. Only the chosen part is decoded, and only as much
+    of it as the budget needs.
+    """
+    chosen = None
+    for subtype in ("plain", "html"):
+        for part in msg.walk():
+            if part.is_multipart() or _is_attachment(part):
+                continue
+            if part.get_content_type() == f"text/{subtype}":
+                chosen = part
+                break
+        if chosen is not None:
+            break
+    if chosen is None:
+        return ""
+
+    raw = chosen.get_payload(decode=False)
+    if isinstance(raw, list):
+        return ""
+    if isinstance(raw, str):
+        # compat32 keeps undecodable 8bit bytes as surrogates
+        try:
+            raw = raw.encode("ascii", "surrogateescape")
+        except UnicodeEncodeError:
+            raw = raw.encode("utf-8", "surrogateescape")
+    encoding = (chosen.get("Content-Transfer-Encoding") or "").strip().lower()
+    subtype = chosen.get_content_subtype()
+    # decode only a budget-sized prefix of a large part
+    limit = fetch_limit(TextPart("", subtype, None, encoding, len(raw)), token_budget)
+    partial = len(raw) > limit
+    text = decode_part(raw[:limit], encoding, chosen.get_content_charset(), partial=partial)
+    return finish_body(text, subtype, token_budget, partial)
+
+
+def parse_headers(header_bytes):
+    """Header block -> Message (no body)."""
+    parser = BytesFeedParser(policy=policy.compat32)
+    parser.feed(header_bytes or b"")
+    return parser.close()
+
+
+def parse_message(raw):
+    return BytesParser(policy=policy.compat32).parsebytes(raw)
+
+
+# ------------------------------------------------------------
+# Structure-mode fetch
+# ------------------------------------------------------------
+def fetch_partial(mail, uids, peek=True, token_budget=None):
+    """
+    {uid: PartialMessage} for the uids whose structure could be read, plus
+    the list of uids that need a full fetch instead.
+    """
+    uid_set = ",".join(str(u) for u in uids)
+    status, data = mail.uid("fetch", uid_set, "(UID BODYSTRUCTURE BODY.PEEK[HEADER])")
+    if status != "OK":
+        raise RuntimeError(f"UID FETCH {uid_set} BODYSTRUCTURE failed: {status}")
+
+    messages, fallback, wanted = {}, [], {}
+    for uid, attrs in parse_fetch(data).items():
+        header_bytes = attrs.get("BODY[HEADER]") or b""
+        try:
+            part = choose_text_part(attrs["BODYSTRUCTURE"])
+        except Exception:
+            fallback.append(uid)
+            continue
+        messages[uid] = PartialMessage(parse_headers(header_bytes), "", len(header_bytes))
+        if part is not None:
+            limit = fetch_limit(part, token_budget)
+            wanted.setdefault((part.section, limit), []).append((uid, part))
+
+    # one partial FETCH per (section, limit) group, not per message; the
+    # limit depends only on the budget, encoding and subtype
+    item = "BODY.PEEK" if peek else "BODY"
+    for (section, limit), group in wanted.items():
+        uid_set = ",".join(str(uid) for uid, _ in group)
+        status, data = mail.uid("fetch", uid_set, f"(UID {item}[{section}]<0.{limit}>)")
+        if status != "OK":
+            fallback.extend(uid for uid, _ in group)
+            continue
+        bodies = parse_fetch(data)
+        for uid, part in group:
+            raw = (bodies.get(uid) or {}).get(f"BODY[{section}]") or b""
+            partial = part.size > len(raw)
+            text = decode_part(raw, part.encoding, part.charset, partial=partial)
+            msg = messages[uid]
+            msg.body = finish_body(text, part.subtype, token_budget, partial)
+            msg.fetched_bytes += len(raw)
+            msg.truncated = msg.body.endswith(TRUNCATED_MARK)
+
+    for uid in fallback:
+        messages.pop(uid, None)
+    missing = [u for u in uids if u not in messages and u not in fallback]
+    return messages, fallback + missing
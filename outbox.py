@@ -0,0 +1,323 @@
+# outbox.py
+"""
+Durable outbound mail queue. Routes insert a row into the outbox table and
+return at once. Worker threads claim due rows, send them over the pooled
+SMTP sessions in mailer, and then apply the row's follow-up: record the
+reply as a project update and, if asked, resolve the task. Failures are
+retried with exponential backoff.
+
+Row states: queued -> sending -> sent | failed (queued again between retries)
+
+    python outbox.py      run workers in the foreground (no Flask)
+"""
+import os
+import time
+import random
+import smtplib
+import threading
+
+from db_writer import get_connection, insert_project_update, update_task_status
+from mailer import build_message, get_pool, EMAIL_ADDRESS, SMTP_TIMEOUT
+
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 2))
+OUTBOX_CLAIM_BATCH = int(os.getenv("OUTBOX_CLAIM_BATCH", 10))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 2))
+# a row stuck in 'sending' this long (worker died) is claimed again. The
+# lease is renewed before each send, so it only has to cover one SMTP
+# exchange (connect, EHLO/login, DATA - each can take SMTP_TIMEOUT)
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", max(120, int(SMTP_TIMEOUT * 4))))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 6))
+OUTBOX_RETRY_BASE = float(os.getenv("OUTBOX_RETRY_BASE", 30))
+OUTBOX_RETRY_MAX = float(os.getenv("OUTBOX_RETRY_MAX", 3600))
+
+ENQUEUE_SQL = """
+    INSERT INTO outbox (project_id, to_address, subject, body, message_id, resolve)
+    OUTPUT INSERTED.id
+    VALUES (?, ?, ?, ?, ?, ?)
+"""
+
+CLAIM_SQL = """
+    WITH due AS (
+        SELECT TOP (?) *
+        FROM outbox WITH (ROWLOCK, UPDLOCK, READPAST)
+        WHERE (status = 'queued' AND next_attempt_at <= SYSUTCDATETIME())
+           OR (status = 'sending' AND locked_until < SYSUTCDATETIME())
+        ORDER BY next_attempt_at
+    )
+    UPDATE due
+    SET status = 'sending',
+        attempts = attempts + 1,
+        locked_until = DATEADD(SECOND, ?, SYSUTCDATETIME())
+    OUTPUT INSERTED.id, INSERTED.project_id, INSERTED.to_address, INSERTED.subject,
+           INSERTED.body, INSERTED.message_id, INSERTED.resolve, INSERTED.attempts
+"""
+
+# attempts is bumped by every claim, so it fences out a worker whose lease
+# ran out and was taken over
+RENEW_SQL = """
+    UPDATE outbox
+    SET locked_until = DATEADD(SECOND, ?, SYSUTCDATETIME())
+    OUTPUT INSERTED.id
+    WHERE id = ? AND status = 'sending' AND attempts = ?
+"""
+
+_wakeup = threading.Event()
+
+
+# ------------------------------------------------------------
+# Producer side
+# ------------------------------------------------------------
+def enqueue(to_address, subject, body, message_id=None, project_id=None, resolve=False, cur=None):
+    """
+    Queue one mail and return its delivery id. With project_id the body is
+    recorded as a reply update once sent; resolve=True also marks the task
+    resolved. Pass cur to enqueue inside the caller's transaction.
+    """
+    return enqueue_many([{
+        "to_address": to_address, "subject": subject, "body": body,
+        "message_id": message_id, "project_id": project_id, "resolve": resolve,
+    }], cur=cur)[0]
+
+
+def enqueue_many(items, cur=None):
+    """Queue several mails in one transaction; returns delivery ids in order."""
+    conn = None
+    if cur is None:
+        conn = get_connection()
+        cur = conn.cursor()
+    try:
+        ids = []
+        for item in items:
+            cur.execute(ENQUEUE_SQL, (
+                item.get("project_id"),
+                item["to_address"],
+                (item.get("subject") or "(no subject)").replace("\n", "").replace("\r", ""),
+                item.get("body") or "",
+                item.get("message_id"),
+                1 if item.get("resolve") else 0,
+            ))
+            ids.append(cur.fetchone()[0])
+        if conn is not None:
+            conn.commit()
+    finally:
+        if conn is not None:
+            conn.close()
+    wake()
+    return ids
+
+
+def wake():
+    """Let in-process workers pick up new rows without waiting for the poll."""
+    _wakeup.set()
+
+
+def delivery_status(delivery_id):
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT id, project_id, to_address, status, attempts, last_error,
+                   created_at, next_attempt_at, sent_at
+            FROM outbox WHERE id = ?
+        """, (delivery_id,))
+        row = cur.fetchone()
+    finally:
+        conn.close()
+    if row is None:
+        return None
+    return {
+        "id": row.id,
+        "project_id": row.project_id,
+        "to_address": row.to_address,
+        "status": row.status,
+        "attempts": row.attempts,
+        "last_error": row.last_error,
+        "created_at": str(row.created_at),
+        "next_attempt_at": str(row.next_attempt_at) if row.status == "queued" else None,
+        "sent_at": str(row.sent_at) if row.sent_at else None,
+    }
+
+
+# ------------------------------------------------------------
+# Worker side
+# ------------------------------------------------------------
+def claim(limit=OUTBOX_CLAIM_BATCH, lease_seconds=OUTBOX_LEASE_SECONDS):
+    """Mark up to `limit` due rows as 'sending' and return them."""
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(CLAIM_SQL, (limit, lease_seconds))
+        rows = cur.fetchall()
+        conn.commit()
+        return rows
+    finally:
+        conn.close()
+
+
+def renew(row, lease_seconds=OUTBOX_LEASE_SECONDS):
+    """Extend the lease on a claimed row; False if another worker took it over."""
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(RENEW_SQL, (lease_seconds, row.id, row.attempts))
+        held = cur.fetchone() is not None
+        conn.commit()
+        return held
+    finally:
+        conn.close()
+
+
+def is_permanent(exc):
+    """Errors that will not go away by retrying (bad address, 5xx reply)."""
+    if isinstance(exc, (ValueError, smtplib.SMTPRecipientsRefused)):
+        return True
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        return False  # configuration; retry once it is fixed
+    code = getattr(exc, "smtp_code", None)
+    return isinstance(code, int) and 500 <= code < 600
+
+
+def backoff(attempts):
+    delay = min(OUTBOX_RETRY_BASE * (2 ** max(0, attempts - 1)), OUTBOX_RETRY_MAX)
+    return delay * random.uniform(0.8, 1.2)
+
+
+def _mark(sql, params):
+    conn = get_connection()
+    try:
+        conn.cursor().execute(sql, params)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def mark_sent(delivery_id):
+    _mark("""
+        UPDATE outbox
+        SET status = 'sent', sent_at = SYSUTCDATETIME(), locked_until = NULL, last_error = NULL
+        WHERE id = ?
+    """, (delivery_id,))
+
+
+def mark_failed(delivery_id, attempts, error, permanent=False):
+    error = str(error)[:2000]
+    if permanent or attempts >= OUTBOX_MAX_ATTEMPTS:
+        _mark("""
+            UPDATE outbox SET status = 'failed', locked_until = NULL, last_error = ? WHERE id = ?
+        """, (error, delivery_id))
+        return "failed"
+    _mark("""
+        UPDATE outbox
+        SET status = 'queued', locked_until = NULL, last_error = ?,
+            next_attempt_at = DATEADD(SECOND, ?, SYSUTCDATETIME())
+        WHERE id = ?
+    """, (error, int(backoff(attempts)), delivery_id))
+    return "queued"
+
+
+def after_sent(row):
+    """Follow-up for a delivered reply (idempotent via the Message-ID)."""
+    if row.project_id is None:
+        return
+    insert_project_update(
+        project_id=row.project_id,
+        update_message=row.body,
+        from_email=EMAIL_ADDRESS,
+        update_type="reply",
+        source_message_id=row.message_id
+    )
+    if row.resolve:
+        update_task_status(row.project_id, "resolved")
+
+
+def deliver(rows, pool=None):
+    """
+    Send claimed rows; returns {"sent": n, "retry": n, "failed": n, "lost": n}.
+    A row whose lease was taken over by another worker is skipped ("lost").
+    """
+    pool = pool or get_pool()
+    result = {"sent": 0, "retry": 0, "failed": 0, "lost": 0}
+    for row in rows:
+        # earlier sends in this batch may have eaten into the claim's lease
+        try:
+            held = renew(row)
+        except Exception as e:
+            print(f"❌ Outbox {row.id} lease renewal failed, leaving it for a later claim:", e)
+            held = False
+        if not held:
+            result["lost"] += 1
+            continue
+        try:
+            msg = build_message(row.to_address, row.subject, row.body, message_id=row.message_id)
+            pool.send(msg)
+        except Exception as e:
+            state = mark_failed(row.id, row.attempts, e, permanent=is_permanent(e))
+            result["failed" if state == "failed" else "retry"] += 1
+            print(f"❌ Outbox {row.id} to {row.to_address} ({state}):", e)
+            continue
+        try:
+            after_sent(row)
+        except Exception as e:
+            # the mail is out; do not send it again because of a DB hiccup
+            print(f"❌ Outbox {row.id} follow-up failed:", e)
+        mark_sent(row.id)
+        result["sent"] += 1
+        print(f"✅ Outbox {row.id} sent to {row.to_address}")
+    return result
+
+
+class OutboxWorker(threading.Thread):
+    def __init__(self, stop_event, name=None):
+        super().__init__(name=name, daemon=True)
+        self.stop_event = stop_event
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                rows = claim()
+            except Exception as e:
+                print("❌ Outbox claim failed:", e)
+                rows = []
+            if rows:
+                deliver(rows)
+                continue
+            _wakeup.wait(OUTBOX_POLL_INTERVAL)
+            _wakeup.clear()
+
+
+_workers = []
+_stop = threading.Event()
+_workers_lock = threading.Lock()
+
+
+def start_workers(count=OUTBOX_WORKERS):
+    """Start the background senders once per process."""
+    with _workers_lock:
+        if _workers:
+            return _workers
+        _stop.clear()
+        for i in range(count):
+            worker = OutboxWorker(_stop, name=f"outbox-{i}")
+            worker.start()
+            _workers.append(worker)
+    return _workers
+
+
+def stop_workers(timeout=10):
+    with _workers_lock:
+        _stop.set()
+        wake()
+        for worker in _workers:
+            worker.join(timeout)
+        _workers.clear()
+
+
+if __name__ == "__main__":
+    start_workers()
+    print(f"📤 Outbox workers running ({OUTBOX_WORKERS}); Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        stop_workers()
+        get_pool().close()
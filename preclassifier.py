@@ -0,0 +1,170 @@
+# preclassifier.py
+import os
+import re
+import threading
+from email.utils import make_msgid
+
+# Verdicts at or above this confidence skip the LLM entirely
+MIN_CONFIDENCE = float(os.getenv("PRECLASSIFY_MIN_CONFIDENCE", 0.9))
+
+# ------------------------------------------------------------
+# Message-IDs of our own outbound replies carry the task id, so a
+# reply's In-Reply-To / References header tells us which task it is for
+# ------------------------------------------------------------
+_TASK_MSGID_RE = re.compile(r"\.task-(\d{1,9})@", re.IGNORECASE)
+
+
+def task_message_id(task_id, from_address=None):
+    """Message-ID for an outbound mail about task_id, e.g. <...task-42@icici.com>."""
+    address = from_address or os.getenv("EMAIL_ADDRESS") or ""
+    domain = address.rsplit("@", 1)[-1] if "@" in address else None
+    return make_msgid(idstring=f"task-{int(task_id)}", domain=domain)
+
+
+def task_id_from_headers(headers):
+    """Return the task id referenced by In-Reply-To / References, or None."""
+    if not headers:
+        return None
+    for name in ("in_reply_to", "references"):
+        value = headers.get(name) or ""
+        # References lists oldest first; the most recent task wins
+        ids = _TASK_MSGID_RE.findall(value)
+        if ids:
+            return int(ids[-1])
+    return None
+
+
+# ------------------------------------------------------------
+# Compiled rules
+# ------------------------------------------------------------
+# Subject of the replies sent from /send_reply (see app.send_reply)
+OUR_SUBJECT_RE = re.compile(r"update on your request:.*\(task\s+(\d{1,9})\)", re.IGNORECASE)
+GENERIC_ID_RE = re.compile(r"(?:task|ticket|id)\s*[:#]?\s*(\d{1,6})", re.IGNORECASE)
+REPLY_PREFIX_RE = re.compile(r"^\s*(?:re|aw|sv|antw)\s*:", re.IGNORECASE)
+
+RESOLVED_KEYWORDS = ["resolved", "done", "completed", "issue fixed", "fixed", "solved", "closed", "no longer needed"]
+PENDING_KEYWORDS = ["in progress", "working on", "pending", "not yet"]
+
+
+def _keyword_re(words):
+    return re.compile(r"\b(?:" + "|".join(re.escape(w) for w in words) + r")\b", re.IGNORECASE)
+
+
+RESOLVED_RE = _keyword_re(RESOLVED_KEYWORDS)
+PENDING_RE = _keyword_re(PENDING_KEYWORDS)
+# "not fixed", "didn't fix it", "hasn’t been resolved yet", "still not really done"
+NEGATED_RE = re.compile(
+    r"\b(?:not|never|\w+n['’]t)\s+(?:(?:yet|been|really|get|got|be|fully|quite)\s+){0,2}"
+    r"(?:resolved?|done|complete[d]?|fix(?:ed)?|solved?|closed?)\b",
+    re.IGNORECASE,
+)
+# Start of the quoted original in a reply ("On Mon, ... wrote:", Outlook header)
+QUOTE_START_RE = re.compile(
+    r"^(?:on .{0,200}wrote:|-{2,}\s*original message\s*-{2,}|from:\s.+)$",
+    re.IGNORECASE | re.MULTILINE,
+)
+
+
+def strip_quoted(body):
+    """Keep only the text the sender actually wrote in this reply."""
+    text = body or ""
+    match = QUOTE_START_RE.search(text)
+    if match:
+        text = text[:match.start()]
+    return "\n".join(line for line in text.splitlines() if not line.lstrip().startswith(">"))
+
+
+def reply_status(reply_text):
+    """(new_status, confidence) from the keywords in the sender's own text."""
+    negated = bool(NEGATED_RE.search(reply_text))
+    resolved = bool(RESOLVED_RE.search(reply_text)) and not negated
+    pending = bool(PENDING_RE.search(reply_text)) or negated
+
+    if resolved and not pending:
+        return "resolved", 0.95
+    if pending and not resolved:
+        return "pending", (0.7 if negated else 0.9)
+    if resolved and pending:
+        return None, 0.5
+    # a plain "thanks" or "it works now" - let the LLM read it
+    return None, 0.7
+
+
+# ------------------------------------------------------------
+# Counters
+# ------------------------------------------------------------
+_stats_lock = threading.Lock()
+_stats = {"checked": 0, "decided": 0, "status_updates": 0, "new_requests": 0, "llm_calls_saved": 0}
+
+
+def record_saved_calls(n):
+    with _stats_lock:
+        _stats["llm_calls_saved"] += n
+
+
+def stats():
+    with _stats_lock:
+        data = dict(_stats)
+    data["hit_rate"] = round(data["decided"] / data["checked"], 4) if data["checked"] else 0.0
+    return data
+
+
+# ------------------------------------------------------------
+# Rule engine
+# ------------------------------------------------------------
+def preclassify(subject, body, headers=None):
+    """
+    Deterministic status-update check that runs before the LLM. Returns
+
+    {"is_status_update", "task_id", "new_status", "confidence", "rule", "certain"}
+
+    "certain" is True when confidence >= MIN_CONFIDENCE, in which case the
+    caller should trust the verdict and not call the LLM.
+    """
+    subject = subject or ""
+    reply_text = strip_quoted(body)
+
+    # --- which task (if any) does this email refer to? ---
+    task_id, id_conf, rule = task_id_from_headers(headers), 0.0, None
+    if task_id is not None:
+        id_conf, rule = 1.0, "reply_header"
+    else:
+        match = OUR_SUBJECT_RE.search(subject)
+        if match:
+            task_id, id_conf, rule = int(match.group(1)), 0.95, "our_subject"
+        else:
+            match = GENERIC_ID_RE.search(subject) or GENERIC_ID_RE.search(reply_text)
+            if match:
+                task_id, id_conf, rule = int(match.group(1)), 0.6, "generic_id"
+
+    # --- what does the sender say about it? ---
+    new_status, status_conf = reply_status(reply_text)
+
+    if task_id is None:
+        # nothing points at an existing task and it is not a reply to us.
+        # Kept below MIN_CONFIDENCE: the rules cannot tell a new request
+        # from an update on a task they have no id for, so the LLM decides.
+        in_thread = bool((headers or {}).get("in_reply_to")) or bool(REPLY_PREFIX_RE.match(subject))
+        verdict = {
+            "is_status_update": False,
+            "task_id": None,
+            "new_status": None,
+            "confidence": 0.6 if in_thread else 0.8,
+            "rule": "no_task_reference",
+        }
+    else:
+        verdict = {
+            "is_status_update": True,
+            "task_id": task_id,
+            "new_status": new_status,
+            "confidence": round(min(id_conf, status_conf), 2),
+            "rule": rule,
+        }
+    verdict["certain"] = verdict["confidence"] >= MIN_CONFIDENCE
+
+    with _stats_lock:
+        _stats["checked"] += 1
+        if verdict["certain"]:
+            _stats["decided"] += 1
+            _stats["status_updates" if verdict["is_status_update"] else "new_requests"] += 1
+    return verdict
@@ -0,0 +1,69 @@
+# project_filters.py
+"""
+WHERE-clause builders for project lookups. They compare against the
+persisted lower-cased columns from migration 0004 (dept_norm, status_norm,
+priority_norm, owner_email_norm, owner_email_rev) so SQL Server can seek
+on an index instead of scanning every row through LOWER(...).
+
+The email columns are built from owner_address (migration 0010), the
+bare address db_writer extracts from the raw From header with
+email_address(); owner_email itself keeps the display name.
+"""
+from email.utils import parseaddr
+
+# emails longer than this are not indexed (matches the computed columns)
+EMAIL_INDEX_LENGTH = 320
+
+
+def normalize(value):
+    return (value or "").strip().lower()
+
+
+def email_address(value):
+    """'Alice <Alice@Corp.com>' -> 'alice@corp.com' (what owner_address stores)."""
+    address = parseaddr(value or "")[1]
+    return normalize(address if "@" in address else value)[:EMAIL_INDEX_LENGTH]
+
+
+def like_escape(value):
+    """Escape LIKE wildcards so user input only ever matches literally."""
+    return value.replace("[", "[[]").replace("%", "[%]").replace("_", "[_]")
+
+
+def email_predicate(term, alias=""):
+    """
+    Email search without a leading wildcard:
+      - "a@b.com"        exact address    owner_email_norm = ?
+      - "@b.com"         domain / suffix  owner_email_rev LIKE 'moc.b@%'
+      - "alice"          prefix           owner_email_norm LIKE 'alice%'
+    A pasted "Name <address>" is reduced to the address first.
+    Returns (sql, params).
+    """
+    term = email_address(term) if "<" in (term or "") else normalize(term)[:EMAIL_INDEX_LENGTH]
+    col = f"{alias}." if alias else ""
+    if "@" in term and not term.startswith("@"):
+        if term.partition("@")[2]:
+            return f"{col}owner_email_norm = ?", [term]
+        return f"{col}owner_email_norm LIKE ?", [like_escape(term) + "%"]
+    if term.startswith("@"):
+        return f"{col}owner_email_rev LIKE ?", [like_escape(term[::-1]) + "%"]
+    return f"{col}owner_email_norm LIKE ?", [like_escape(term) + "%"]
+
+
+def project_filters(dept=None, status=None, priority=None, email=None, alias=""):
+    """
+    AND-ed conditions for the department / sender views. Empty arguments
+    are skipped. Returns (sql, params); sql is "1 = 1" when nothing applies.
+    """
+    col = f"{alias}." if alias else ""
+    clauses, params = [], []
+    for column, value in (("dept_norm", dept), ("status_norm", status), ("priority_norm", priority)):
+        value = normalize(value)
+        if value:
+            clauses.append(f"{col}{column} = ?")
+            params.append(value)
+    if normalize(email):
+        sql, extra = email_predicate(email, alias)
+        clauses.append(sql)
+        params.extend(extra)
+    return (" AND ".join(clauses) or "1 = 1"), params
@@ -0,0 +1,295 @@
+# project_repository.py
+"""
+Project reads shared by the Flask routes. A page of projects, the newest
+updates of each project and (optionally) the filter totals all come back
+from one batch with several result sets. The page ids are staged in
+#page, so there is no IN list and no parameter cap.
+"""
+import os
+import json
+import threading
+from collections import namedtuple
+from datetime import datetime
+
+import metrics
+from db_writer import get_connection
+from project_filters import normalize, project_filters, email_predicate
+
+# ------------------------------------------------------------
+# Settings
+# ------------------------------------------------------------
+DEPT_PAGE_SIZE = int(os.getenv("DEPT_PAGE_SIZE", 50))
+SENDER_PAGE_SIZE = int(os.getenv("SENDER_PAGE_SIZE", 100))
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 200))
+# newest updates returned inline per project; older ones load on demand
+UPDATES_PER_PROJECT = int(os.getenv("UPDATES_PER_PROJECT", 5))
+
+# ------------------------------------------------------------
+# Records
+# ------------------------------------------------------------
+Update = namedtuple("Update", "id message from_email update_type created_at")
+Counts = namedtuple("Counts", "total pending resolved")
+Page = namedtuple("Page", "projects next_cursor counts")
+
+
+class Project:
+    __slots__ = (
+        "id", "project_type", "owner_email", "assigned_dept", "time_required",
+        "status", "priority", "created_at", "summary", "updates", "older_updates",
+    )
+
+    def __init__(self, row):
+        (self.id, self.project_type, self.owner_email, self.assigned_dept, self.time_required,
+         self.status, self.priority, self.created_at, self.summary) = row
+        self.updates = []
+        self.older_updates = 0
+
+    @property
+    def updates_cursor(self):
+        """Cursor for the updates older than the ones already loaded."""
+        if not self.updates:
+            return None
+        first = self.updates[0]
+        return encode_cursor(first.created_at, first.id)
+
+
+# ------------------------------------------------------------
+# Keyset cursors on (created_at, id)
+# ------------------------------------------------------------
+def encode_cursor(created_at, row_id):
+    return f"{created_at.isoformat()}~{row_id}"
+
+
+def decode_cursor(value):
+    """'2024-05-01T10:00:00.123000~42' -> (datetime, 42); None if absent/invalid."""
+    if not value:
+        return None
+    try:
+        ts, row_id = value.rsplit("~", 1)
+        return datetime.fromisoformat(ts), int(row_id)
+    except ValueError:
+        return None
+
+
+def page_size(value, default=DEPT_PAGE_SIZE):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+# ------------------------------------------------------------
+# Statement cache
+# ------------------------------------------------------------
+# SQL text depends only on which filters are present, so the same few
+# strings are reused. Identical text lets pyodbc reuse the prepared
+# statement on a cursor and SQL Server reuse the cached plan.
+_statements = {}
+_stats = {"queries": 0, "statements": 0, "statement_hits": 0}
+_lock = threading.Lock()
+
+KEYSET = "(created_at < ? OR (created_at = ? AND id < ?))"
+
+PAGE_SQL = """
+SET NOCOUNT ON;
+IF OBJECT_ID('tempdb..#page') IS NOT NULL DROP TABLE #page;
+
+SELECT TOP (?) id, project_type, owner_email, assigned_dept,
+       time_required, status, priority, created_at, summary
+INTO #page
+FROM projects
+WHERE {where}
+ORDER BY created_at DESC, id DESC;
+
+SELECT id, project_type, owner_email, assigned_dept,
+       time_required, status, priority, created_at, summary
+FROM #page
+ORDER BY created_at DESC, id DESC;
+
+SELECT project_id, id, update_message, from_email, update_type, created_at, total
+FROM (
+    SELECT u.project_id, u.id, u.update_message, u.from_email, u.update_type, u.created_at,
+           ROW_NUMBER() OVER (PARTITION BY u.project_id ORDER BY u.created_at DESC, u.id DESC) AS rn,
+           COUNT(*) OVER (PARTITION BY u.project_id) AS total
+    FROM project_updates u
+    JOIN #page p ON p.id = u.project_id
+) w
+WHERE rn <= ?
+ORDER BY project_id, created_at ASC, id ASC;
+{counts}
+DROP TABLE #page;
+"""
+
+COUNTS_SQL = """
+SELECT COUNT(*),
+       SUM(CASE WHEN status_norm = 'pending' THEN 1 ELSE 0 END),
+       SUM(CASE WHEN status_norm = 'resolved' THEN 1 ELSE 0 END)
+FROM projects
+WHERE {where};
+"""
+
+UPDATES_SQL = """
+SELECT TOP (?) id, update_message, from_email, update_type, created_at
+FROM project_updates
+WHERE project_id = ?{keyset}
+ORDER BY created_at DESC, id DESC
+"""
+
+
+def statement(key, build):
+    """Return the SQL text cached under key, building it once."""
+    with _lock:
+        sql = _statements.get(key)
+        if sql is None:
+            sql = _statements[key] = build()
+            _stats["statements"] += 1
+        else:
+            _stats["statement_hits"] += 1
+    return sql
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
+
+
+def _run(cur, sql, params):
+    with _lock:
+        _stats["queries"] += 1
+    cur.execute(sql, params)
+
+
+class _Borrowed:
+    """Use the caller's cursor if given, otherwise a pooled connection."""
+
+    def __init__(self, cur):
+        self.cur = cur
+        self.conn = None
+
+    def __enter__(self):
+        if self.cur is None:
+            self.conn = get_connection()
+            self.cur = self.conn.cursor()
+        return self.cur
+
+    def __exit__(self, *exc):
+        if self.conn is not None:
+            self.conn.close()
+
+
+# ------------------------------------------------------------
+# Queries
+# ------------------------------------------------------------
+@metrics.timed("db_seconds", function="repo.find_department")
+def find_department(name, cur=None):
+    """Canonical department name for a case-insensitive match, or None."""
+    with _Borrowed(cur) as cur:
+        _run(cur, "SELECT name FROM departments WHERE name_norm = ?", (normalize(name),))
+        row = cur.fetchone()
+    return row[0] if row else None
+
+
+@metrics.timed("db_seconds", function="repo.fetch_page")
+def fetch_page(where, params, limit, before=None, with_counts=False,
+               per_project=UPDATES_PER_PROJECT, cur=None):
+    """
+    One round-trip: up to `limit` projects matching where/params (newest
+    first, older than `before`), their newest `per_project` updates and,
+    with_counts, total/pending/resolved over the whole filter.
+    """
+    cursor = decode_cursor(before) if isinstance(before, str) else before
+    page_where = f"{where} AND {KEYSET}" if cursor else where
+
+    def build():
+        counts = COUNTS_SQL.format(where=where) if with_counts else ""
+        return PAGE_SQL.format(where=page_where, counts=counts)
+
+    sql = statement(("page", page_where, with_counts), build)
+    args = [limit + 1] + list(params)
+    if cursor:
+        args += [cursor[0], cursor[0], cursor[1]]
+    args.append(per_project)
+    if with_counts:
+        args += list(params)
+
+    with _Borrowed(cur) as cur:
+        _run(cur, sql, args)
+        projects = [Project(r) for r in cur.fetchall()]
+        cur.nextset()
+        update_rows = cur.fetchall()
+        counts = None
+        if with_counts:
+            cur.nextset()
+            total, pending, resolved = cur.fetchone()
+            counts = Counts(total, pending or 0, resolved or 0)
+        while cur.nextset():
+            pass
+
+    next_cursor = None
+    if len(projects) > limit:
+        # the extra row only tells us an older page exists
+        projects = projects[:limit]
+        next_cursor = encode_cursor(projects[-1].created_at, projects[-1].id)
+
+    by_id = {p.id: p for p in projects}
+    for project_id, uid, message, from_email, update_type, created_at, total in update_rows:
+        p = by_id.get(project_id)
+        if p is None:
+            continue
+        p.updates.append(Update(uid, message, from_email, update_type, created_at))
+        p.older_updates = max(0, total - per_project)
+
+    return Page(projects, next_cursor, counts)
+
+
+def department_page(dept, status=None, priority=None, email=None,
+                    limit=DEPT_PAGE_SIZE, before=None, cur=None):
+    where, params = project_filters(dept, status, priority, email)
+    return fetch_page(where, params, limit, before, cur=cur)
+
+
+def sender_page(email, limit=SENDER_PAGE_SIZE, before=None, cur=None):
+    """Sender view: the page plus totals over every matching project."""
+    where, params = email_predicate(email)
+    return fetch_page(where, params, limit, before, with_counts=True, cur=cur)
+
+
+@metrics.timed("db_seconds", function="repo.projects_by_ids")
+def projects_by_ids(ids, cur=None):
+    """{id: Project} for the given ids in one query (ids go as one JSON parameter)."""
+    if not ids:
+        return {}
+    sql = statement(("by_ids",), lambda: """
+        SELECT p.id, p.project_type, p.owner_email, p.assigned_dept,
+               p.time_required, p.status, p.priority, p.created_at, p.summary
+        FROM projects p
+        JOIN OPENJSON(?) WITH (id INT '$') j ON j.id = p.id
+    """)
+    with _Borrowed(cur) as cur:
+        _run(cur, sql, (json.dumps(sorted({int(i) for i in ids})),))
+        return {r[0]: Project(r) for r in cur.fetchall()}
+
+
+@metrics.timed("db_seconds", function="repo.project_updates")
+def project_updates(project_id, limit, before=None, cur=None):
+    """
+    Updates of one project older than `before`, oldest first. Returns
+    (updates, next_cursor).
+    """
+    cursor = decode_cursor(before) if isinstance(before, str) else before
+    keyset = f" AND {KEYSET}" if cursor else ""
+    sql = statement(("updates", bool(cursor)), lambda: UPDATES_SQL.format(keyset=keyset))
+    args = [limit + 1, project_id]
+    if cursor:
+        args += [cursor[0], cursor[0], cursor[1]]
+
+    with _Borrowed(cur) as cur:
+        _run(cur, sql, args)
+        rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].created_at, rows[-1].id)
+    return [Update(*r) for r in reversed(rows)], next_cursor
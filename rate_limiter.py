@@ -0,0 +1,130 @@
+# rate_limiter.py
+import os
+import time
+import random
+import asyncio
+
+# Groq limits for the model we use (requests / tokens per minute)
+GROQ_RPM = float(os.getenv("GROQ_RPM", 30))
+GROQ_TPM = float(os.getenv("GROQ_TPM", 6000))
+LLM_MAX_IN_FLIGHT = int(os.getenv("LLM_MAX_IN_FLIGHT", 4))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", 5))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", 2.0))
+LLM_MAX_OUTPUT_TOKENS = int(os.getenv("LLM_MAX_OUTPUT_TOKENS", 300))
+
+
+def estimate_tokens(text):
+    """Rough prompt size (~4 chars per token) used for TPM budgeting."""
+    return max(1, len(text or "") // 4)
+
+
+class TokenBucket:
+    """
+    Async token bucket refilled continuously at rate_per_minute / 60 per
+    second. Waiters are served in arrival order.
+    """
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.capacity = float(capacity or rate_per_minute)
+        self.fill_rate = rate_per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.fill_rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        amount = min(float(amount), self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.fill_rate)
+
+    def adjust(self, delta):
+        """Correct an estimate once the real usage is known (delta may be negative)."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+
+def is_rate_limited(exc):
+    if getattr(exc, "status_code", None) == 429:
+        return True
+    text = str(exc).lower()
+    return "429" in text or "rate limit" in text or "rate_limit" in text
+
+
+def retry_after(exc):
+    """Seconds from a Retry-After header on the provider error, if any."""
+    response = getattr(exc, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def _used_tokens(response):
+    usage = getattr(response, "usage_metadata", None) or {}
+    if usage.get("total_tokens"):
+        return usage["total_tokens"]
+    meta = getattr(response, "response_metadata", None) or {}
+    return (meta.get("token_usage") or {}).get("total_tokens")
+
+
+class LLMScheduler:
+    """
+    Wraps an async invoke callable (e.g. ChatGroq.ainvoke) with
+    requests/min and tokens/min buckets, an in-flight cap and
+    jittered exponential backoff on 429s. Call it like ainvoke:
+
+        scheduler = LLMScheduler(llm.ainvoke)
+        response = await scheduler(prompt)
+    """
+
+    def __init__(self, ainvoke, rpm=GROQ_RPM, tpm=GROQ_TPM, max_in_flight=LLM_MAX_IN_FLIGHT,
+                 max_retries=LLM_MAX_RETRIES, base_delay=LLM_RETRY_BASE_DELAY,
+                 max_output_tokens=LLM_MAX_OUTPUT_TOKENS):
+        self._ainvoke = ainvoke
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self._in_flight = asyncio.Semaphore(max_in_flight)
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_output_tokens = max_output_tokens
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "failures": 0, "in_flight": 0}
+
+    async def __call__(self, prompt):
+        estimate = estimate_tokens(prompt) + self.max_output_tokens
+        attempt = 0
+        while True:
+            await self.requests.acquire(1)
+            await self.tokens.acquire(estimate)
+            async with self._in_flight:
+                self.stats["in_flight"] += 1
+                try:
+                    response = await self._ainvoke(prompt)
+                except Exception as e:
+                    if not is_rate_limited(e) or attempt >= self.max_retries:
+                        self.stats["failures"] += 1
+                        raise
+                    self.stats["rate_limited"] += 1
+                    delay = retry_after(e) or self.base_delay * (2 ** attempt)
+                else:
+                    self.stats["calls"] += 1
+                    used = _used_tokens(response)
+                    if used:
+                        self.tokens.adjust(used - estimate)
+                    return response
+                finally:
+                    self.stats["in_flight"] -= 1
+
+            # jitter so a burst of 429s does not retry in lockstep
+            attempt += 1
+            self.stats["retries"] += 1
+            await asyncio.sleep(random.uniform(0.5, 1.5) * delay)
@@ -0,0 +1,239 @@
+# read_cache.py
+"""
+Read-through cache for the department list and department pages.
+
+Every department has a generation number that is part of each cache key
+for that department. db_writer bumps it after committing a write that
+touches the department, so later reads miss and reload. Entries written
+under the old generation are never read again and age out of the LRU.
+Because a reader takes the generation *before* querying, a page loaded
+from pre-commit data is stored under the old generation and is never
+served after the bump.
+
+Backends:
+  memory  per-process (default). Writes made in another process (the
+          ingest loop) are seen after at most READ_CACHE_TTL seconds.
+  redis   shared through REDIS_URL. Every process sees the bump at once;
+          TTL only bounds writes that bypass db_writer.
+"""
+import os
+import time
+import pickle
+import threading
+from collections import OrderedDict
+
+READ_CACHE_ENABLED = os.getenv("READ_CACHE_ENABLED", "1") == "1"
+READ_CACHE_BACKEND = os.getenv("READ_CACHE_BACKEND", "memory")
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+READ_CACHE_TTL = float(os.getenv("READ_CACHE_TTL", 30))
+DEPARTMENTS_CACHE_TTL = float(os.getenv("DEPARTMENTS_CACHE_TTL", 300))
+READ_CACHE_MAX_ENTRIES = int(os.getenv("READ_CACHE_MAX_ENTRIES", 2000))
+KEY_PREFIX = os.getenv("READ_CACHE_PREFIX", "appless:")
+
+
+# ------------------------------------------------------------
+# Backends
+# ------------------------------------------------------------
+class MemoryBackend:
+    """LRU dict of key -> (value, stored_at, expires_at)."""
+
+    shared = False
+
+    def __init__(self, max_entries=READ_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._data = OrderedDict()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[2] <= time.time():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[0], entry[1]
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._data[key] = (value, now, now + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def size(self):
+        return len(self._data)
+
+
+class RedisBackend:
+    """Values are pickled; generations are plain INCR counters."""
+
+    shared = True
+
+    def __init__(self, url=REDIS_URL):
+        import redis  # optional dependency, only needed for this backend
+        self.client = redis.Redis.from_url(url)
+
+    def get(self, key):
+        raw = self.client.get(KEY_PREFIX + key)
+        if raw is None:
+            return None
+        return pickle.loads(raw)
+
+    def set(self, key, value, ttl):
+        payload = pickle.dumps((value, time.time()), protocol=pickle.HIGHEST_PROTOCOL)
+        self.client.set(KEY_PREFIX + key, payload, ex=max(1, int(ttl)))
+
+    def counter(self, key):
+        raw = self.client.get(KEY_PREFIX + key)
+        return int(raw) if raw else 0
+
+    def incr(self, key):
+        return self.client.incr(KEY_PREFIX + key)
+
+    def clear(self):
+        for key in self.client.scan_iter(KEY_PREFIX + "*"):
+            self.client.delete(key)
+
+    def size(self):
+        return None
+
+
+# ------------------------------------------------------------
+# Cache
+# ------------------------------------------------------------
+def _norm(dept):
+    return (dept or "").strip().lower()
+
+
+class ReadCache:
+    def __init__(self, backend=None, ttl=READ_CACHE_TTL, enabled=READ_CACHE_ENABLED):
+        self.backend = backend or MemoryBackend()
+        self.ttl = ttl
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._totals = {"invalidations": 0, "errors": 0, "max_served_age": 0.0}
+
+    def _count(self, kind, field):
+        with self._lock:
+            per_kind = self._stats.setdefault(kind, {"hits": 0, "misses": 0})
+            per_kind[field] += 1
+
+    def _count_total(self, field):
+        with self._lock:
+            self._totals[field] += 1
+
+    def generation(self, dept):
+        return self.backend.counter(f"gen:{_norm(dept)}")
+
+    def get_or_load(self, kind, dept, params, loader, ttl=None):
+        """
+        Return the cached value for (kind, dept, params), calling loader()
+        on a miss. params must have a stable repr (tuples of str/int).
+        """
+        if not self.enabled:
+            return loader()
+        try:
+            key = f"{kind}:{_norm(dept)}:{self.generation(dept)}:{params!r}"
+            entry = self.backend.get(key)
+        except Exception as e:
+            print("❌ Read cache error:", e)
+            self._count_total("errors")
+            return loader()
+
+        if entry is not None:
+            value, stored_at = entry
+            age = time.time() - stored_at
+            with self._lock:
+                self._totals["max_served_age"] = max(self._totals["max_served_age"], age)
+            self._count(kind, "hits")
+            return value
+
+        self._count(kind, "misses")
+        value = loader()
+        try:
+            self.backend.set(key, value, ttl or self.ttl)
+        except Exception as e:
+            print("❌ Read cache error:", e)
+            self._count_total("errors")
+        return value
+
+    def invalidate(self, *depts):
+        """Bump the generation of every department given (call after commit)."""
+        if not self.enabled:
+            return
+        for dept in {_norm(d) for d in depts if d}:
+            try:
+                self.backend.incr(f"gen:{dept}")
+                self._count_total("invalidations")
+            except Exception as e:
+                print("❌ Read cache invalidation error:", e)
+                self._count_total("errors")
+
+    def stats(self):
+        with self._lock:
+            kinds = {k: dict(v) for k, v in self._stats.items()}
+            totals = dict(self._totals)
+        hits = sum(v["hits"] for v in kinds.values())
+        misses = sum(v["misses"] for v in kinds.values())
+        for v in kinds.values():
+            lookups = v["hits"] + v["misses"]
+            v["hit_ratio"] = round(v["hits"] / lookups, 4) if lookups else 0.0
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "shared": self.backend.shared,
+            "entries": self.backend.size(),
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": round(hits / (hits + misses), 4) if hits + misses else 0.0,
+            "kinds": kinds,
+            "invalidations": totals["invalidations"],
+            "errors": totals["errors"],
+            # oldest entry served so far
+            "max_served_age_seconds": round(totals["max_served_age"], 3),
+            # worst case for a write this cache was not told about (another
+            # process on the memory backend, or SQL outside db_writer);
+            # invalidated writes are never served stale
+            "stale_bound_seconds": {"pages": self.ttl, "departments": DEPARTMENTS_CACHE_TTL},
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Process-wide ReadCache; the backend comes from READ_CACHE_BACKEND."""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            backend = None
+            if READ_CACHE_BACKEND == "redis":
+                try:
+                    backend = RedisBackend()
+                except Exception as e:
+                    print("❌ Redis read cache unavailable, using memory:", e)
+            _cache = ReadCache(backend)
+        return _cache
+
+
+def invalidate_departments(*depts):
+    get_cache().invalidate(*depts)
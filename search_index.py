@@ -0,0 +1,363 @@
+# search_index.py
+"""
+Keyword search over project summaries and update messages.
+
+Backends (SEARCH_BACKEND):
+  mssql  SQL Server full-text indexes (set up with --setup-fulltext);
+         SQL Server keeps them current itself.
+  local  SQLite FTS5 file kept current by db_writer's write hooks
+         (index_projects / index_updates / index_status).
+  auto   mssql when both full-text indexes exist, local otherwise.
+  off    no search, hooks do nothing.
+
+Both backends rank matching projects: the best match among the project
+and its updates, with ties broken by the newest id. Facets and paging are
+computed over at most SEARCH_MAX_MATCHES top-ranked hits.
+
+    python search_index.py --rebuild          refill the local index from the DB
+    python search_index.py --setup-fulltext   create the SQL Server FTS catalog/indexes
+"""
+import os
+import re
+import sys
+import sqlite3
+import threading
+
+import db_writer
+
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "auto")
+SEARCH_INDEX_PATH = os.getenv("SEARCH_INDEX_PATH", "search_index.sqlite3")
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 20))
+SEARCH_MAX_MATCHES = int(os.getenv("SEARCH_MAX_MATCHES", 5000))
+REBUILD_CHUNK = 5000
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def query_terms(q):
+    """Lower-cased word tokens; everything else in the query is ignored."""
+    return [t.lower() for t in _TOKEN_RE.findall(q or "")][:16]
+
+
+def _project_text(project_type, summary):
+    return f"{project_type or ''}\n{summary or ''}"
+
+
+# ------------------------------------------------------------
+# Local backend: SQLite FTS5
+# ------------------------------------------------------------
+class LocalIndex:
+    """
+    docs holds one row per project (rowid 2*id) and per update
+    (rowid 2*id+1), so re-indexing the same row replaces it.
+    project_meta carries the facet fields.
+    """
+
+    def __init__(self, path=SEARCH_INDEX_PATH):
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(
+                body, project_id UNINDEXED, kind UNINDEXED,
+                tokenize = 'unicode61 remove_diacritics 2'
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS project_meta (
+                project_id INTEGER PRIMARY KEY,
+                dept TEXT,
+                status TEXT
+            )
+        """)
+        self._db.commit()
+
+    def add_projects(self, rows):
+        """rows: (project_id, project_type, summary, dept, status)"""
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO docs (rowid, body, project_id, kind) VALUES (?, ?, ?, 'project')",
+                [(2 * pid, _project_text(ptype, summary), pid) for pid, ptype, summary, _, _ in rows],
+            )
+            self._db.executemany(
+                "INSERT OR REPLACE INTO project_meta (project_id, dept, status) VALUES (?, ?, ?)",
+                [(pid, (dept or "").lower(), (status or "").lower()) for pid, _, _, dept, status in rows],
+            )
+            self._db.commit()
+
+    def add_updates(self, rows):
+        """rows: (update_id, project_id, update_message)"""
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO docs (rowid, body, project_id, kind) VALUES (?, ?, ?, 'update')",
+                [(2 * uid + 1, message or "", pid) for uid, pid, message in rows],
+            )
+            self._db.commit()
+
+    def set_status(self, project_ids, status):
+        with self._lock:
+            self._db.executemany(
+                "UPDATE project_meta SET status = ? WHERE project_id = ?",
+                [((status or "").lower(), pid) for pid in project_ids],
+            )
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM docs")
+            self._db.execute("DELETE FROM project_meta")
+            self._db.commit()
+
+    def candidates(self, terms, max_matches=SEARCH_MAX_MATCHES):
+        """[(project_id, score, matches, dept, status)], higher score = better."""
+        match = " AND ".join(f'"{t}"*' for t in terms)
+        with self._lock:
+            rows = self._db.execute("""
+                WITH m AS (
+                    SELECT project_id, bm25(docs) AS score
+                    FROM docs WHERE docs MATCH ?
+                    ORDER BY rank LIMIT ?
+                )
+                SELECT m.project_id, -MIN(m.score), COUNT(*), pm.dept, pm.status
+                FROM m LEFT JOIN project_meta pm ON pm.project_id = m.project_id
+                GROUP BY m.project_id
+            """, (match, max_matches)).fetchall()
+        return rows
+
+
+# ------------------------------------------------------------
+# SQL Server backend: CONTAINSTABLE
+# ------------------------------------------------------------
+MSSQL_CANDIDATES_SQL = """
+SELECT h.project_id, MAX(h.rank), COUNT(*), p.dept_norm, p.status_norm
+FROM (
+    SELECT k.[KEY] AS project_id, k.[RANK] AS rank
+    FROM CONTAINSTABLE(projects, (project_type, summary), ?, {top}) k
+    UNION ALL
+    SELECT u.project_id, k.[RANK]
+    FROM CONTAINSTABLE(project_updates, update_message, ?, {top}) k
+    JOIN project_updates u ON u.id = k.[KEY]
+) h
+JOIN projects p ON p.id = h.project_id
+GROUP BY h.project_id, p.dept_norm, p.status_norm
+"""
+
+SETUP_FULLTEXT = [
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.fulltext_catalogs WHERE name = 'ticket_search')
+        CREATE FULLTEXT CATALOG ticket_search
+    """,
+    # the key index is whatever the primary key is called
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID('projects'))
+    BEGIN
+        DECLARE @pk SYSNAME = (SELECT name FROM sys.indexes
+                               WHERE object_id = OBJECT_ID('projects') AND is_primary_key = 1);
+        EXEC('CREATE FULLTEXT INDEX ON projects (project_type, summary) KEY INDEX '
+             + QUOTENAME(@pk) + ' ON ticket_search WITH CHANGE_TRACKING AUTO');
+    END
+    """,
+    """
+    IF NOT EXISTS (SELECT 1 FROM sys.fulltext_indexes WHERE object_id = OBJECT_ID('project_updates'))
+    BEGIN
+        DECLARE @pk SYSNAME = (SELECT name FROM sys.indexes
+                               WHERE object_id = OBJECT_ID('project_updates') AND is_primary_key = 1);
+        EXEC('CREATE FULLTEXT INDEX ON project_updates (update_message) KEY INDEX '
+             + QUOTENAME(@pk) + ' ON ticket_search WITH CHANGE_TRACKING AUTO');
+    END
+    """,
+]
+
+
+def setup_fulltext():
+    """Full-text DDL cannot run inside a transaction, so this uses autocommit."""
+    conn = db_writer.get_connection()
+    raw = conn.raw
+    try:
+        raw.autocommit = True
+        cur = raw.cursor()
+        cur.execute("SELECT CAST(FULLTEXTSERVICEPROPERTY('IsFullTextInstalled') AS INT)")
+        if not cur.fetchone()[0]:
+            print("❌ Full-text search is not installed on this SQL Server; use SEARCH_BACKEND=local")
+            return False
+        for sql in SETUP_FULLTEXT:
+            cur.execute(sql)
+        print("✅ Full-text catalog and indexes are in place")
+        return True
+    finally:
+        raw.autocommit = False
+        conn.close()
+
+
+def _mssql_candidates(terms, max_matches=SEARCH_MAX_MATCHES):
+    condition = " AND ".join(f'"{t}*"' for t in terms)
+    conn = db_writer.get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(MSSQL_CANDIDATES_SQL.format(top=int(max_matches)), (condition, condition))
+        return [tuple(r) for r in cur.fetchall()]
+    finally:
+        conn.close()
+
+
+# ------------------------------------------------------------
+# Backend selection
+# ------------------------------------------------------------
+_backend = None
+_local = None
+_backend_lock = threading.Lock()
+
+
+def _detect():
+    conn = db_writer.get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT COUNT(*) FROM sys.fulltext_indexes
+            WHERE object_id IN (OBJECT_ID('projects'), OBJECT_ID('project_updates'))
+        """)
+        return "mssql" if cur.fetchone()[0] == 2 else "local"
+    except Exception:
+        return "local"
+    finally:
+        conn.close()
+
+
+def backend():
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _detect() if SEARCH_BACKEND == "auto" else SEARCH_BACKEND
+        return _backend
+
+
+def get_local_index():
+    global _local
+    with _backend_lock:
+        if _local is None:
+            _local = LocalIndex()
+        return _local
+
+
+# ------------------------------------------------------------
+# Write hooks (called by db_writer after commit)
+# ------------------------------------------------------------
+def _hook(fn, *args):
+    try:
+        if backend() == "local":
+            fn(get_local_index(), *args)
+    except Exception as e:
+        # the index can be refilled with --rebuild; never fail the write
+        print("❌ Search index update failed:", e)
+
+
+def index_projects(rows):
+    """rows: (project_id, project_type, summary, dept, status)"""
+    if rows:
+        _hook(LocalIndex.add_projects, rows)
+
+
+def index_updates(rows):
+    """rows: (update_id, project_id, update_message)"""
+    if rows:
+        _hook(LocalIndex.add_updates, rows)
+
+
+def index_status(project_ids, status):
+    if project_ids:
+        _hook(LocalIndex.set_status, project_ids, status)
+
+
+# ------------------------------------------------------------
+# Query
+# ------------------------------------------------------------
+def search(q, dept=None, status=None, page=1, page_size=SEARCH_PAGE_SIZE):
+    """
+    Returns {"total", "results", "facets": {"dept": {...}, "status": {...}},
+    "page", "page_size", "capped", "backend"}. results are project records
+    (project_repository.Project) with .score and .matches added.
+    """
+    import project_repository as repo
+
+    terms = query_terms(q)
+    dept = (dept or "").strip().lower()
+    status = (status or "").strip().lower()
+    name = backend()
+    empty = {"total": 0, "results": [], "facets": {"dept": {}, "status": {}},
+             "page": page, "page_size": page_size, "capped": False, "backend": name}
+    if not terms or name == "off":
+        return empty
+
+    if name == "mssql":
+        candidates = _mssql_candidates(terms)
+    else:
+        candidates = get_local_index().candidates(terms)
+
+    # each facet counts hits under the *other* filter, so picking a
+    # department still shows how the statuses split (and vice versa)
+    facets = {"dept": {}, "status": {}}
+    hits = []
+    for project_id, score, matches, d, s in candidates:
+        d, s = d or "", s or ""
+        if not status or s == status:
+            facets["dept"][d] = facets["dept"].get(d, 0) + 1
+        if not dept or d == dept:
+            facets["status"][s] = facets["status"].get(s, 0) + 1
+        if (not dept or d == dept) and (not status or s == status):
+            hits.append((score, project_id, matches))
+
+    hits.sort(key=lambda h: (h[0], h[1]), reverse=True)
+    start = (max(1, page) - 1) * page_size
+    window = hits[start:start + page_size]
+    records = repo.projects_by_ids([pid for _, pid, _ in window])
+
+    results = []
+    for score, project_id, matches in window:
+        record = records.get(project_id)
+        if record is None:
+            continue  # deleted since it was indexed
+        results.append({"project": record, "score": round(float(score), 4), "matches": matches})
+
+    return dict(empty, total=len(hits), results=results, facets=facets,
+                capped=len(candidates) >= SEARCH_MAX_MATCHES)
+
+
+# ------------------------------------------------------------
+# Rebuild
+# ------------------------------------------------------------
+def rebuild():
+    """Stream every project and update from SQL Server into the local index."""
+    index = get_local_index()
+    index.clear()
+    conn = db_writer.get_connection()
+    counts = {"projects": 0, "updates": 0}
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT id, project_type, summary, assigned_dept, status FROM projects")
+        while True:
+            rows = cur.fetchmany(REBUILD_CHUNK)
+            if not rows:
+                break
+            index.add_projects([tuple(r) for r in rows])
+            counts["projects"] += len(rows)
+        cur.execute("SELECT id, project_id, update_message FROM project_updates")
+        while True:
+            rows = cur.fetchmany(REBUILD_CHUNK)
+            if not rows:
+                break
+            index.add_updates([tuple(r) for r in rows])
+            counts["updates"] += len(rows)
+    finally:
+        conn.close()
+    print(f"✅ Search index rebuilt: {counts['projects']} projects, {counts['updates']} updates")
+    return counts
+
+
+if __name__ == "__main__":
+    if "--setup-fulltext" in sys.argv[1:]:
+        setup_fulltext()
+    elif "--rebuild" in sys.argv[1:]:
+        rebuild()
+    else:
+        print(__doc__)
@@ -0,0 +1,292 @@
+# thread_index.py
+"""
+Thread index: maps an email's thread keys to the project it belongs to,
+so follow-ups and duplicate deliveries never reach the LLM.
+
+Keys (thread_keys, migration 0007) are the first 16 bytes of
+SHA-256(UTF-16LE("<kind>:<value>")) - the same bytes SQL Server's
+HASHBYTES gives for an NVARCHAR, so the migration can backfill them:
+
+  m  a Message-ID we stored (project source mail, sender updates and our
+     own outbound replies); a later In-Reply-To / References to it
+     attaches the email to that project
+  s  sender address + normalized subject ("RE: Fwd: VPN down" -> "vpn
+     down"); only matches while the project is open and the key was seen
+     within THREAD_SUBJECT_WINDOW_DAYS
+
+db_writer records keys in the same transaction as the insert, and
+email_reader resolves a whole batch of emails with one primary-key
+lookup query before classification. Emails of one drain are classified
+in parallel, so a reply can be classified before its original is
+written; the writer stage checks new projects again (recheck) against
+the index and the Message-IDs written earlier in the drain.
+"""
+import os
+import re
+import json
+import hashlib
+import threading
+from email.utils import parseaddr
+
+import db_writer
+import metrics
+import preclassifier
+from llm_cache import normalize_subject
+
+THREAD_INDEX_ENABLED = os.getenv("THREAD_INDEX_ENABLED", "1") == "1"
+THREAD_SUBJECT_WINDOW_DAYS = int(os.getenv("THREAD_SUBJECT_WINDOW_DAYS", 30))
+# "help", "urgent", "issue" ... are too generic to thread on
+THREAD_SUBJECT_MIN_CHARS = int(os.getenv("THREAD_SUBJECT_MIN_CHARS", 8))
+# References can list a whole thread; the newest ids are the useful ones
+MAX_REFERENCES = 20
+
+_MSGID_RE = re.compile(r"<[^<>\s]+>")
+
+# lower rank wins when several keys of one email hit
+RANK_SELF, RANK_REPLY, RANK_SUBJECT = 0, 1, 1000
+
+LOOKUP_SQL = """
+    SELECT j.n, j.r, j.kind, k.project_id
+    FROM OPENJSON(?) WITH (n INT '$.n', r INT '$.r', kind CHAR(1) '$.t', k VARCHAR(32) '$.k') j
+    JOIN thread_keys k ON k.key_hash = CONVERT(BINARY(16), j.k, 2)
+    JOIN projects p ON p.id = k.project_id
+    WHERE j.kind = 'm'
+       OR (k.last_seen_at >= DATEADD(day, -?, SYSUTCDATETIME())
+           AND COALESCE(p.status_norm, '') <> 'resolved')
+"""
+
+# a Message-ID stays with its first project; a subject key follows the
+# newest project opened under that subject
+RECORD_SQL = """
+    MERGE thread_keys WITH (HOLDLOCK) AS t
+    USING (
+        SELECT CONVERT(BINARY(16), k, 2) AS key_hash, kind, project_id
+        FROM OPENJSON(?) WITH (k VARCHAR(32) '$.k', kind CHAR(1) '$.t', project_id INT '$.p')
+    ) AS s
+       ON t.key_hash = s.key_hash
+    WHEN MATCHED THEN UPDATE SET
+        project_id = CASE WHEN t.kind = 's' THEN s.project_id ELSE t.project_id END,
+        last_seen_at = SYSUTCDATETIME()
+    WHEN NOT MATCHED THEN
+        INSERT (key_hash, kind, project_id) VALUES (s.key_hash, s.kind, s.project_id);
+"""
+
+
+# ------------------------------------------------------------
+# Keys
+# ------------------------------------------------------------
+def key_hash(kind, value):
+    return hashlib.sha256(f"{kind}:{value}".encode("utf-16-le")).hexdigest()[:32].upper()
+
+
+def normalize_message_id(value):
+    return (value or "").replace("<", "").replace(">", "").strip()
+
+
+def message_ids(value):
+    """Message-IDs in a header value, in header order."""
+    return [normalize_message_id(m) for m in _MSGID_RE.findall(value or "")]
+
+
+def subject_key(subject, sender):
+    """Hash of sender + normalized subject, or None when too generic to use."""
+    address = parseaddr(sender or "")[1].strip().lower()
+    norm = normalize_subject(subject)
+    if not address or len(norm) < THREAD_SUBJECT_MIN_CHARS:
+        return None
+    return key_hash("s", f"{address}\n{norm}")
+
+
+def keys_for(message_id=None, subject=None, sender=None):
+    """[(hex_key, kind)] to record for one stored email."""
+    keys = []
+    mid = normalize_message_id(message_id)
+    if mid:
+        keys.append((key_hash("m", mid), "m"))
+    skey = subject_key(subject, sender) if subject is not None else None
+    if skey:
+        keys.append((skey, "s"))
+    return keys
+
+
+def _lookup_keys(parsed):
+    """[(rank, hex_key, kind)] to look up for one parsed email."""
+    headers = parsed.get("headers") or {}
+    keys = []
+    own = normalize_message_id(headers.get("message_id"))
+    if own:
+        keys.append((RANK_SELF, key_hash("m", own), "m"))
+    # In-Reply-To first, then References newest-first
+    refs = message_ids(headers.get("in_reply_to"))
+    refs += list(reversed(message_ids(headers.get("references"))))[:MAX_REFERENCES]
+    seen = {own}
+    for mid in refs:
+        if mid in seen:
+            continue
+        seen.add(mid)
+        keys.append((RANK_REPLY + len(keys), key_hash("m", mid), "m"))
+    skey = subject_key(parsed.get("subject"), parsed.get("sender"))
+    if skey:
+        keys.append((RANK_SUBJECT, skey, "s"))
+    return keys
+
+
+# ------------------------------------------------------------
+# Writes (called by db_writer inside its transaction)
+# ------------------------------------------------------------
+def record(cur, entries):
+    """entries: [(project_id, [(hex_key, kind), ...]), ...]"""
+    if not THREAD_INDEX_ENABLED:
+        return
+    rows = {}
+    for project_id, keys in entries:
+        if project_id is None:
+            continue
+        for key, kind in keys:
+            # MERGE rejects two source rows for one target row; last one wins
+            rows[key] = {"k": key, "t": kind, "p": int(project_id)}
+    if rows:
+        cur.execute(RECORD_SQL, (json.dumps(list(rows.values())),))
+
+
+# ------------------------------------------------------------
+# Lookup (called by email_reader before classification)
+# ------------------------------------------------------------
+_stats_lock = threading.Lock()
+_stats = {"checked": 0, "threaded": 0, "duplicates": 0, "errors": 0, "late": 0}
+
+
+def stats():
+    with _stats_lock:
+        data = dict(_stats)
+    hits = data["threaded"] + data["duplicates"]
+    data["hit_rate"] = round(hits / data["checked"], 4) if data["checked"] else 0.0
+    return data
+
+
+@metrics.timed("db_seconds", function="thread_index.lookup")
+def lookup_many(parsed_list):
+    """[(rank, project_id) or None] per parsed email; one query for the batch."""
+    payload = []
+    for n, parsed in enumerate(parsed_list):
+        for rank, key, kind in _lookup_keys(parsed):
+            payload.append({"n": n, "r": rank, "t": kind, "k": key})
+    best = [None] * len(parsed_list)
+    if not payload:
+        return best
+    conn = db_writer.get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(LOOKUP_SQL, (json.dumps(payload), THREAD_SUBJECT_WINDOW_DAYS))
+        rows = cur.fetchall()
+    finally:
+        conn.close()
+    for n, rank, _, project_id in rows:
+        if best[n] is None or rank < best[n][0]:
+            best[n] = (rank, project_id)
+    return best
+
+
+def _decision(parsed, hit):
+    rank, project_id = hit
+    if rank == RANK_SELF:
+        # same Message-ID already stored: CC'd aliases or a redelivery
+        print(f"↩ Duplicate delivery of a message already stored on project {project_id}")
+        return {"kind": "skip", "thread_rule": "duplicate"}
+    rule = "subject" if rank == RANK_SUBJECT else "reply_header"
+    new_status, _ = preclassifier.reply_status(preclassifier.strip_quoted(parsed.get("body")))
+    print(f"🧵 Follow-up on project {project_id} ({rule}), no extraction needed")
+    return {"kind": "status", "thread_rule": rule, "status_info": {
+        "is_status_update": True,
+        "task_id": project_id,
+        "new_status": new_status,
+    }}
+
+
+def resolve_many(parsed_list):
+    """
+    A write_email() decision per parsed email that belongs to a known
+    thread (None for the rest, which go to classification). Lookup
+    errors are logged and treated as misses.
+    """
+    if not THREAD_INDEX_ENABLED or not parsed_list:
+        return [None] * len(parsed_list)
+    try:
+        hits = lookup_many(parsed_list)
+    except Exception as e:
+        print("❌ Thread index lookup failed:", e)
+        with _stats_lock:
+            _stats["checked"] += len(parsed_list)
+            _stats["errors"] += 1
+        return [None] * len(parsed_list)
+
+    decisions = [None if hit is None else _decision(p, hit) for p, hit in zip(parsed_list, hits)]
+    found = [d for d in decisions if d is not None]
+    with _stats_lock:
+        _stats["checked"] += len(parsed_list)
+        _stats["duplicates"] += sum(1 for d in found if d["kind"] == "skip")
+        _stats["threaded"] += sum(1 for d in found if d["kind"] == "status")
+    for d in found:
+        metrics.inc("thread_index_hits_total", rule=d["thread_rule"])
+    preclassifier.record_saved_calls(len(found))
+    return decisions
+
+
+def resolve(parsed):
+    return resolve_many([parsed])[0]
+
+
+# ------------------------------------------------------------
+# Writer stage
+# ------------------------------------------------------------
+class WrittenThreads:
+    """
+    Message-IDs written earlier in one drain -> project id. Only used
+    from the pipeline's writer thread.
+    """
+
+    def __init__(self):
+        self._projects = {}
+
+    def add(self, message_id, project_id):
+        mid = normalize_message_id(message_id)
+        if mid and project_id is not None:
+            # like the index: a Message-ID stays with its first project
+            self._projects.setdefault(key_hash("m", mid), project_id)
+
+    def lookup(self, parsed):
+        """(rank, project_id) of the best Message-ID hit, or None."""
+        best = None
+        for rank, key, kind in _lookup_keys(parsed):
+            project_id = self._projects.get(key) if kind == "m" else None
+            if project_id is not None and (best is None or rank < best[0]):
+                best = (rank, project_id)
+        return best
+
+
+def recheck(parsed_list, written=None):
+    """
+    Writer-stage second look at emails classified as new projects: their
+    thread may have been written since they were resolved. Checks
+    `written` (a WrittenThreads) and the index; returns a write_email()
+    decision or None per email, like resolve_many().
+    """
+    if not THREAD_INDEX_ENABLED or not parsed_list:
+        return [None] * len(parsed_list)
+    hits = [written.lookup(p) if written is not None else None for p in parsed_list]
+    todo = [n for n, hit in enumerate(hits) if hit is None or hit[0] != RANK_SELF]
+    try:
+        found = lookup_many([parsed_list[n] for n in todo]) if todo else []
+    except Exception as e:
+        print("❌ Thread index lookup failed:", e)
+        with _stats_lock:
+            _stats["errors"] += 1
+        found = [None] * len(todo)
+    for n, hit in zip(todo, found):
+        if hit is not None and (hits[n] is None or hit[0] < hits[n][0]):
+            hits[n] = hit
+
+    decisions = [None if hit is None else _decision(p, hit) for p, hit in zip(parsed_list, hits)]
+    with _stats_lock:
+        _stats["late"] += sum(1 for d in decisions if d is not None)
+    return decisions